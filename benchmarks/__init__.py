@@ -0,0 +1,4 @@
+""" Benchmarks for the Cinema 3 services, run as modules from the repository root:
+
+    python -m benchmarks.<benchmark> --help
+"""
@@ -0,0 +1,72 @@
+""" Per-user booking lookup time as the bookings table grows, with and without
+the (user, date) index.
+
+    python -m benchmarks.bench_booking_lookup --sizes 10000 100000 1000000
+"""
+import argparse
+import random
+import tempfile
+import time
+from datetime import date, timedelta
+from os.path import join
+from sqlalchemy import create_engine, text
+from services.bookings import Booking
+
+INSERT_CHUNK_SIZE = 50000
+
+
+def fill_bookings(engine, size, users, movies):
+    """ Insert `size` random bookings spread over a year """
+    rng = random.Random(size)
+    first_day = date(2019, 1, 1)
+    insert = Booking.__table__.insert()
+    for start in range(0, size, INSERT_CHUNK_SIZE):
+        rows = [{"user": rng.randint(1, users),
+                 "movie": rng.randint(1, movies),
+                 "date": first_day + timedelta(days=rng.randint(0, 364)),
+                 "rewarded": True}
+                for _ in range(start, min(start + INSERT_CHUNK_SIZE, size))]
+        engine.execute(insert, rows)
+
+
+def time_lookups(engine, users, lookups):
+    """ Mean milliseconds to fetch one user's bookings for a month """
+    rng = random.Random(0)
+    query = text("SELECT * FROM booking WHERE user = :user "
+                 "AND date BETWEEN '2019-06-01' AND '2019-06-30' ORDER BY date")
+    with engine.connect() as connection:
+        start = time.perf_counter()
+        for _ in range(lookups):
+            connection.execute(query, user=rng.randint(1, users)).fetchall()
+        elapsed = time.perf_counter() - start
+
+    return elapsed / lookups * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[10000, 100000, 1000000])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--movies", type=int, default=500)
+    parser.add_argument("--lookups", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'bookings':>10} {'indexed ms':>12} {'full scan ms':>14}")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            engine = create_engine(f"sqlite:///{join(tmp_dir, 'bookings.db')}")
+            Booking.__table__.create(engine)
+            fill_bookings(engine, size, args.users, args.movies)
+
+            indexed = time_lookups(engine, args.users, args.lookups)
+            for index in Booking.__table__.indexes:
+                index.drop(bind=engine)
+            full_scan = time_lookups(engine, args.users, args.lookups)
+            engine.dispose()
+
+        print(f"{size:>10} {indexed:>12.3f} {full_scan:>14.3f}")
+
+
+if __name__ == "__main__":
+    main()
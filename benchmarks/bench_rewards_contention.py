@@ -0,0 +1,106 @@
+""" Hammer a single user's score from several processes and check that no
+point is lost.
+
+Each process posts to /rewards/add_score through the rewards app, all of them
+sharing one SQLite file. For comparison the same load is also run with the
+former read-modify-write increment done through the ORM.
+
+    python -m benchmarks.bench_rewards_contention --processes 8 --increments 200
+"""
+import argparse
+import multiprocessing
+import sys
+import tempfile
+import time
+from os.path import join
+from sqlalchemy import create_engine
+from services import rewards
+
+USER = 1
+
+
+def bind_database(db_path):
+    """ Point the rewards app of this process at the benchmark database """
+    rewards.app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{db_path}"
+
+
+def atomic_worker(db_path, increments, errors):
+    """ Increment through the service route """
+    bind_database(db_path)
+    with rewards.app.test_client() as add_score_route:
+        for _ in range(increments):
+            response = add_score_route.post(
+                "/rewards/add_score", json={"user": USER, "add_to_score": 1})
+            if response.status_code != 200:
+                with errors.get_lock():
+                    errors.value += 1
+
+
+def read_modify_write_worker(db_path, increments, errors):
+    """ Increment the way add_score used to: read, add in Python, commit """
+    bind_database(db_path)
+    with rewards.app.app_context():
+        for _ in range(increments):
+            try:
+                reward = rewards.Reward.query.get(USER)
+                reward.score += 1
+                rewards.db.session.commit()
+            except Exception:
+                rewards.db.session.rollback()
+                with errors.get_lock():
+                    errors.value += 1
+
+
+def run(worker, processes, increments):
+    """ Returns (final score, failed requests, seconds) for one strategy """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = join(tmp_dir, "rewards.db")
+        engine = create_engine(f"sqlite:///{db_path}")
+        rewards.Reward.__table__.create(engine)
+        engine.execute(rewards.Reward.__table__.insert(),
+                       {"user": USER, "score": 0})
+
+        errors = multiprocessing.Value('i', 0)
+        workers = [multiprocessing.Process(
+            target=worker, args=(db_path, increments, errors))
+            for _ in range(processes)]
+        start = time.perf_counter()
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
+        elapsed = time.perf_counter() - start
+
+        score = engine.execute(
+            "SELECT score FROM reward WHERE user = ?", USER).scalar()
+        engine.dispose()
+
+    return score, errors.value, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--increments", type=int, default=200,
+                        help="increments sent by each process")
+    args = parser.parse_args()
+    expected = args.processes * args.increments
+
+    exact = True
+    print(f"{'strategy':>18} {'score':>8} {'expected':>9} {'errors':>7} "
+          f"{'lost':>6} {'incr/s':>9}")
+    for name, worker in (("atomic update", atomic_worker),
+                         ("read-modify-write", read_modify_write_worker)):
+        score, errors, elapsed = run(worker, args.processes, args.increments)
+        lost = expected - errors - score
+        print(f"{name:>18} {score:>8} {expected:>9} {errors:>7} "
+              f"{lost:>6} {score / elapsed:>9.0f}")
+        if worker is atomic_worker:
+            exact = score == expected
+
+    # the service route must account for every single increment
+    sys.exit(0 if exact else 1)
+
+
+if __name__ == "__main__":
+    main()
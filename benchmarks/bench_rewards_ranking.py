@@ -0,0 +1,104 @@
+""" Leaderboard reads as the rewards table grows to millions of users.
+
+Times /rewards/top, served from the score index, and /rewards/rank/<user>,
+served from the count of users per score, against what a client had to do
+before: download /rewards whole and sort it. Ranks are looked up for users at
+several places on the leaderboard, which no longer makes a difference.
+
+    python -m benchmarks.bench_rewards_ranking --sizes 100000 1000000 3000000
+"""
+import argparse
+import random
+import sqlite3
+import tempfile
+import time
+from os.path import join
+from sqlalchemy import create_engine
+from sqlalchemy.schema import CreateTable
+from services import rewards
+
+INSERT_CHUNK_SIZE = 50000
+# places on the leaderboard, as a fraction of the users, of the ranked users
+RANK_PERCENTILES = (0.001, 0.1, 0.5, 0.9)
+
+
+def fill_rewards(db_path, size):
+    """ `size` users whose scores are skewed: most have a few points.
+        Returns the users in leaderboard order.
+    """
+    rng = random.Random(size)
+    engine = create_engine(f"sqlite:///{db_path}")
+    # the index is built once the table is full
+    engine.execute(CreateTable(rewards.Reward.__table__))
+    engine.dispose()
+
+    connection = sqlite3.connect(db_path)
+    with connection:
+        for start in range(1, size + 1, INSERT_CHUNK_SIZE):
+            connection.executemany(
+                "INSERT INTO reward (user, score) VALUES (?, ?)",
+                ((user, int(rng.expovariate(0.1)))
+                 for user in range(start, min(start + INSERT_CHUNK_SIZE,
+                                              size + 1))))
+        users_by_place = [user for user, in connection.execute(
+            "SELECT user FROM reward ORDER BY score DESC, user")]
+    connection.close()
+    return users_by_place
+
+
+def timed(route, url, repeat):
+    """ Mean milliseconds to answer a GET """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        response = route.get(url)
+        response.get_data()
+        assert response.status_code == 200, (url, response.status_code)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def bench(size, repeat):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = join(tmp_dir, "rewards.db")
+        users_by_place = fill_rewards(db_path, size)
+        engine = create_engine(f"sqlite:///{db_path}")
+        for index in rewards.Reward.__table__.indexes:
+            index.create(bind=engine)
+        # the score counts, filled from the rewards as they are created
+        rewards.db.metadata.create_all(engine)
+        engine.dispose()
+
+        rewards.app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{db_path}"
+        results = {}
+        with rewards.app.test_client() as route:
+            start = time.perf_counter()
+            everyone = route.get("/rewards").get_json()
+            everyone.sort(key=lambda reward: (-reward["score"], reward["user"]))
+            results["dump and sort"] = (time.perf_counter() - start) * 1000
+
+            results["top 100"] = timed(route, "/rewards/top?n=100", repeat)
+            results["top 100 @ 10k"] = timed(
+                route, "/rewards/top?n=100&offset=10000", repeat)
+            for percentile in RANK_PERCENTILES:
+                user = users_by_place[int(size * percentile)]
+                results[f"rank @ {percentile:.1%}"] = timed(
+                    route, f"/rewards/rank/{user}", repeat)
+        rewards.db.engine.dispose()
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[100000, 1000000, 3000000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        print(f"{size} users")
+        for name, milliseconds in bench(size, args.repeat).items():
+            print(f"  {name:<16} {milliseconds:>10.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+""" Serializing 10k-row lists: marshmallow dumps(sort_keys=True, indent=4),
+the former path of the list routes, against the fast encoder.
+
+    python -m benchmarks.bench_serialization --rows 10000
+"""
+import argparse
+import random
+import timeit
+from datetime import date, timedelta
+from services.bookings import Booking, bookings_schema, booking_encoder
+from services.movies import Movie, movies_schema, movie_encoder
+
+
+def sample_bookings(rows):
+    rng = random.Random(rows)
+    return [Booking(id=index, user=rng.randint(1, 1000),
+                    movie=rng.randint(1, 100), rewarded=rng.random() < 0.9,
+                    date=date(2019, 1, 1) + timedelta(days=index % 365))
+            for index in range(1, rows + 1)]
+
+
+def sample_movies(rows):
+    rng = random.Random(rows)
+    return [Movie(id=index, rating=rng.randint(1, 10),
+                  title=f"Movie number {index}", director="Richard Linklater")
+            for index in range(1, rows + 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'list':>9} {'path':>20} {'ms':>9} {'KiB':>8}")
+    for name, objs, schema, encoder in (
+            ("bookings", sample_bookings(args.rows), bookings_schema,
+             booking_encoder),
+            ("movies", sample_movies(args.rows), movies_schema,
+             movie_encoder)):
+        paths = (
+            ("marshmallow indent=4",
+             lambda: schema.dumps(objs, sort_keys=True, indent=4)),
+            ("fast ?pretty=1", lambda: encoder.dumps_many(objs, pretty=True)),
+            ("fast compact", lambda: encoder.dumps_many(objs)))
+        assert paths[0][1]() == paths[1][1]()
+
+        for path, dump in paths:
+            best = min(timeit.repeat(dump, number=1, repeat=args.repeat))
+            size = len(dump()) / 1024
+            print(f"{name:>9} {path:>20} {best * 1000:>9.2f} {size:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
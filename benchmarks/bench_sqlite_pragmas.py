@@ -0,0 +1,98 @@
+""" Mixed read/write throughput of the bookings service with SQLite's default
+settings and with the pragmas the services apply.
+
+Several processes share one database file; each of them reads the bookings
+of random users and, now and then, books a movie through the bookings app,
+for a fixed amount of time.
+
+    python -m benchmarks.bench_sqlite_pragmas --processes 8 --seconds 5
+"""
+import argparse
+import multiprocessing
+import random
+import tempfile
+import time
+from os.path import join
+from sqlalchemy import create_engine
+from services import bookings
+from services.database import SQLITE_PRAGMAS
+from benchmarks.bench_booking_lookup import fill_bookings
+
+PROFILES = {
+    # what a connection gets when nothing is set, python's 5s lock timeout
+    "sqlite defaults": {'journal_mode': 'DELETE', 'synchronous': 'FULL',
+                        'busy_timeout': 5000, 'mmap_size': 0,
+                        'cache_size': -2000},
+    "service pragmas": SQLITE_PRAGMAS,
+}
+
+
+def worker(db_path, pragmas, seconds, write_ratio, users, movies, counts):
+    """ Read and write through the bookings routes until time is up """
+    bookings.app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{db_path}"
+    bookings.app.config['SQLITE_PRAGMAS'] = pragmas
+    rng = random.Random()
+    reads = writes = errors = 0
+
+    with bookings.app.test_client() as bookings_route:
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            user = rng.randint(1, users)
+            if rng.random() < write_ratio:
+                response = bookings_route.post("/bookings/new", json={
+                    "user": user, "movie": rng.randint(1, movies),
+                    "date": "2019-12-01"})
+                writes += response.status_code == 200
+            else:
+                response = bookings_route.get(f"/bookings/{user}")
+                reads += response.status_code in (200, 404)
+            errors += response.status_code not in (200, 404)
+
+    with counts.get_lock():
+        counts[0] += reads
+        counts[1] += writes
+        counts[2] += errors
+
+
+def run(pragmas, args):
+    """ Returns (reads/s, writes/s, errors) for one set of pragmas """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = join(tmp_dir, "bookings.db")
+        engine = create_engine(f"sqlite:///{db_path}")
+        bookings.db.metadata.create_all(engine)
+        fill_bookings(engine, args.bookings, args.users, args.movies)
+        engine.dispose()
+
+        counts = multiprocessing.Array('i', 3)
+        workers = [multiprocessing.Process(target=worker, args=(
+            db_path, pragmas, args.seconds, args.write_ratio,
+            args.users, args.movies, counts))
+            for _ in range(args.processes)]
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
+
+    reads, writes, errors = counts[:]
+    return reads / args.seconds, writes / args.seconds, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--write-ratio", type=float, default=0.2,
+                        help="share of the requests booking a movie")
+    parser.add_argument("--bookings", type=int, default=100000)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--movies", type=int, default=500)
+    args = parser.parse_args()
+
+    print(f"{'profile':>16} {'reads/s':>9} {'writes/s':>9} {'errors':>7}")
+    for name, pragmas in PROFILES.items():
+        reads, writes, errors = run(pragmas, args)
+        print(f"{name:>16} {reads:>9.0f} {writes:>9.0f} {errors:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+""" Load generation against the five services running locally.
+
+The services are started with the launcher on generated databases, then
+concurrent clients replay a weighted mix of requests for a fixed time.
+Throughput and latency percentiles are reported per route as JSON, so runs
+can be compared across commits:
+
+    python -m benchmarks.load --mix browse --clients 16 --duration 30
+    python -m benchmarks.load --weights movie=3,new_booking=1 --output run.json
+
+The services bind their usual ports, stop any running copy first.
+"""
@@ -0,0 +1,100 @@
+import argparse
+import json
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from os.path import join
+from benchmarks.load import __doc__ as description
+from benchmarks.load.cluster import Cluster
+from benchmarks.load.data import generate
+from benchmarks.load.traffic import MIXES, ROUTES, run
+
+
+def parse_weights(raw_weights):
+    """ Read route=weight,route=weight """
+    weights = {}
+    for item in raw_weights.split(","):
+        route, _, weight = item.partition("=")
+        if route not in ROUTES:
+            raise argparse.ArgumentTypeError(
+                f"unknown route {route}, choose among {', '.join(ROUTES)}")
+        weights[route] = float(weight or 1)
+    return weights
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def outbox_backlog(database_dir):
+    """ Reward points not yet credited when the run ended """
+    connection = sqlite3.connect(join(database_dir, "bookings.db"))
+    try:
+        return connection.execute(
+            "SELECT COUNT(*) FROM reward_outbox").fetchone()[0]
+    finally:
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=description,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mix", choices=MIXES, default="mixed")
+    parser.add_argument("--weights", type=parse_weights,
+                        help="route=weight,... instead of a predefined mix")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30.0,
+                        help="seconds measured")
+    parser.add_argument("--warmup", type=float, default=5.0,
+                        help="seconds run before measuring")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--movies", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--days", type=int, default=60)
+    parser.add_argument("--showtimes-per-day", type=int, default=20)
+    parser.add_argument("--bookings", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the report to this file")
+    args = parser.parse_args()
+    weights = args.weights or MIXES[args.mix]
+
+    with tempfile.TemporaryDirectory() as database_dir:
+        data = generate(database_dir, args.movies, args.users, args.days,
+                        args.showtimes_per_day, args.bookings, args.seed)
+        with Cluster(database_dir, args.workers, args.threads) as cluster:
+            routes, total = run(cluster, data, weights, args.clients,
+                                args.duration, args.warmup, args.seed)
+        backlog = outbox_backlog(database_dir)
+
+    report = {
+        "commit": current_commit(),
+        "mix": "custom" if args.weights else args.mix,
+        "weights": weights,
+        "clients": args.clients,
+        "duration": args.duration,
+        "workers": args.workers,
+        "threads": args.threads,
+        "data": dict(data.as_dict(), bookings=args.bookings),
+        "routes": routes,
+        "total": total,
+        # points of the bookings made during the run still waiting for
+        # the rewards service
+        "outbox_backlog": backlog,
+    }
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as report_file:
+            report_file.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+""" The five services run with the launcher, on the benchmark databases """
+import os
+import signal
+import subprocess
+import sys
+from os.path import join
+from services.launcher import SERVICES, GRACEFUL_TIMEOUT, wait_until_ready
+
+HOST = "127.0.0.1"
+
+
+class Cluster:
+    """ Starts the services on entering and stops them on exit """
+
+    def __init__(self, database_dir, workers, threads):
+        self.database_dir = database_dir
+        self.workers = workers
+        self.threads = threads
+        self.processes = []
+
+    def __enter__(self):
+        environment = dict(os.environ, CINEMA_DATABASE_DIR=self.database_dir)
+        for service in SERVICES:
+            log = open(join(self.database_dir, f"{service}.log"), "w")
+            self.processes.append(subprocess.Popen(
+                [sys.executable, "-m", "services.launcher", "--host", HOST,
+                 "serve", service, "--workers", str(self.workers),
+                 "--threads", str(self.threads)],
+                env=environment, stdout=log, stderr=subprocess.STDOUT))
+            log.close()
+
+        if not wait_until_ready(SERVICES, HOST):
+            self.stop()
+            raise RuntimeError(f"The services did not start, see the logs "
+                               f"in {self.database_dir}")
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stop(self):
+        """ Stop the services gracefully, then for good """
+        for process in self.processes:
+            process.send_signal(signal.SIGTERM)
+        for process in self.processes:
+            try:
+                process.wait(GRACEFUL_TIMEOUT + 5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.processes = []
+
+    def url(self, service, path):
+        return f"http://{HOST}:{SERVICES[service]}{path}"
@@ -0,0 +1,44 @@
+""" The data set of populate_db.py, written into the service databases """
+import sqlite3
+from datetime import date, timedelta
+import populate_db
+
+
+class DataSet:
+    """ What was generated, for the traffic to pick existing rows """
+
+    def __init__(self, movies, users, days, schedule):
+        self.movies = movies
+        self.users = users
+        self.days = [populate_db.FIRST_DAY + timedelta(days=day)
+                     for day in range(days)]
+        # (date, movie) of every showtime
+        self.schedule = schedule
+
+    def as_dict(self):
+        return {"movies": self.movies, "users": self.users,
+                "days": len(self.days), "showtimes": len(self.schedule)}
+
+
+def generate(database_dir, movie_count, user_count, days, showtimes_per_day,
+             booking_count, seed=0):
+    """ Replace the five databases in `database_dir` with those populate_db.py
+        generates for these sizes
+    """
+    sizes = populate_db.Sizes(0, users=user_count, movies=movie_count,
+                              bookings=booking_count, days=days,
+                              showtimes_per_day=showtimes_per_day)
+    populate_db.generate(database_dir, sizes, seed)
+    return DataSet(sizes.movies, sizes.users, sizes.days,
+                   read_schedule(database_dir))
+
+
+def read_schedule(database_dir):
+    """ (date, movie) of every generated showtime """
+    connection = sqlite3.connect(
+        populate_db.database_path(database_dir, "showtimes"))
+    try:
+        return [(date.fromisoformat(day), movie) for day, movie in
+                connection.execute("SELECT date, movie FROM showtime")]
+    finally:
+        connection.close()
@@ -0,0 +1,145 @@
+""" Weighted request mixes replayed by concurrent clients """
+import random
+import threading
+import time
+# http for humans
+import requests
+
+# every route a mix can weigh: request(rng, data) -> (service, method, path, json)
+ROUTES = {
+    "movie_list": lambda rng, data: ("movies", "GET", "/movies", None),
+    "movie": lambda rng, data: (
+        "movies", "GET", f"/movies/{rng.randint(1, data.movies)}", None),
+    "movie_lookup": lambda rng, data: (
+        "movies", "GET", "/movies?ids=" + ",".join(
+            str(rng.randint(1, data.movies)) for _ in range(20)), None),
+    "schedule": lambda rng, data: (
+        "showtimes", "GET", "/showtimes?from={}&to={}".format(
+            *week(rng, data)), None),
+    "showtimes_date": lambda rng, data: (
+        "showtimes", "GET", f"/showtimes/{rng.choice(data.days)}", None),
+    "new_booking": lambda rng, data: new_booking(rng, data),
+    "user_bookings": lambda rng, data: (
+        "users", "GET", f"/users/{rng.randint(1, data.users)}/bookings", None),
+    "user_bookings_expanded": lambda rng, data: (
+        "users", "GET", f"/users/{rng.randint(1, data.users)}/bookings"
+        "?expand=movie,showtime", None),
+}
+
+MIXES = {
+    # people looking around before booking
+    "browse": {"movie_list": 1, "movie": 4, "movie_lookup": 2, "schedule": 3,
+               "showtimes_date": 2, "user_bookings": 2},
+    # a premiere: bookings, each of them crediting reward points
+    "booking": {"movie": 2, "schedule": 2, "new_booking": 5,
+                "user_bookings": 1},
+    "mixed": {"movie_list": 1, "movie": 3, "movie_lookup": 1, "schedule": 2,
+              "showtimes_date": 1, "new_booking": 2, "user_bookings": 2,
+              "user_bookings_expanded": 1},
+}
+
+PERCENTILES = (50, 95, 99)
+
+
+def week(rng, data):
+    """ A week of the generated schedule """
+    first = rng.randrange(max(1, len(data.days) - 6))
+    return data.days[first], data.days[min(first + 6, len(data.days) - 1)]
+
+
+def new_booking(rng, data):
+    day, movie = rng.choice(data.schedule)
+    return ("bookings", "POST", "/bookings/new",
+            {"user": rng.randint(1, data.users), "movie": movie,
+             "date": day.isoformat()})
+
+
+class Recorder:
+    """ Latencies and errors per route, shared by the clients """
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, route, seconds, failed):
+        with self._lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            self.errors[route] = self.errors.get(route, 0) + failed
+
+    def report(self, duration):
+        """ Throughput and latency percentiles per route, and overall """
+        with self._lock:
+            routes = {route: summarize(latencies, self.errors[route], duration)
+                      for route, latencies in sorted(self.latencies.items())}
+            every_latency = [seconds for latencies in self.latencies.values()
+                             for seconds in latencies]
+            total = summarize(every_latency, sum(self.errors.values()), duration)
+        return routes, total
+
+
+def summarize(latencies, errors, duration):
+    latencies = sorted(latencies)
+    summary = {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / duration, 1),
+    }
+    for percentile in PERCENTILES:
+        summary[f"p{percentile}_ms"] = round(
+            percentile_of(latencies, percentile) * 1000, 3)
+    summary["max_ms"] = round(latencies[-1] * 1000, 3) if latencies else 0.0
+    return summary
+
+
+def percentile_of(sorted_values, percentile):
+    """ Nearest-rank percentile """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * percentile // 100))
+    return sorted_values[rank - 1]
+
+
+def client(cluster, data, weights, seed, deadline, warmup_until, recorder):
+    """ Send requests back to back until the deadline. Those answered
+        before the warmup is over are not recorded.
+    """
+    rng = random.Random(seed)
+    routes = list(weights)
+    cumulative_weights = []
+    for route in routes:
+        cumulative_weights.append(
+            weights[route] + (cumulative_weights[-1] if cumulative_weights else 0))
+
+    with requests.Session() as session:
+        while time.perf_counter() < deadline:
+            route = rng.choices(routes, cum_weights=cumulative_weights)[0]
+            service, method, path, body = ROUTES[route](rng, data)
+            start = time.perf_counter()
+            try:
+                failed = session.request(
+                    method, cluster.url(service, path), json=body,
+                    timeout=10).status_code >= 500
+            except requests.exceptions.RequestException:
+                failed = True
+            end = time.perf_counter()
+            if start >= warmup_until:
+                recorder.record(route, end - start, failed)
+
+
+def run(cluster, data, weights, clients, duration, warmup, seed=0):
+    """ Drive the cluster with `clients` concurrent clients for `duration`
+        seconds after `warmup` seconds, then report per route
+    """
+    recorder = Recorder()
+    warmup_until = time.perf_counter() + warmup
+    deadline = warmup_until + duration
+    threads = [threading.Thread(target=client, args=(
+        cluster, data, weights, seed + number, deadline, warmup_until,
+        recorder)) for number in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return recorder.report(duration)
@@ -0,0 +1,16 @@
+""" Upgrade existing service databases in place to the current models.
+
+Tables and indexes added since a database file was created are added to it,
+data is left untouched. Run it from the repository root:
+
+    python migrate_db.py
+"""
+from services.bookings import db as bookings_db
+from services.movies import db as movies_db
+from services.rewards import db as rewards_db
+from services.showtimes import db as showtimes_db
+# schema migrations
+from services.database import upgrade_schema
+
+for service_db in (bookings_db, movies_db, rewards_db, showtimes_db):
+    upgrade_schema(service_db)
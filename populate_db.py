@@ -1,75 +1,276 @@
+""" Fill the five service databases with generated data.
+
+The same seed always gives the same data. Sizes grow with the scale factor,
+scale 1 being 1M users, 50k movies, 5M bookings and a year of showtimes:
+
+    python populate_db.py                   # scale 0.01
+    python populate_db.py --scale 1 --seed 7
+    python populate_db.py --users 3 --movies 3 --bookings 3 --days 3
+
+Popularity is skewed the way it is at a real box office: a few movies sell
+most of the tickets and a few users book far more than the others. Existing
+databases are replaced; rows are loaded with chunked executemany calls
+straight through sqlite3, the indexes being built once the tables are full.
+"""
+import argparse
+import itertools
+import os
+import random
+import sqlite3
+import time
+from datetime import date, timedelta
+from os.path import join
+from sqlalchemy import create_engine
+from sqlalchemy.schema import CreateTable
+# Models
 from services.bookings import db as bookings_db
 from services.movies import db as movies_db
 from services.rewards import db as rewards_db
 from services.showtimes import db as showtimes_db
 from services.users import db as users_db
-# Models
-from services.bookings import Booking
-from services.movies import Movie
-from services.rewards import Reward
-from services.showtimes import Showtime
-from services.users import User
-# timestamp
-from datetime import date
-
-# Clean previous databses
-bookings_db.drop_all()
-movies_db.drop_all()
-rewards_db.drop_all()
-showtimes_db.drop_all()
-users_db.drop_all()
-
-# Create the databases
-bookings_db.create_all()
-movies_db.create_all()
-rewards_db.create_all()
-showtimes_db.create_all()
-users_db.create_all()
-
-# populate bookings
-b1 = Booking(user=1, date=date(2019, 11, 1), movie=1, rewarded=True)
-b2 = Booking(user=2, date=date(2019, 11, 1), movie=2, rewarded=True)
-b3 = Booking(user=3, date=date(2019, 11, 3), movie=3, rewarded=True)
-bookings_db.session.add(b1)
-bookings_db.session.add(b2)
-bookings_db.session.add(b3)
-bookings_db.session.commit()
-
-# populate movies
-m1 = Movie(rating=10, title="Boyhood", director="Richard Linklater")
-m2 = Movie(rating=8, title="Before Sunset", director="Richard Linklater")
-m3 = Movie(rating=9, title="Waking Life", director="Richard Linklater")
-movies_db.session.add(m1)
-movies_db.session.add(m2)
-movies_db.session.add(m3)
-movies_db.session.commit()
-
-
-#populate rewards
-r1 = Reward(user=1, score=0)
-r2 = Reward(user=2, score=0)
-r3 = Reward(user=3, score=0)
-rewards_db.session.add(r1)
-rewards_db.session.add(r2)
-rewards_db.session.add(r3)
-rewards_db.session.commit()
-
-
-#populate showtimes
-s1 = Showtime(date=date(2019, 11, 1), movie=1)
-s2 = Showtime(date=date(2019, 11, 2), movie=2)
-s3 = Showtime(date=date(2019, 11, 3), movie=3)
-showtimes_db.session.add(s1)
-showtimes_db.session.add(s2)
-showtimes_db.session.add(s3)
-showtimes_db.session.commit()
-
-
-# populate users
-u1 = User(name="Jim Halpert")
-u2 = User(name="Dwight Schrute")
-u3 = User(name="Michael Scott")
-users_db.session.add(u1)
-users_db.session.add(u2)
-users_db.session.add(u3)
-users_db.session.commit()
+# where the services look for their databases
+from services.database import DATABASE_DIR
+
+# sizes at scale 1
+USERS = 1000000
+MOVIES = 50000
+BOOKINGS = 5000000
+SHOWTIMES_PER_DAY = 500
+DAYS = 365
+# fewer showtimes a day would leave most of a small catalog unscheduled
+MIN_SHOWTIMES_PER_DAY = 10
+DEFAULT_SCALE = 0.01
+FIRST_DAY = date(2019, 11, 1)
+
+# exponents of the Zipf laws the popularity of movies and the activity of
+# users follow: rank r gets a weight of 1 / r ** exponent
+MOVIE_POPULARITY_SKEW = 1.1
+USER_ACTIVITY_SKEW = 0.8
+
+# rows per executemany call
+INSERT_CHUNK_SIZE = 50000
+
+SERVICE_DATABASES = {
+    "bookings": bookings_db,
+    "movies": movies_db,
+    "rewards": rewards_db,
+    "showtimes": showtimes_db,
+    "users": users_db,
+}
+
+FIRST_NAMES = ("Jim", "Pam", "Dwight", "Michael", "Angela", "Oscar", "Kevin",
+               "Stanley", "Phyllis", "Andy", "Erin", "Ryan", "Kelly", "Toby",
+               "Creed", "Meredith", "Darryl", "Jan", "Holly", "Karen")
+LAST_NAMES = ("Halpert", "Beesly", "Schrute", "Scott", "Martin", "Martinez",
+              "Malone", "Hudson", "Vance", "Bernard", "Hannon", "Howard",
+              "Kapoor", "Flenderson", "Bratton", "Palmer", "Philbin", "Levinson",
+              "Flax", "Filippelli")
+TITLE_WORDS = ("Before", "After", "Sunset", "Sunrise", "Midnight", "Waking",
+               "Life", "Boyhood", "School", "Rock", "Dazed", "Confused",
+               "Slacker", "Tape", "Fast", "Food", "Nation", "Bernie", "Last",
+               "Flag", "Flying", "Everybody", "Wants", "Some", "Apollo")
+# ratings of movies, most of them average
+RATING_WEIGHTS = (1, 2, 4, 7, 10, 12, 10, 7, 4, 2)
+
+
+class Sizes:
+    """ How many rows of each kind to generate """
+
+    def __init__(self, scale, users=None, movies=None, bookings=None,
+                 days=None, showtimes_per_day=None):
+        self.users = users if users is not None else round(USERS * scale)
+        self.movies = movies if movies is not None else round(MOVIES * scale)
+        self.bookings = bookings if bookings is not None \
+            else round(BOOKINGS * scale)
+        self.days = days if days is not None else DAYS
+        if showtimes_per_day is None:
+            showtimes_per_day = max(MIN_SHOWTIMES_PER_DAY,
+                                    round(SHOWTIMES_PER_DAY * scale))
+        self.showtimes_per_day = min(showtimes_per_day, self.movies)
+
+    def __repr__(self):
+        return (f"{self.users} users, {self.movies} movies, {self.bookings} "
+                f"bookings, {self.showtimes_per_day} showtimes a day for "
+                f"{self.days} days")
+
+
+def zipf_cum_weights(count, exponent):
+    """ Cumulative weights of ranks 1 to `count` under a Zipf law """
+    return list(itertools.accumulate(
+        1 / rank ** exponent for rank in range(1, count + 1)))
+
+
+def ranked(rng, count):
+    """ Ids 1 to `count` in a random order, the first one being ranked 1st """
+    ids = list(range(1, count + 1))
+    rng.shuffle(ids)
+    return ids
+
+
+def movie_rows(rng, sizes):
+    directors = max(1, sizes.movies // 8)
+    for movie in range(1, sizes.movies + 1):
+        title = " ".join(rng.sample(TITLE_WORDS, rng.randint(1, 3)))
+        yield (movie, f"{title} {movie}", f"Director {rng.randint(1, directors)}",
+               rng.choices(range(1, 11), RATING_WEIGHTS)[0])
+
+
+def user_rows(rng, sizes):
+    for user in range(1, sizes.users + 1):
+        yield (user, f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}")
+
+
+def schedule(rng, sizes, movies_by_rank, movie_weights):
+    """ (date, movie) of every showtime: each day the popular movies are the
+        likeliest to be on
+    """
+    showtimes = []
+    for day in range(sizes.days):
+        screening = set()
+        while len(screening) < sizes.showtimes_per_day:
+            screening.update(rng.choices(
+                movies_by_rank, cum_weights=movie_weights,
+                k=sizes.showtimes_per_day - len(screening)))
+        day_date = (FIRST_DAY + timedelta(days=day)).isoformat()
+        showtimes.extend((day_date, movie) for movie in sorted(screening))
+    return showtimes
+
+
+def booking_rows(rng, sizes, showtimes, showtime_weights, users_by_rank,
+                 scores):
+    """ Bookings of showtimes picked by the popularity of their movie, by
+        users picked by their activity. Each one earned its point, counted
+        in `scores`.
+    """
+    user_weights = zipf_cum_weights(sizes.users, USER_ACTIVITY_SKEW)
+    left = sizes.bookings
+    while left:
+        count = min(left, INSERT_CHUNK_SIZE)
+        picked_showtimes = rng.choices(showtimes, cum_weights=showtime_weights,
+                                       k=count)
+        picked_users = rng.choices(users_by_rank, cum_weights=user_weights,
+                                   k=count)
+        for (day_date, movie), user in zip(picked_showtimes, picked_users):
+            scores[user] += 1
+            yield (user, day_date, movie, 1)
+        left -= count
+
+
+def generate(database_dir, sizes, seed=0):
+    """ Replace the five databases in `database_dir` with generated data,
+        returns the number of rows written
+    """
+    rng = random.Random(seed)
+    # the showtimes and the bookings only need the movies to be known
+    movies_by_rank = ranked(rng, sizes.movies)
+    movie_weights = zipf_cum_weights(sizes.movies, MOVIE_POPULARITY_SKEW)
+    popularity = {movie: 1 / rank ** MOVIE_POPULARITY_SKEW
+                  for rank, movie in enumerate(movies_by_rank, 1)}
+    showtimes = schedule(rng, sizes, movies_by_rank, movie_weights)
+    showtime_weights = list(itertools.accumulate(
+        popularity[movie] for _, movie in showtimes))
+    users_by_rank = ranked(rng, sizes.users)
+    scores = [0] * (sizes.users + 1)
+
+    tables = (
+        ("movies", "movie", ("id", "title", "director", "rating"),
+         movie_rows(rng, sizes)),
+        ("users", "user", ("id", "name"), user_rows(rng, sizes)),
+        ("showtimes", "showtime", ("date", "movie"), iter(showtimes)),
+        ("bookings", "booking", ("user", "date", "movie", "rewarded"),
+         booking_rows(rng, sizes, showtimes, showtime_weights, users_by_rank,
+                      scores)),
+        # once the bookings are known, so are the scores
+        ("rewards", "reward", ("user", "score"),
+         ((user, scores[user]) for user in range(1, sizes.users + 1))),
+    )
+    written = 0
+    for name, table, columns, rows in tables:
+        create_database(database_dir, name, table)
+        written += load(database_dir, name, table, columns, rows)
+        finish_database(database_dir, name, table)
+
+    return written
+
+
+def database_path(database_dir, name):
+    return join(database_dir, f"{name}.db")
+
+
+def create_database(database_dir, name, table):
+    """ A new database of a service holding only the table to load, without
+        its indexes: they are cheaper to build once than row by row
+    """
+    path = database_path(database_dir, name)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    engine = create_engine(f"sqlite:///{path}")
+    engine.execute(CreateTable(SERVICE_DATABASES[name].metadata.tables[table]))
+    engine.dispose()
+
+
+def finish_database(database_dir, name, table):
+    """ Index the loaded table and add the other tables of the service, the
+        way the service creates them (e.g. along with their triggers)
+    """
+    metadata = SERVICE_DATABASES[name].metadata
+    engine = create_engine(f"sqlite:///{database_path(database_dir, name)}")
+    for index in metadata.tables[table].indexes:
+        index.create(bind=engine)
+    metadata.create_all(engine)
+    engine.dispose()
+
+
+def load(database_dir, name, table, columns, rows):
+    """ Insert the rows in a single transaction, INSERT_CHUNK_SIZE rows per
+        executemany call, returns how many were inserted
+    """
+    connection = sqlite3.connect(database_path(database_dir, name))
+    # a failed load leaves a database to generate again, not to recover
+    connection.execute("PRAGMA journal_mode = OFF")
+    connection.execute("PRAGMA synchronous = OFF")
+    statement = (f'INSERT INTO "{table}" ({", ".join(columns)}) '
+                 f'VALUES ({", ".join("?" * len(columns))})')
+
+    inserted = 0
+    with connection:
+        while True:
+            chunk = list(itertools.islice(rows, INSERT_CHUNK_SIZE))
+            if not chunk:
+                break
+            connection.executemany(statement, chunk)
+            inserted += len(chunk)
+    connection.close()
+    return inserted
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=float, default=DEFAULT_SCALE)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--users", type=int)
+    parser.add_argument("--movies", type=int)
+    parser.add_argument("--bookings", type=int)
+    parser.add_argument("--days", type=int)
+    parser.add_argument("--showtimes-per-day", type=int)
+    parser.add_argument("--database-dir", default=os.environ.get(
+        'CINEMA_DATABASE_DIR', DATABASE_DIR))
+    args = parser.parse_args()
+
+    sizes = Sizes(args.scale, args.users, args.movies, args.bookings,
+                  args.days, args.showtimes_per_day)
+    if min(sizes.users, sizes.movies, sizes.days) < 1 or sizes.bookings < 0:
+        parser.error(f"Nothing to book with {sizes}")
+
+    print(f"Generating {sizes} in {args.database_dir}")
+    start = time.perf_counter()
+    rows = generate(args.database_dir, sizes, args.seed)
+    seconds = time.perf_counter() - start
+    print(f"{rows} rows in {seconds:.1f}s, {rows / seconds:.0f} rows/s")
+
+
+if __name__ == "__main__":
+    main()
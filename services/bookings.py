@@ -1,7 +1,11 @@
+import fcntl
+import hashlib
 import requests
-from os.path import dirname, realpath
+import os
+import threading
+import time
 # microframework for webapps
-from flask import Flask, request, Response, abort
+from flask import Flask, request, Response, abort, stream_with_context, url_for
 # local data storage
 from flask_sqlalchemy import SQLAlchemy
 # data serialization
@@ -11,18 +15,52 @@ from http import HTTPStatus as http_status
 # reads and dumps json data
 import json
 # exception handling
-from werkzeug.exceptions import NotFound
-from datetime import date as datetime_date
+from werkzeug.exceptions import BadRequest, ServiceUnavailable, UnprocessableEntity
+from sqlalchemy.exc import IntegrityError
+from datetime import date as datetime_date, datetime, timedelta
+# shared helpers
+from services.request_args import int_arg, date_arg, flag_arg
+from services.streaming import keyset_batches, json_array_chunks, \
+    ndjson_response, wants_ndjson, STREAM_BATCH_SIZE
+from services.http_client import client
+from services.cache import LRUCache
+from services.bulk import ingest
+from services.serializers import FastEncoder
+from services.health import add_health_routes
+from services.instrumentation import instrument
+from services.tracing import enable_tracing, span
+from services.deadlines import enable_deadlines
+from services.database import database_uri, tune_sqlite
 
 # instantiate a flask app and give it a name
 app = Flask(__name__)
 
 # load the database
-root_dir = dirname(realpath(__file__ + '/..'))
-db_file = f"sqlite:///{root_dir}/database/bookings.db"
-app.config['SQLALCHEMY_DATABASE_URI'] = db_file
+app.config['SQLALCHEMY_DATABASE_URI'] = database_uri("bookings")
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+tune_sqlite(app)
 db = SQLAlchemy(app)
+add_health_routes(app, db)
+instrument(app)
+enable_tracing(app, "bookings")
+enable_deadlines(app)
+
+# page sizes for listing bookings
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# reward points are handed to the Rewards service by a background dispatcher
+OUTBOX_BATCH_SIZE = 100
+OUTBOX_POLL_INTERVAL = 1.0  # seconds to wait once the outbox is empty
+# client errors the Rewards service may answer differently later on
+RETRYABLE_CLIENT_ERRORS = (http_status.REQUEST_TIMEOUT,
+                           http_status.TOO_MANY_REQUESTS)
+# responses to POST /bookings/new are kept this long for clients retrying
+# with the same Idempotency-Key, the most recent in memory as well
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_TTL = 24 * 60 * 60  # seconds
+IDEMPOTENCY_CACHE_SIZE = 10000
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+IDEMPOTENCY_PURGE_INTERVAL = 60.0  # seconds between purges of expired keys
 
 
 class Booking(db.Model):
@@ -33,11 +71,78 @@ class Booking(db.Model):
     movie = db.Column(db.Integer, nullable=False)
     rewarded = db.Column(db.Boolean, nullable=False, default=False)
 
+    # lookups are per user or per movie, usually narrowed to a period of time;
+    # listings of a period alone read it in id order from the last index
+    __table_args__ = (
+        db.Index('ix_booking_user_date', 'user', 'date'),
+        db.Index('ix_booking_movie_date', 'movie', 'date'),
+        db.Index('ix_booking_date_id', 'date', 'id'),
+    )
+
     def __repr__(self):
         """ to simple represent an instance of a booking """
         return f"<Booking: user:{self.user} movie: {self.movie} @ {self.date}>"
 
 
+class RewardOutbox(db.Model):
+    """ Reward points waiting to be credited on the Rewards service.
+        A row is written in the same transaction as its booking and removed
+        once the Rewards service acknowledged the points.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    booking = db.Column(db.Integer, nullable=False)
+    user = db.Column(db.Integer, nullable=False)
+    points = db.Column(db.Integer, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<RewardOutbox: {self.points} points for booking {self.booking}>"
+
+
+class ParkedReward(db.Model):
+    """ Reward points the Rewards service refused, moved out of the outbox
+        so they do not hold up the points queued behind them. Left for an
+        operator to look into.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    booking = db.Column(db.Integer, nullable=False)
+    user = db.Column(db.Integer, nullable=False)
+    points = db.Column(db.Integer, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False)
+    # what the Rewards service answered
+    status = db.Column(db.Integer, nullable=False)
+    parked = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"<ParkedReward: {self.points} points for booking {self.booking}>"
+
+
+class PointsRejected(Exception):
+    """ The Rewards service refused reward points: sending them again
+        would not help
+    """
+
+    def __init__(self, status):
+        super().__init__(f"The Rewards service answered {status}.")
+        self.status = status
+
+
+class IdempotentResponse(db.Model):
+    """ The response a POST /bookings/new sent with an Idempotency-Key got.
+        Written in the same transaction as the booking, so a retry either
+        finds it or creates the booking itself.
+    """
+    key = db.Column(db.String(MAX_IDEMPOTENCY_KEY_LENGTH), primary_key=True)
+    # tells a retry from another request reusing the key
+    request_hash = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.Integer, nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    created = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<IdempotentResponse: {self.key}>"
+
+
 class BookingSchema(Schema):
     """ Defines how a Booking instance will be serialized"""
     class Meta:
@@ -59,6 +164,10 @@ class BookingSchema(Schema):
 # instantiate the schema serializer
 booking_schema = BookingSchema()
 bookings_schema = BookingSchema(many=True)
+booking_encoder = FastEncoder(booking_schema)
+# key -> (request hash, status, body) of the latest idempotent responses
+idempotency_cache = LRUCache(maxsize=IDEMPOTENCY_CACHE_SIZE,
+                             ttl=IDEMPOTENCY_TTL)
 
 # manuals for this service
 @app.route("/", methods=['GET'])
@@ -74,28 +183,75 @@ def hello():
 # add a route to GET bookings json
 @app.route("/bookings", methods=['GET'])
 def booking_list():
-    """ Return all booking instances """
-    bookings = Booking.query.all()
-    serialized_objects = bookings_schema.dumps(
-        bookings, sort_keys=True, indent=4)
+    """ Return booking instances ordered by id.
+        ?movie=<id>&from=<date>&to=<date> narrow the list down.
+        With ?after=<id>&limit=<n> a single page is returned and the next one
+        is linked in the Link header. Without them the whole table is streamed
+        in batches, so memory stays flat however big the table gets, as NDJSON
+        if the Accept header asks for it (from ?after= on, if given).
+        Output is compact unless ?pretty=1 is given.
+    """
+    pretty = flag_arg('pretty')
+    after = int_arg('after', minimum=0)
+    limit = int_arg('limit', minimum=1, maximum=MAX_PAGE_SIZE)
+    movie = int_arg('movie')
+    query = filter_by_date(Booking.query)
+    if movie is not None:
+        query = query.filter(Booking.movie == movie)
 
-    return Response(
-        response=serialized_objects,
+    if limit is None and wants_ndjson():
+        return ndjson_response(query, Booking.id, booking_encoder, after=after)
+
+    if after is None and limit is None:
+        batches = keyset_batches(query, Booking.id, STREAM_BATCH_SIZE)
+        return Response(
+            response=stream_with_context(
+                json_array_chunks(batches, booking_encoder, pretty)),
+            status=http_status.OK,
+            mimetype="application/json"
+        )
+
+    limit = limit or DEFAULT_PAGE_SIZE
+    page = next(keyset_batches(query, Booking.id, limit, after=after), [])
+    response = Response(
+        response=booking_encoder.dumps_many(page, pretty),
         status=http_status.OK,
         mimetype="application/json"
     )
+    if len(page) == limit:
+        next_url = url_for('booking_list', **dict(
+            request.args, after=page[-1].id, limit=limit))
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+
+    return response
+
+
+def filter_by_date(query):
+    """ Narrow a booking query to the ?from= and ?to= dates, both inclusive """
+    from_date = date_arg('from')
+    to_date = date_arg('to')
+    if from_date is not None:
+        query = query.filter(Booking.date >= from_date)
+    if to_date is not None:
+        query = query.filter(Booking.date <= to_date)
+
+    return query
+
 
 # route to GET bookings json from a specific user
 @app.route("/bookings/<user>", methods=['GET'])
 def booking_record(user):
-    """ Return all booking instances of a certain user """
-    user_bookings = Booking.query.filter_by(user=user).all()
+    """ Return all booking instances of a certain user,
+        optionally between the ?from= and ?to= dates
+    """
+    user_bookings = filter_by_date(
+        Booking.query.filter_by(user=user)).order_by(Booking.date).all()
 
     if not user_bookings:
         raise abort(404, description="Resource not found")
 
-    serialized_objects = bookings_schema.dumps(
-        user_bookings, sort_keys=True, indent=4)
+    serialized_objects = booking_encoder.dumps_many(
+        user_bookings, flag_arg('pretty'))
 
     return Response(
         response=serialized_objects,
@@ -106,7 +262,18 @@ def booking_record(user):
 # Route for adding a new booking
 @app.route("/bookings/new", methods=["POST"])
 def new_booking():
-    """ Make a new booking after a POST request """
+    """ Make a new booking after a POST request.
+        Requests sent with an Idempotency-Key header are answered once: a
+        retry with the same key and body gets the stored response back,
+        without booking, nor earning points, again.
+    """
+    key = idempotency_key()
+    request_hash = hashlib.sha256(request.get_data()).hexdigest()
+    if key is not None:
+        stored = stored_response(key, request_hash)
+        if stored is not None:
+            return stored
+
     # we may want to define a table in the db for this and other rewards
     points_ammount_for_new_booking = 1
     new_booking = ''
@@ -118,38 +285,241 @@ def new_booking():
         pass
         # TODO: send a exception  message
 
-    # save data:
+    # save the booking and the points it earns in a single transaction,
+    # the outbox dispatcher sends them to the Rewards service later on
     db.session.add(new_booking)
-    db.session.commit()
+    db.session.flush()  # assigns the booking id
+    db.session.add(RewardOutbox(booking=new_booking.id, user=new_booking.user,
+                                points=points_ammount_for_new_booking))
+    body = booking_schema.dumps(new_booking, sort_keys=True, indent=4)
+    if key is not None:
+        # an expired response the purge did not get to yet makes way
+        IdempotentResponse.query.filter(
+            IdempotentResponse.key == key,
+            IdempotentResponse.created < idempotency_cutoff()).delete(
+                synchronize_session='fetch')
+        db.session.add(IdempotentResponse(
+            key=key, request_hash=request_hash, status=http_status.OK,
+            body=body, created=datetime.utcnow()))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        if key is None:
+            raise
+        # a concurrent request with the same key booked first
+        db.session.rollback()
+        return stored_response(key, request_hash)
 
-    # send a reward point for this user
-    response_from_rewards_service = add_to_user_score(
-        new_booking.user, points_ammount_for_new_booking)
-    new_booking.rewarded = True if response_from_rewards_service == http_status.OK else False
+    if key is not None:
+        idempotency_cache.set(key, (request_hash, http_status.OK, body))
 
     return Response(
-        response=booking_schema.dumps(new_booking, sort_keys=True, indent=4),
+        response=body,
         status=http_status.OK,
         mimetype='application/json'
     )
 
 
-def add_to_user_score(user, points_to_be_added):
-    """ This sends a new point to a user's score on the Rewards service"""
-    post_score_url = "http://localhost:5004/rewards/add_score"
-    data = {"user": user, "add_to_score": points_to_be_added}
+def idempotency_key():
+    """ The Idempotency-Key of the request, None if it has none """
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if key is None:
+        return None
+    if not key or len(key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+        raise BadRequest(f"{IDEMPOTENCY_HEADER} must be 1 to "
+                         f"{MAX_IDEMPOTENCY_KEY_LENGTH} characters long.")
+    return key
+
+
+def stored_response(key, request_hash):
+    """ The response stored for an idempotency key, looked up in memory
+        before the database. None if the key is new or expired.
+    """
+    stored = idempotency_cache.get(key)
+    if stored is None:
+        record = IdempotentResponse.query.get(key)
+        if record is None:
+            return None
+        # cached no longer than the record lives, whose expiry is absolute
+        seconds_left = IDEMPOTENCY_TTL - (
+            datetime.utcnow() - record.created).total_seconds()
+        if seconds_left <= 0:
+            return None
+        stored = (record.request_hash, record.status, record.body)
+        idempotency_cache.set(key, stored, ttl=seconds_left)
+
+    stored_hash, status, body = stored
+    if stored_hash != request_hash:
+        raise UnprocessableEntity(
+            f"{IDEMPOTENCY_HEADER} {key} was used for another request.")
+    response = Response(
+        response=body,
+        status=status,
+        mimetype='application/json'
+    )
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotency_cutoff():
+    """ Responses stored before this date are expired """
+    return datetime.utcnow() - timedelta(seconds=IDEMPOTENCY_TTL)
+
+
+def purge_idempotency_keys():
+    """ Delete the expired idempotent responses, returns how many """
+    purged = IdempotentResponse.query.filter(
+        IdempotentResponse.created < idempotency_cutoff()).delete(
+            synchronize_session=False)
+    db.session.commit()
+    return purged
+
+
+# Route for adding many bookings at once
+@app.route("/bookings/bulk", methods=["POST"])
+def bulk_bookings():
+    """ POST many bookings as a JSON array or an NDJSON stream.
+        Bookings are imported as they are: no reward point is credited for
+        them, their `rewarded` flag is taken from the payload.
+    """
+    return ingest(db, Booking, booking_schema)
+
+
+def add_to_users_scores(points_by_user):
+    """ This sends new points to users' scores on the Rewards service.
+        Takes (id, user, points) triples and returns the set of users that
+        have no reward record there. The Rewards service applies an id once,
+        so points sent again after a lost reply are not credited twice.
+        Raises PointsRejected if they must not be sent again as they are.
+    """
+    post_scores_url = "http://localhost:5004/rewards/add_scores"
+    data = [{"id": delta_id, "user": user, "add_to_score": points}
+            for delta_id, user, points in points_by_user]
 
     try:
-        response = requests.post(post_score_url, json=data)
-    except requests.exceptions.ConnectionError:
+        response = client.post(post_scores_url, json=data)
+    except requests.exceptions.RequestException:
         raise ServiceUnavailable("The Rewards service is unavailable.")
 
-    if response.status_code == http_status.NOT_FOUND:
-        raise NotFound(f"No reward record were found for user {user}")
+    if 400 <= response.status_code < 500 and \
+            response.status_code not in RETRYABLE_CLIENT_ERRORS:
+        raise PointsRejected(response.status_code)
+    if response.status_code != http_status.OK:
+        raise ServiceUnavailable(
+            f"The Rewards service answered {response.status_code}.")
+
+    return set(response.json()["not_found"])
+
+
+def drain_outbox(batch_size=OUTBOX_BATCH_SIZE):
+    """ Send one batch of pending reward points to the Rewards service.
+        Acknowledged points flag their booking as rewarded and leave the
+        outbox; if the Rewards service is unavailable they all stay there
+        for the next round. Returns how many entries left the outbox.
+    """
+    pending = RewardOutbox.query.order_by(
+        RewardOutbox.id).limit(batch_size).all()
+    if not pending:
+        return 0
+
+    return dispatch_points(pending)
+
+
+def reward_delta_id(entry):
+    """ The id the Rewards service knows the points of an entry by """
+    return f"booking-{entry.booking}"
+
+
+def dispatch_points(pending):
+    """ Send outbox entries to the Rewards service. Entries it refuses are
+        sent again one by one, those it refuses alone are parked.
+        Returns how many entries left the outbox.
+    """
+    try:
+        with span("reward outbox dispatch"):
+            not_found = add_to_users_scores(
+                [(reward_delta_id(entry), entry.user, entry.points)
+                 for entry in pending])
+    except ServiceUnavailable:
+        for entry in pending:
+            entry.attempts += 1
+        db.session.commit()
+        return 0
+    except PointsRejected as rejected:
+        if len(pending) > 1:
+            # find out which of them were refused
+            return sum(dispatch_points([entry]) for entry in pending)
+        park(pending[0], rejected.status)
+        return 1
+
+    if not_found:
+        # these users have no reward record, retrying will not help
+        app.logger.warning(f"No reward record for users {sorted(not_found)}, "
+                           "their bookings are not rewarded")
+    rewarded = [entry.booking for entry in pending
+                if entry.user not in not_found]
+    Booking.query.filter(Booking.id.in_(rewarded)).update(
+        {"rewarded": True}, synchronize_session=False)
+    RewardOutbox.query.filter(RewardOutbox.id.in_(
+        [entry.id for entry in pending])).delete(synchronize_session=False)
+    db.session.commit()
+
+    return len(pending)
+
+
+def park(entry, status):
+    """ Move an outbox entry the Rewards service refused out of the way """
+    app.logger.warning(f"The Rewards service answered {status} to the points "
+                       f"of booking {entry.booking}, they are parked")
+    db.session.add(ParkedReward(
+        booking=entry.booking, user=entry.user, points=entry.points,
+        attempts=entry.attempts + 1, status=status, parked=datetime.utcnow()))
+    db.session.delete(entry)
+    db.session.commit()
+
+
+def run_outbox_dispatcher(poll_interval=OUTBOX_POLL_INTERVAL):
+    """ Drain the outbox forever, pausing whenever it runs out of work.
+        Expired idempotency keys are purged along the way.
+    """
+    next_purge = time.monotonic()
+    while True:
+        done = 0
+        with app.app_context():
+            try:
+                done = drain_outbox()
+                if time.monotonic() >= next_purge:
+                    purge_idempotency_keys()
+                    next_purge = time.monotonic() + IDEMPOTENCY_PURGE_INTERVAL
+            except Exception:
+                db.session.rollback()
+                app.logger.exception("Reward outbox dispatch failed")
+        if done < OUTBOX_BATCH_SIZE:
+            time.sleep(poll_interval)
+
+
+def start_outbox_dispatcher(lock_path=None):
+    """ Run the outbox dispatcher in a daemon thread of this process.
+        With `lock_path` the thread first waits for an exclusive lock on that
+        file: when the service runs several workers a single one dispatches,
+        and another takes over as soon as it exits.
+    """
+    def dispatch():
+        if lock_path is not None:
+            # held until this process exits, the system then releases it
+            lock_file = open(lock_path, 'a')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        run_outbox_dispatcher()
 
-    return response.status_code
+    dispatcher = threading.Thread(target=dispatch,
+                                  name="reward-outbox", daemon=True)
+    dispatcher.start()
+    return dispatcher
 
 
 # exeuted when this is called from the cmd
 if __name__ == "__main__":
+    # with the reloader on, only the process serving requests dispatches
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_outbox_dispatcher()
     app.run(port=5003, debug=True)
@@ -0,0 +1,129 @@
+""" Bulk ingestion behind the /<collection>/bulk routes of the services """
+import json
+from http import HTTPStatus as http_status
+from flask import request, Response
+from marshmallow import ValidationError
+from sqlalchemy.exc import IntegrityError
+# exception handling
+from werkzeug.exceptions import BadRequest
+from services.request_args import int_arg
+from services.streaming import NDJSON_MIMETYPE
+
+# rows inserted by a single executemany, overridable with ?chunk_size=
+DEFAULT_CHUNK_SIZE = 1000
+MAX_CHUNK_SIZE = 10000
+
+
+def ingest(db, model, schema, before_commit=None):
+    """ Insert the rows posted as a JSON array or as an NDJSON stream.
+        Every row is validated with `schema`; invalid rows are reported
+        without stopping the others from being inserted. `before_commit`,
+        if given, is called in every transaction inserting rows, right
+        before it commits.
+        response json has the following format:
+        {
+            "inserted": count: Int,
+            "errors": [{"row": row_number: Int, "errors": errors}, ...]
+        }
+    """
+    chunk_size = int_arg('chunk_size', default=DEFAULT_CHUNK_SIZE,
+                         minimum=1, maximum=MAX_CHUNK_SIZE)
+    inserted, errors = bulk_insert(db, model, schema, read_rows(), chunk_size,
+                                   before_commit)
+    errors.sort(key=lambda error: error["row"])
+
+    return Response(
+        response=json.dumps({"inserted": inserted, "errors": errors},
+                            sort_keys=True, indent=4),
+        status=http_status.OK,
+        mimetype='application/json'
+    )
+
+
+def read_rows():
+    """ Yield (row number, row) pairs from the request body. NDJSON bodies are
+        read line by line; a line that is not JSON yields a ValueError.
+    """
+    if request.mimetype == NDJSON_MIMETYPE:
+        for number, line in enumerate(request.stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield number, json.loads(line)
+            except ValueError as err:
+                yield number, err
+        return
+
+    rows = request.get_json(force=True, silent=True)
+    if not isinstance(rows, list):
+        raise BadRequest("Expected a JSON array or an NDJSON stream")
+    yield from enumerate(rows, start=1)
+
+
+def bulk_insert(db, model, schema, rows, chunk_size, before_commit=None):
+    """ Validate rows with `schema` and insert the valid ones `chunk_size`
+        at a time. Returns the number of inserted rows and the errors found.
+    """
+    inserted = 0
+    errors = []
+    chunk = []
+
+    for number, row in rows:
+        if isinstance(row, ValueError):
+            errors.append({"row": number, "errors": str(row)})
+            continue
+        try:
+            instance = schema.load(row)
+        except ValidationError as err:
+            errors.append({"row": number, "errors": err.messages})
+            continue
+
+        chunk.append((number, column_values(model, instance)))
+        if len(chunk) == chunk_size:
+            inserted += insert_chunk(db, model, chunk, errors, before_commit)
+            chunk = []
+
+    if chunk:
+        inserted += insert_chunk(db, model, chunk, errors, before_commit)
+
+    return inserted, errors
+
+
+def column_values(model, instance):
+    """ The values set on a model instance, keyed by column """
+    values = {}
+    for column in model.__table__.columns:
+        value = getattr(instance, column.key)
+        if value is not None:
+            values[column.key] = value
+
+    return values
+
+
+def insert_chunk(db, model, chunk, errors, before_commit=None):
+    """ Insert a chunk with executemany. If the database rejects it, the rows
+        are inserted one by one to tell the faulty ones apart.
+    """
+    def commit():
+        if before_commit is not None:
+            before_commit()
+        db.session.commit()
+
+    try:
+        db.session.bulk_insert_mappings(model, [values for _, values in chunk])
+        commit()
+        return len(chunk)
+    except IntegrityError:
+        db.session.rollback()
+
+    inserted = 0
+    for number, values in chunk:
+        try:
+            db.session.bulk_insert_mappings(model, [values])
+            commit()
+            inserted += 1
+        except IntegrityError as err:
+            db.session.rollback()
+            errors.append({"row": number, "errors": str(err.orig)})
+
+    return inserted
@@ -0,0 +1,81 @@
+""" Database helpers shared by the services """
+import os
+import sqlite3
+from os.path import dirname, join, realpath
+from sqlalchemy import inspect
+
+# where the service databases are, unless CINEMA_DATABASE_DIR says otherwise
+DATABASE_DIR = join(dirname(realpath(__file__ + '/..')), 'database')
+
+# pragmas set on every SQLite connection of the services. A service changes
+# them with the SQLITE_PRAGMAS setting of its app, None leaves one untouched
+SQLITE_PRAGMAS = {
+    # readers and the writer no longer block each other
+    'journal_mode': 'WAL',
+    # with WAL a power loss may drop the last commits, never corrupt the file
+    'synchronous': 'NORMAL',
+    # milliseconds to wait for a lock held by another worker
+    'busy_timeout': 5000,
+    # bytes of the file read through the memory map instead of read() calls
+    'mmap_size': 256 * 1024 * 1024,
+    # page cache of each connection, negative values are in KiB
+    'cache_size': -64 * 1024,
+}
+
+
+def database_uri(name):
+    """ SQLAlchemy URI of the SQLite database of a service """
+    directory = os.environ.get('CINEMA_DATABASE_DIR', DATABASE_DIR)
+    return f"sqlite:///{join(directory, name)}.db"
+
+
+def tune_sqlite(app):
+    """ Apply the SQLite pragmas to every connection the app opens.
+        The hook is part of the engine options, so it also holds for the
+        engines rebuilt after the database URI changed.
+    """
+    def apply_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        for name, value in sqlite_pragmas(app).items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+
+    engine_options = app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+    engine_options.setdefault('pool_events', []).append(
+        (apply_pragmas, 'connect'))
+
+
+def sqlite_pragmas(app):
+    """ The pragmas of an app: the defaults updated with its settings """
+    pragmas = dict(SQLITE_PRAGMAS, **app.config.get('SQLITE_PRAGMAS', {}))
+    return {name: value for name, value in pragmas.items()
+            if value is not None}
+
+
+def upgrade_schema(db):
+    """ Bring a database created by an older version of a service up to date:
+        create the tables it lacks and the indexes missing from existing ones.
+        Safe to run repeatedly.
+    """
+    db.create_all()
+    inspector = inspect(db.engine)
+
+    for table in db.metadata.sorted_tables:
+        existing_indexes = {index['name']
+                            for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(bind=db.engine)
+
+
+# SQLite refuses statements with more bound parameters than this
+# (the limit of versions older than 3.32, newer ones allow more)
+MAX_VARIABLES = 999
+
+
+def chunked(values, size=MAX_VARIABLES):
+    """ Split a list into slices small enough for an IN (...) clause """
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
@@ -0,0 +1,91 @@
+""" Time budgets handed down from a service to the services it calls.
+
+A caller sends the milliseconds it can still wait in the X-Request-Budget-Ms
+header. The callee answers 503 right away when that is too little to do any
+useful work, marked with the X-Budget-Exhausted header so callers do not take
+it for a failure of the callee, and passes what is left of it on to its own
+calls, whose timeouts never exceed it.
+"""
+import contextvars
+import math
+import time
+from flask import g, request
+# exception handling
+from werkzeug.exceptions import BadRequest, ServiceUnavailable
+
+BUDGET_HEADER = 'X-Request-Budget-Ms'
+# set on the 503 answered to callers out of time
+BUDGET_EXHAUSTED_HEADER = 'X-Budget-Exhausted'
+# callers left with less time than this are answered, or failed, right away
+MIN_BUDGET_MS = 10
+
+# time.monotonic() by which the request being served must be answered
+current_deadline = contextvars.ContextVar('current_deadline', default=None)
+
+
+class BudgetExhausted(ServiceUnavailable):
+    """ The caller left too little time to answer, through no fault of the
+        service
+    """
+
+    def get_headers(self, *args, **kwargs):
+        headers = super().get_headers(*args, **kwargs)
+        headers.append((BUDGET_EXHAUSTED_HEADER, "1"))
+        return headers
+
+
+def enable_deadlines(app):
+    """ Honour the budget of incoming requests. Requests coming without one
+        get app.config['REQUEST_BUDGET_MS'], if set.
+    """
+    @app.before_request
+    def start_deadline():
+        budget_ms = app.config.get('REQUEST_BUDGET_MS')
+        raw_budget = request.headers.get(BUDGET_HEADER)
+        if raw_budget is not None:
+            budget_ms = budget_arg(raw_budget)
+        if budget_ms is None:
+            return
+        if budget_ms < MIN_BUDGET_MS:
+            raise BudgetExhausted(
+                f"{budget_ms:.0f} ms left, too little to answer in time")
+        g.deadline_token = current_deadline.set(
+            time.monotonic() + budget_ms / 1000)
+
+    @app.teardown_request
+    def forget_deadline(exception):
+        token = g.pop('deadline_token', None)
+        if token is not None:
+            current_deadline.reset(token)
+
+
+def budget_arg(raw_budget):
+    """ The milliseconds of a budget header, answering 400 if it is not a
+        finite number: a NaN deadline would never expire, an infinite one
+        would turn the budget off
+    """
+    try:
+        budget_ms = float(raw_budget)
+    except ValueError:
+        budget_ms = math.nan
+    if not math.isfinite(budget_ms):
+        raise BadRequest(f"{BUDGET_HEADER} must be a number of milliseconds, "
+                         f"got '{raw_budget}'")
+    return budget_ms
+
+
+def remaining():
+    """ Seconds left to answer the current request, None without a deadline """
+    deadline = current_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def outbound_headers(headers, seconds_left):
+    """ The headers of an outgoing call, passing on the time left """
+    if seconds_left is None:
+        return headers
+    headers = dict(headers or {})
+    headers[BUDGET_HEADER] = str(int(seconds_left * 1000))
+    return headers
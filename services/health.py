@@ -0,0 +1,34 @@
+""" Liveness and readiness routes shared by the services """
+import json
+from http import HTTPStatus as http_status
+from flask import Response
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+
+def add_health_routes(app, db):
+    """ Register /health/live, answering as long as the process serves
+        requests, and /health/ready, answering 200 once the service database
+        can be queried and 503 otherwise
+    """
+    @app.route("/health/live", methods=['GET'])
+    def health_live():
+        return health_response("ok", http_status.OK)
+
+    @app.route("/health/ready", methods=['GET'])
+    def health_ready():
+        try:
+            db.session.execute(text("SELECT 1"))
+        except SQLAlchemyError:
+            db.session.rollback()
+            return health_response("database unavailable",
+                                   http_status.SERVICE_UNAVAILABLE)
+        return health_response("ok", http_status.OK)
+
+
+def health_response(status, http_code):
+    return Response(
+        response=json.dumps({"status": status}),
+        status=http_code,
+        mimetype="application/json"
+    )
@@ -0,0 +1,269 @@
+""" HTTP client the services share to call each other.
+
+A single keep-alive connection pool per process, connect and read timeouts on
+every call, bounded retries with jittered backoff for idempotent calls, a
+circuit breaker and running latency figures per destination service.
+"""
+import bisect
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+# http for humans
+import requests
+from requests.adapters import HTTPAdapter
+from services import deadlines, tracing
+
+# seconds to wait for a connection, then for the response
+CONNECT_TIMEOUT = 0.5
+READ_TIMEOUT = 2.0
+# extra attempts for idempotent calls and the base delay between them
+RETRIES = 2
+BACKOFF = 0.05
+# connections kept alive per destination
+POOL_SIZE = 20
+
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'))
+# statuses worth another attempt: the callee or a proxy in front of it is busy
+RETRY_STATUSES = frozenset((502, 503, 504))
+# consecutive failures opening the circuit of a destination
+FAILURE_THRESHOLD = 5
+# seconds an open circuit fails calls right away before letting one through
+RESET_TIMEOUT = 5.0
+# upper bounds, in seconds, of the buckets calls are counted in
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0)
+
+
+class CircuitOpen(requests.exceptions.RequestException):
+    """ Raised instead of calling a destination whose circuit is open """
+
+
+class DeadlineExceeded(requests.exceptions.RequestException):
+    """ Raised instead of calling once the request being served is out of
+        time, the caller gave up on it already
+    """
+
+
+class CircuitBreaker:
+    """ Stops calling a destination failing `failure_threshold` times in a
+        row. Once open, calls fail right away for `reset_timeout` seconds,
+        then a single trial call is let through (half-open): the circuit
+        closes if it succeeds and opens again if it fails. A trial never
+        reported back is given up after another `reset_timeout` seconds.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD,
+                 reset_timeout=RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """ Whether a call may be sent now """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            # opened_at is also when the trial call in flight started
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.opened_at = time.monotonic()
+                return True
+            # open, or half-open with the trial call in flight
+            return False
+
+    def record(self, failed):
+        with self._lock:
+            if not failed:
+                self.state = self.CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class LatencyStats:
+    """ Running latency figures for one destination """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        # calls per LATENCY_BUCKETS bucket, the last one counts slower calls
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, seconds, failed):
+        self.calls += 1
+        self.errors += failed
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.bucket_counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def as_dict(self):
+        mean = self.total_seconds / self.calls if self.calls else 0.0
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "mean_ms": round(mean * 1000, 3),
+            "max_ms": round(self.max_seconds * 1000, 3)
+        }
+
+
+class ServiceClient:
+    """ Pooled HTTP client with timeouts and retries """
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, retries=RETRIES,
+                 backoff=BACKOFF, pool_size=POOL_SIZE,
+                 failure_threshold=FAILURE_THRESHOLD,
+                 reset_timeout=RESET_TIMEOUT):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breakers = {}
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.latencies = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, timeout=None, retries=None,
+                idempotent=None, **kwargs):
+        """ Send a request, retrying idempotent ones on connection errors,
+            timeouts and busy statuses. Non idempotent requests (POST unless
+            told otherwise) are sent once. Raises requests' exceptions when
+            the last attempt fails, CircuitOpen without calling a destination
+            that keeps failing and DeadlineExceeded once the request being
+            served has no time left.
+        """
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        if retries is None:
+            retries = self.retries
+        attempts = 1 + retries if idempotent else 1
+        destination = urlsplit(url).netloc
+        breaker = self.breaker(destination)
+        # the callee answers on behalf of the same request
+        headers = tracing.outbound_headers(kwargs.pop('headers', None))
+
+        for attempt in range(attempts):
+            last_attempt = attempt == attempts - 1
+            seconds_left = deadlines.remaining()
+            if seconds_left is not None and \
+                    seconds_left * 1000 < deadlines.MIN_BUDGET_MS:
+                raise DeadlineExceeded(f"No time left to call {destination}")
+            if not breaker.allow():
+                raise CircuitOpen(f"The circuit to {destination} is open")
+
+            start = time.perf_counter()
+            try:
+                response = self.session.request(
+                    method, url,
+                    timeout=self.attempt_timeout(timeout, seconds_left),
+                    headers=deadlines.outbound_headers(headers, seconds_left),
+                    **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout):
+                seconds = time.perf_counter() - start
+                self.record(destination, seconds, True)
+                breaker.record(True)
+                tracing.record_call(method, url, None, seconds)
+                if last_attempt:
+                    raise
+            except Exception:
+                # anything else, e.g. a body cut short, still ends the call
+                # and must end a half-open trial
+                seconds = time.perf_counter() - start
+                self.record(destination, seconds, True)
+                breaker.record(True)
+                tracing.record_call(method, url, None, seconds)
+                raise
+            else:
+                seconds = time.perf_counter() - start
+                # the callee answered in time that the budget ran out, it
+                # is healthy and another attempt would have even less time
+                out_of_budget = deadlines.BUDGET_EXHAUSTED_HEADER in \
+                    response.headers
+                failed = response.status_code >= 500 and not out_of_budget
+                self.record(destination, seconds, failed)
+                breaker.record(failed)
+                tracing.record_call(method, url, response.status_code, seconds)
+                if last_attempt or out_of_budget or \
+                        response.status_code not in RETRY_STATUSES:
+                    return response
+
+            self.sleep_before_retry(attempt)
+
+    def attempt_timeout(self, timeout, seconds_left):
+        """ The timeouts of an attempt, cut down to the time left """
+        timeout = timeout or self.timeout
+        if seconds_left is None:
+            return timeout
+        if isinstance(timeout, tuple):
+            return tuple(min(part, seconds_left) for part in timeout)
+        return min(timeout, seconds_left)
+
+    def breaker(self, destination):
+        with self._lock:
+            breaker = self.breakers.get(destination)
+            if breaker is None:
+                breaker = self.breakers[destination] = CircuitBreaker(
+                    self.failure_threshold, self.reset_timeout)
+            return breaker
+
+    def sleep_before_retry(self, attempt):
+        """ Exponential backoff with full jitter, so retries from many
+            workers do not hit a recovering service all at once
+        """
+        time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def record(self, destination, seconds, failed):
+        with self._lock:
+            stats = self.latencies.get(destination)
+            if stats is None:
+                stats = self.latencies[destination] = LatencyStats()
+            stats.record(seconds, failed)
+
+    def latency_report(self):
+        """ Latency figures per destination as a dict """
+        with self._lock:
+            return {destination: stats.as_dict()
+                    for destination, stats in self.latencies.items()}
+
+    def circuit_report(self):
+        """ The state of the circuit of each destination """
+        with self._lock:
+            return {destination: breaker.state
+                    for destination, breaker in self.breakers.items()}
+
+    def latency_histograms(self):
+        """ (bucket counts, total seconds, calls, errors) per destination """
+        with self._lock:
+            return {destination: (list(stats.bucket_counts),
+                                  stats.total_seconds, stats.calls,
+                                  stats.errors)
+                    for destination, stats in self.latencies.items()}
+
+
+# the client shared by all the calls made from this process
+client = ServiceClient()
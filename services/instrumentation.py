@@ -0,0 +1,212 @@
+""" Prometheus metrics of a service, served at /metrics.
+
+Request durations, status counts and requests in flight per route, the SQL
+queries each request runs and the calls made to the other services. Every
+worker process keeps its own figures, those of the worker answering the
+scrape are returned.
+"""
+import bisect
+import threading
+import time
+from http import HTTPStatus as http_status
+from flask import Response, current_app, g, has_app_context, \
+    has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from services.http_client import client, LATENCY_BUCKETS
+
+# upper bounds of the buckets counting the queries run by a request
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# requests that matched no route share this label, keeping series bounded
+UNMATCHED_ROUTE = "unmatched"
+
+
+class Histogram:
+    """ Bucket counts, sum and count of the values observed per labels.
+        Not thread-safe, the caller holds the lock of its Metrics.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+
+class Metrics:
+    """ The figures of one app """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (method, route, status) -> requests
+        self.responses = {}
+        # (method, route) -> requests being served
+        self.in_flight = {}
+        self.durations = Histogram(LATENCY_BUCKETS)
+        # per route: queries run, and seconds spent in them, by a request
+        self.request_queries = Histogram(QUERY_COUNT_BUCKETS)
+        self.request_query_seconds = Histogram(LATENCY_BUCKETS)
+        # every query, those run outside of requests included
+        self.queries = 0
+        self.query_seconds = 0.0
+
+
+def instrument(app):
+    """ Collect the metrics of an app and serve them at /metrics """
+    metrics = app.extensions['metrics'] = Metrics()
+
+    @app.before_request
+    def start_request_metrics():
+        rule = request.url_rule
+        g.metrics_labels = (request.method,
+                            rule.rule if rule else UNMATCHED_ROUTE)
+        g.sql_queries = 0
+        g.sql_seconds = 0.0
+        with metrics.lock:
+            metrics.in_flight[g.metrics_labels] = \
+                metrics.in_flight.get(g.metrics_labels, 0) + 1
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request_metrics(response):
+        if 'metrics_start' not in g:
+            return response
+        seconds = time.perf_counter() - g.metrics_start
+        method, route = g.metrics_labels
+        status = (method, route, str(response.status_code))
+        with metrics.lock:
+            metrics.responses[status] = metrics.responses.get(status, 0) + 1
+            metrics.durations.observe(g.metrics_labels, seconds)
+            metrics.request_queries.observe((route,), g.sql_queries)
+            metrics.request_query_seconds.observe((route,), g.sql_seconds)
+        return response
+
+    @app.teardown_request
+    def end_request_metrics(exception):
+        labels = g.pop('metrics_labels', None)
+        if labels is not None:
+            with metrics.lock:
+                metrics.in_flight[labels] -= 1
+
+    @app.route("/metrics", methods=['GET'])
+    def metrics_endpoint():
+        return Response(
+            response=render(metrics),
+            status=http_status.OK,
+            content_type=PROMETHEUS_CONTENT_TYPE
+        )
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_query_timer(conn, cursor, statement, parameters, context,
+                      executemany):
+    context.metrics_start = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    """ Count the query for the request running it and for its app """
+    if not has_app_context():
+        return
+    metrics = current_app.extensions.get('metrics')
+    if metrics is None:
+        return
+
+    seconds = time.perf_counter() - context.metrics_start
+    if has_request_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+        g.sql_seconds += seconds
+    with metrics.lock:
+        metrics.queries += 1
+        metrics.query_seconds += seconds
+
+
+def render(metrics):
+    """ The metrics in the Prometheus text format """
+    lines = []
+    with metrics.lock:
+        write_samples(lines, "http_requests_total", "counter",
+                      "Requests answered, by status",
+                      ("method", "route", "status"), metrics.responses)
+        write_samples(lines, "http_requests_in_flight", "gauge",
+                      "Requests being served", ("method", "route"),
+                      metrics.in_flight)
+        write_histogram(lines, "http_request_duration_seconds",
+                        "Time to answer a request", ("method", "route"),
+                        metrics.durations)
+        write_histogram(lines, "sql_queries_per_request",
+                        "SQL queries run by a request", ("route",),
+                        metrics.request_queries)
+        write_histogram(lines, "sql_seconds_per_request",
+                        "Time a request spent in SQL queries", ("route",),
+                        metrics.request_query_seconds)
+        write_samples(lines, "sql_queries_total", "counter",
+                      "SQL queries run", (), {(): metrics.queries})
+        write_samples(lines, "sql_query_seconds_total", "counter",
+                      "Time spent in SQL queries", (),
+                      {(): metrics.query_seconds})
+
+    outbound = Histogram(LATENCY_BUCKETS)
+    outbound_errors = {}
+    for destination, (bucket_counts, seconds, calls, errors) in \
+            client.latency_histograms().items():
+        outbound.series[(destination,)] = [bucket_counts, seconds, calls]
+        outbound_errors[(destination,)] = errors
+    write_histogram(lines, "http_client_request_duration_seconds",
+                    "Time of the calls made to other services",
+                    ("destination",), outbound)
+    write_samples(lines, "http_client_errors_total", "counter",
+                  "Calls to other services that failed", ("destination",),
+                  outbound_errors)
+    write_samples(lines, "http_client_circuit_open", "gauge",
+                  "Whether calls to another service fail right away",
+                  ("destination",),
+                  {(destination,): int(state != "closed")
+                   for destination, state in client.circuit_report().items()})
+
+    return "\n".join(lines) + "\n"
+
+
+def write_samples(lines, name, kind, description, label_names, samples):
+    lines.append(f"# HELP {name} {description}")
+    lines.append(f"# TYPE {name} {kind}")
+    for label_values, value in sorted(samples.items()):
+        lines.append(f"{name}{format_labels(label_names, label_values)} {value}")
+
+
+def write_histogram(lines, name, description, label_names, histogram):
+    lines.append(f"# HELP {name} {description}")
+    lines.append(f"# TYPE {name} histogram")
+    bounds = [str(bound) for bound in histogram.buckets] + ["+Inf"]
+    for label_values, (bucket_counts, total, count) in \
+            sorted(histogram.series.items()):
+        cumulative = 0
+        for bound, bucket_count in zip(bounds, bucket_counts):
+            cumulative += bucket_count
+            labels = format_labels(label_names + ("le",),
+                                   label_values + (bound,))
+            lines.append(f"{name}_bucket{labels} {cumulative}")
+        labels = format_labels(label_names, label_values)
+        lines.append(f"{name}_sum{labels} {total}")
+        lines.append(f"{name}_count{labels} {count}")
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{escape(value)}"'
+                     for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def escape(value):
+    return str(value).replace("\\", r"\\").replace('"', r'\"') \
+        .replace("\n", r"\n")
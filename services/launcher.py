@@ -0,0 +1,156 @@
+""" Run the services under gunicorn, a prefork WSGI server.
+
+    python -m services.launcher serve bookings --workers 4 --threads 8
+    python -m services.launcher wait users movies showtimes bookings rewards
+
+`serve` starts a master process forking the workers of one service and
+restarting any worker that dies. The master writes its pid to
+run/<service>.pid and answers these signals:
+
+    HUP         reload the code and replace the workers gracefully
+    TERM        stop gracefully, letting the requests in flight finish
+    INT, QUIT   stop right away
+    TTIN, TTOU  add or remove a worker
+
+`wait` returns once the services answer their readiness check, or fails
+after a timeout.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from importlib import import_module
+from os.path import dirname, join, realpath
+# http for humans
+import requests
+# prefork WSGI server
+from gunicorn.app.base import BaseApplication
+
+# port of each service
+SERVICES = {
+    "users": 5000,
+    "movies": 5001,
+    "showtimes": 5002,
+    "bookings": 5003,
+    "rewards": 5004,
+}
+# pid files, logs and locks of the running services
+RUN_DIR = join(dirname(realpath(__file__ + '/..')), "run")
+# seconds the workers have to finish their requests on reload and shutdown
+GRACEFUL_TIMEOUT = 30
+# seconds `wait` gives the services to become ready
+READY_TIMEOUT = 30.0
+READY_POLL_INTERVAL = 0.2
+
+
+def start_reward_dispatcher(worker):
+    """ Every bookings worker runs a dispatcher thread, one of them at a
+        time gets the outbox lock and dispatches
+    """
+    bookings = import_module("services.bookings")
+    bookings.start_outbox_dispatcher(join(RUN_DIR, "bookings-outbox.lock"))
+
+
+# run in each worker once it loaded its service
+WORKER_HOOKS = {
+    "bookings": start_reward_dispatcher,
+}
+
+
+class ServiceApplication(BaseApplication):
+    """ A gunicorn application serving the Flask app of a service """
+
+    def __init__(self, service, options):
+        self.service = service
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for name, value in self.options.items():
+            self.cfg.set(name, value)
+
+    def load(self):
+        return import_module(f"services.{self.service}").app
+
+
+def serve(service, host, workers, threads, daemon, trace=False):
+    """ Run a service until the master process is told to stop """
+    os.makedirs(RUN_DIR, exist_ok=True)
+    if trace:
+        # the workers inherit it and trace their requests there
+        os.environ.setdefault("CINEMA_TRACE_DIR", join(RUN_DIR, "traces"))
+    options = {
+        "bind": f"{host}:{SERVICES[service]}",
+        "workers": workers,
+        "threads": threads,
+        "graceful_timeout": GRACEFUL_TIMEOUT,
+        "pidfile": join(RUN_DIR, f"{service}.pid"),
+        "proc_name": f"cinema-{service}",
+        "daemon": daemon,
+    }
+    if daemon:
+        options["errorlog"] = join(RUN_DIR, f"{service}.log")
+    if service in WORKER_HOOKS:
+        options["post_worker_init"] = WORKER_HOOKS[service]
+
+    ServiceApplication(service, options).run()
+
+
+def wait_until_ready(services, host, timeout=READY_TIMEOUT):
+    """ True once every service answered its readiness check in time """
+    deadline = time.monotonic() + timeout
+    pending = list(services)
+    while pending:
+        service = pending[0]
+        url = f"http://{host}:{SERVICES[service]}/health/ready"
+        try:
+            ready = requests.get(url, timeout=1).status_code == 200
+        except requests.exceptions.RequestException:
+            ready = False
+
+        if ready:
+            pending.pop(0)
+        elif time.monotonic() > deadline:
+            print(f"{', '.join(pending)} not ready after {timeout}s",
+                  file=sys.stderr)
+            return False
+        else:
+            time.sleep(READY_POLL_INTERVAL)
+
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_command = commands.add_parser("serve", help="run a service")
+    serve_command.add_argument("service", choices=SERVICES)
+    serve_command.add_argument("--workers", type=int,
+                               default=multiprocessing.cpu_count())
+    serve_command.add_argument("--threads", type=int, default=4,
+                               help="threads serving requests in each worker")
+    serve_command.add_argument("--daemon", action="store_true",
+                               help="detach from the terminal")
+    serve_command.add_argument("--trace", action="store_true",
+                               help="write the spans of the requests to "
+                                    "run/traces")
+
+    wait_command = commands.add_parser("wait",
+                                       help="wait for services to be ready")
+    wait_command.add_argument("services", nargs="+", choices=SERVICES)
+    wait_command.add_argument("--timeout", type=float, default=READY_TIMEOUT)
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        serve(args.service, args.host, args.workers, args.threads, args.daemon,
+              args.trace)
+    elif not wait_until_ready(args.services, args.host, args.timeout):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
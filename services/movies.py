@@ -1,4 +1,4 @@
-from os.path import dirname, realpath
+import time
 # microframework for webapps
 from flask import Flask, request, Response
 # local data storage
@@ -10,17 +10,44 @@ from http import HTTPStatus as http_status
 # read and dump as json data
 import json
 # exception handling
-from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import BadRequest, NotFound
+# sql statements
+from sqlalchemy import text
+# shared helpers
+from services.streaming import ndjson_response, wants_ndjson
+from services.bulk import ingest
+from services.cache import LRUCache
+from services.database import chunked, database_uri, tune_sqlite
+from services.health import add_health_routes
+from services.instrumentation import instrument
+from services.tracing import enable_tracing
+from services.deadlines import enable_deadlines
+from services.request_args import flag_arg, int_list_arg
+from services.serializers import FastEncoder, encode
 
 # instantiate a flask app and give it a name
 app = Flask(__name__)
 
 # load the database
-root_dir = dirname(realpath(__file__ + '/..'))
-db_file = f"sqlite:///{root_dir}/database/movies.db"
-app.config['SQLALCHEMY_DATABASE_URI'] = db_file
+app.config['SQLALCHEMY_DATABASE_URI'] = database_uri("movies")
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+tune_sqlite(app)
 db = SQLAlchemy(app)
+add_health_routes(app, db)
+instrument(app)
+enable_tracing(app, "movies")
+enable_deadlines(app)
+
+# seconds a worker trusts its copy of the catalog version before reading it
+# again, which bounds how late it notices changes made through other workers
+CATALOG_VERSION_MAX_AGE = 1.0
+# seconds clients may reuse a catalog response without revalidating it
+CATALOG_MAX_AGE = 0
+# serialized movies and movie lists kept by each worker
+MOVIE_CACHE_SIZE = 10000
+MOVIE_CACHE_TTL = 300.0
+# ids a single lookup may ask for
+MAX_LOOKUP_IDS = 10000
 
 
 class Movie(db.Model):
@@ -34,6 +61,15 @@ class Movie(db.Model):
         return f"<Movie: {self.title}>"
 
 
+class CatalogVersion(db.Model):
+    """ A single row counting the changes made to the movie catalog """
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<CatalogVersion: {self.version}>"
+
+
 class MovieSchema(Schema):
     """ Defines how a Movie instance will be serialized"""
     class Meta:
@@ -54,6 +90,11 @@ class MovieSchema(Schema):
 # instantiate the schema serializer
 movie_schema = MovieSchema()
 movies_schema = MovieSchema(many=True)
+movie_encoder = FastEncoder(movie_schema)
+
+# serialized responses, and movies dumped for lookups, keyed by catalog
+# version so any change makes them stale
+movie_cache = LRUCache(maxsize=MOVIE_CACHE_SIZE, ttl=MOVIE_CACHE_TTL)
 
 # instructions if you hit '/'
 @app.route("/", methods=['GET'])
@@ -62,37 +103,205 @@ def hello():
         "uri": "/",
         "subresource_uris": {
             "movies": "/movies",
-            "movie": "/movies/<id>"
+            "movie": "/movies/<id>",
+            "lookup": "/movies?ids=<id>,<id>",
+            "cache": "/cache"
         }
     })
 
 
+# this worker's copy of the catalog version
+catalog = {"version": None, "read_at": 0.0}
+
+
+def catalog_version():
+    """ The current catalog version, read from the database at most once
+        every CATALOG_VERSION_MAX_AGE seconds
+    """
+    now = time.monotonic()
+    if catalog["version"] is None or \
+            now - catalog["read_at"] > CATALOG_VERSION_MAX_AGE:
+        row = CatalogVersion.query.get(1)
+        catalog["version"] = row.version if row else 0
+        catalog["read_at"] = now
+
+    return catalog["version"]
+
+
+def bump_catalog_version():
+    """ Bump the catalog version within the current transaction """
+    db.session.execute(text(
+        "INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0)"))
+    db.session.execute(text(
+        "UPDATE catalog_version SET version = version + 1 WHERE id = 1"))
+
+
+def forget_catalog():
+    """ Have this worker read the new version on next use """
+    catalog["version"] = None
+    movie_cache.clear()
+
+
+def commit_catalog_change():
+    """ Commit the current transaction, bumping the catalog version in it """
+    bump_catalog_version()
+    db.session.commit()
+    forget_catalog()
+
+
+def catalog_etag(version, pretty):
+    """ Strong ETag of a catalog response, the same for every URL as ETags
+        only need to tell apart the representations of a single one
+    """
+    etag = f"catalog-v{version}"
+    return f"{etag}-pretty" if pretty else etag
+
+
+def catalog_response(serialized_objects, etag, status=http_status.OK):
+    response = Response(
+        response=serialized_objects,
+        status=status,
+        mimetype="application/json"
+    )
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = CATALOG_MAX_AGE
+    response.cache_control.must_revalidate = True
+    # /movies answers NDJSON to the same URL, shared caches tell them apart
+    response.vary.add('Accept')
+    return response
+
+
 # route to get a movie by its id
 @app.route("/movies/<id>", methods=['GET'])
 def movie_info(id):
-    """ GET a movie by id"""
-    movie = Movie.query.get(id)
+    """ GET a movie by id.
+        Answers 304 Not Modified when the If-None-Match header holds the
+        ETag of the current catalog and the movie exists, without touching
+        the database if the movie is cached.
+        Cached movies are served without the ORM nor the serializer.
+    """
+    pretty = flag_arg('pretty')
+    version = catalog_version()
+    etag = catalog_etag(version, pretty)
+    if request.if_none_match.contains_weak(etag) and movie_exists(version, id):
+        return catalog_response(None, etag, http_status.NOT_MODIFIED)
+
+    cache_key = (version, id, pretty)
+    serialized_object = movie_cache.get(cache_key)
+    if serialized_object is None:
+        movie = Movie.query.get(id)
+
+        if not movie:
+            raise NotFound
 
-    if not movie:
-        raise NotFound
+        serialized_object = movie_encoder.dumps(movie, pretty)
+        movie_cache.set(cache_key, serialized_object)
 
-    serialized_object = movie_schema.dumps(movie, sort_keys=True, indent=4)
+    return catalog_response(serialized_object, etag)
+
+
+def movie_exists(version, id):
+    """ Whether a movie is in the catalog, looking in the cache first
+        without counting it as a hit or a miss
+    """
+    if any((version, id, pretty) in movie_cache for pretty in (False, True)):
+        return True
+    return db.session.query(Movie.id).filter(Movie.id == id).first() \
+        is not None
+
+
+# add a route to GET all movies
+@app.route("/movies", methods=['GET'])
+def movie_list():
+    """ Return all Movie instances, or only those listed in ?ids=1,2,3.
+        Answers 304 Not Modified, without touching the database, when the
+        If-None-Match header holds the ETag of the current catalog.
+        The whole catalog is streamed as NDJSON if the Accept header asks
+        for it.
+    """
+    if wants_ndjson() and 'ids' not in request.args:
+        response = ndjson_response(Movie.query, Movie.id, movie_encoder)
+        response.vary.add('Accept')
+        return response
+
+    pretty = flag_arg('pretty')
+    version = catalog_version()
+    etag = catalog_etag(version, pretty)
+    if request.if_none_match.contains_weak(etag):
+        return catalog_response(None, etag, http_status.NOT_MODIFIED)
+
+    ids = int_list_arg('ids')
+    if ids is not None:
+        return catalog_response(lookup_movies(ids, version, pretty), etag)
+
+    cache_key = (version, None, pretty)
+    serialized_objects = movie_cache.get(cache_key)
+    if serialized_objects is None:
+        movies = Movie.query.all()
+        serialized_objects = movie_encoder.dumps_many(movies, pretty)
+        movie_cache.set(cache_key, serialized_objects)
+
+    return catalog_response(serialized_objects, etag)
+
+
+# route to look up a list of movies too long for the query string
+@app.route("/movies/lookup", methods=['POST'])
+def movie_lookup():
+    """ POST {"ids": [id, ...]} and get the movies as GET /movies?ids= does """
+    body = request.get_json(force=True, silent=True)
+    ids = body.get("ids") if isinstance(body, dict) else None
+    if not isinstance(ids, list) or \
+            not all(type(movie_id) is int for movie_id in ids):
+        raise BadRequest('Expected {"ids": [id, ...]}')
 
     return Response(
-        response=serialized_object,
+        response=lookup_movies(ids, catalog_version(), flag_arg('pretty')),
         status=http_status.OK,
         mimetype="application/json"
     )
 
-# add a route to GET all movies
-@app.route("/movies", methods=['GET'])
-def movie_list():
-    """ Return all Movie instances """
-    movies = Movie.query.all()
-    serialized_objects = movies_schema.dumps(movies, sort_keys=True, indent=4)
 
+def lookup_movies(ids, version, pretty):
+    """ Movies by id, in the order asked, with a single IN (...) query for
+        those not cached yet (one per MAX_VARIABLES ids).
+        response json has the following format:
+        {
+            "movies": [movie, ...],
+            "not_found": [id: Int, ...]
+        }
+    """
+    # a repeated id is answered once, where it first appears
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > MAX_LOOKUP_IDS:
+        raise BadRequest(f"At most {MAX_LOOKUP_IDS} ids can be looked up at once")
+
+    found = {}
+    uncached = []
+    for movie_id in ids:
+        movie = movie_cache.get((version, movie_id))
+        if movie is None:
+            uncached.append(movie_id)
+        else:
+            found[movie_id] = movie
+
+    for chunk in chunked(uncached):
+        for movie in Movie.query.filter(Movie.id.in_(chunk)):
+            found[movie.id] = movie_encoder.dump(movie)
+            movie_cache.set((version, movie.id), found[movie.id])
+
+    return encode({
+        "movies": [found[movie_id] for movie_id in ids if movie_id in found],
+        "not_found": [movie_id for movie_id in ids if movie_id not in found]
+    }, pretty)
+
+
+# route to GET the figures of the movie cache of this worker
+@app.route("/cache", methods=['GET'])
+def cache_stats():
+    """ Return the hit and miss counters of the movie cache """
     return Response(
-        response=serialized_objects,
+        response=json.dumps(movie_cache.stats(), sort_keys=True, indent=4),
         status=http_status.OK,
         mimetype="application/json"
     )
@@ -109,7 +318,7 @@ def new_movie():
         # TODO: send a exception  message
     # save data:
     db.session.add(new_movie)
-    db.session.commit()
+    commit_catalog_change()
 
     return Response(
         response=movie_schema.dumps(new_movie, sort_keys=True, indent=4),
@@ -118,6 +327,19 @@ def new_movie():
     )
 
 
+# Route for adding many movies at once
+@app.route("/movies/bulk", methods=["POST"])
+def bulk_movies():
+    """ POST many movies as a JSON array or an NDJSON stream.
+        Every transaction inserting movies bumps the catalog version too.
+    """
+    try:
+        return ingest(db, Movie, movie_schema,
+                      before_commit=bump_catalog_version)
+    finally:
+        forget_catalog()
+
+
 # exeuted when this is called from the cmd
 if __name__ == "__main__":
     app.run(port=5001, debug=True)
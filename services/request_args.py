@@ -0,0 +1,55 @@
+""" Helpers to read and validate query string arguments shared by the services """
+from datetime import date as datetime_date
+from flask import request
+# exception handling
+from werkzeug.exceptions import BadRequest
+
+
+def int_arg(name, default=None, minimum=None, maximum=None):
+    """ Read an integer query argument, answering 400 if it is malformed.
+        Values above `maximum` are clamped, values below `minimum` rejected.
+    """
+    raw_value = request.args.get(name)
+    if raw_value is None or raw_value == '':
+        return default
+
+    try:
+        value = int(raw_value)
+    except ValueError:
+        raise BadRequest(f"'{name}' must be an integer, got '{raw_value}'")
+
+    if minimum is not None and value < minimum:
+        raise BadRequest(f"'{name}' must be at least {minimum}")
+    if maximum is not None:
+        value = min(value, maximum)
+
+    return value
+
+
+def flag_arg(name):
+    """ Read a boolean query argument such as ?stream=1 or ?stream=true """
+    return request.args.get(name, '').lower() in ('1', 'true', 'yes')
+
+
+def date_arg(name):
+    """ Read a YYYY-MM-DD query argument as a datetime.date """
+    raw_value = request.args.get(name)
+    if raw_value is None or raw_value == '':
+        return None
+
+    try:
+        return datetime_date.fromisoformat(raw_value)
+    except ValueError:
+        raise BadRequest(f"'{name}' must be a YYYY-MM-DD date, got '{raw_value}'")
+
+
+def int_list_arg(name):
+    """ Read a comma separated list of integers such as ?ids=1,2,3 """
+    raw_value = request.args.get(name)
+    if raw_value is None or raw_value == '':
+        return None
+
+    try:
+        return [int(value) for value in raw_value.split(',') if value.strip()]
+    except ValueError:
+        raise BadRequest(f"'{name}' must be a list of integers, got '{raw_value}'")
@@ -1,27 +1,67 @@
-from os.path import dirname, realpath
+import sqlite3
 # to return HTTP status to incoming requests
 from http import HTTPStatus as http_status
 # microframework for webapps
-from flask import Flask, request, Response
+from flask import Flask, request, Response, url_for
 # local data storage
 from flask_sqlalchemy import SQLAlchemy
 # data serialization
-from marshmallow import Schema, fields, post_load
+from marshmallow import Schema, fields, post_load, validate, ValidationError
 
 # read and dump as json data
 import json
 # exception handling
-from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import NotFound, BadRequest, ServiceUnavailable
+# sql expressions for set-based updates
+from sqlalchemy import DDL, bindparam, event, func, text
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, time, timedelta
+# shared helpers
+from services.streaming import ndjson_response, wants_ndjson
+from services.database import chunked, database_uri, tune_sqlite
+from services.health import add_health_routes
+from services.instrumentation import instrument
+from services.tracing import enable_tracing
+from services.deadlines import enable_deadlines
+from services.cache import LRUCache
+from services.request_args import date_arg, flag_arg, int_arg, \
+    int_list_arg
+from services.serializers import FastEncoder, encode
 
 # instantiate a flask app and give it a name
 app = Flask(__name__)
 
 # load the database
-root_dir = dirname(realpath(__file__ + '/..'))
-db_file = f"sqlite:///{root_dir}/database/rewards.db"
-app.config['SQLALCHEMY_DATABASE_URI'] = db_file
+app.config['SQLALCHEMY_DATABASE_URI'] = database_uri("rewards")
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# score increments queue up behind each other, let them wait longer
+app.config['SQLITE_PRAGMAS'] = {'busy_timeout': 10000}
+tune_sqlite(app)
 db = SQLAlchemy(app)
+add_health_routes(app, db)
+instrument(app)
+enable_tracing(app, "rewards")
+enable_deadlines(app)
+
+# UPDATE ... RETURNING appeared in SQLite 3.35
+SUPPORTS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+# users listed by /rewards/top
+DEFAULT_TOP_SIZE = 100
+MAX_TOP_SIZE = 1000
+# the prize tier of a new database
+DEFAULT_PRIZE_POINTS = 5
+# seconds the prize tiers are cached for, changes show up after that
+PRIZE_TIERS_TTL = 60.0
+# users a single /rewards/prizes call may ask for
+MAX_PRIZE_USERS = 10000
+# pages of /rewards/prizes/eligible
+DEFAULT_EVENTS_PAGE_SIZE = 1000
+MAX_EVENTS_PAGE_SIZE = 10000
+# ids of the applied deltas are kept this long, a delta sent again later on
+# is applied again
+APPLIED_DELTA_TTL = 30 * 24 * 60 * 60  # seconds
+APPLIED_DELTA_PURGE_INTERVAL = 60 * 60  # seconds between purges
+MAX_DELTA_ID_LENGTH = 255
 
 
 class Reward(db.Model):
@@ -33,6 +73,42 @@ class Reward(db.Model):
         return f"<Reward: {self.user} has {self.score} points>"
 
 
+# the leaderboard reads the users in this order straight from the index,
+# ties going to the lowest user id
+db.Index('ix_reward_score_user', Reward.score.desc(), Reward.user)
+
+
+class ScoreCount(db.Model):
+    """ How many users have each score, kept up to date by triggers on the
+        reward table whatever writes to it. Ranking a user adds up the few
+        scores above theirs instead of counting every user ahead.
+    """
+    score = db.Column(db.Integer, primary_key=True)
+    users = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f"<ScoreCount: {self.users} users have {self.score} points>"
+
+
+# created with the score_count table, which counts the existing rewards
+SCORE_COUNT_DDL = (
+    "INSERT INTO score_count (score, users) "
+    "SELECT score, count(*) FROM reward GROUP BY score",
+    "CREATE TRIGGER score_count_insert AFTER INSERT ON reward BEGIN "
+    "INSERT INTO score_count (score, users) VALUES (NEW.score, 1) "
+    "ON CONFLICT (score) DO UPDATE SET users = users + 1; END",
+    "CREATE TRIGGER score_count_update AFTER UPDATE OF score ON reward "
+    "WHEN NEW.score != OLD.score BEGIN "
+    "UPDATE score_count SET users = users - 1 WHERE score = OLD.score; "
+    "INSERT INTO score_count (score, users) VALUES (NEW.score, 1) "
+    "ON CONFLICT (score) DO UPDATE SET users = users + 1; END",
+    "CREATE TRIGGER score_count_delete AFTER DELETE ON reward BEGIN "
+    "UPDATE score_count SET users = users - 1 WHERE score = OLD.score; END",
+)
+for statement in SCORE_COUNT_DDL:
+    event.listen(ScoreCount.__table__, 'after_create', DDL(statement))
+
+
 class RewardSchema(Schema):
     """ Defines how a Reward instance will be serialized"""
     user = fields.Int()
@@ -43,18 +119,98 @@ class RewardSchema(Schema):
         return Reward(**data)
 
 
+class ScoreDeltaSchema(Schema):
+    """ Validates the points to add to a user's score """
+    user = fields.Int(required=True)
+    add_to_score = fields.Int(required=True)
+    # given by senders that may send the same delta again
+    id = fields.Str(validate=validate.Length(min=1, max=MAX_DELTA_ID_LENGTH))
+
+
+class AppliedDelta(db.Model):
+    """ The id of a delta added to a score by /rewards/add_scores, written in
+        the same transaction as the score, so a delta sent again after its
+        reply got lost is not added twice
+    """
+    id = db.Column(db.String(MAX_DELTA_ID_LENGTH), primary_key=True)
+    created = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<AppliedDelta: {self.id}>"
+
+
+class PrizeTier(db.Model):
+    """ A prize users get once their score reaches its points """
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(120), nullable=False)
+    points = db.Column(db.Integer, nullable=False, unique=True)
+
+    def __repr__(self):
+        return f"<PrizeTier: {self.name} at {self.points} points>"
+
+
+class EligibilityEvent(db.Model):
+    """ A user whose score reached the points of a prize tier, recorded by
+        triggers on the reward table. Read in id order by the jobs handing
+        out the prizes, which carry on from the last id they saw.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    user = db.Column(db.Integer, nullable=False)
+    tier = db.Column(db.Integer, nullable=False)
+    points = db.Column(db.Integer, nullable=False)
+    # the format SQLAlchemy stores datetimes in, so they compare as text
+    created = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<EligibilityEvent: {self.user} reached {self.points} points>"
+
+
+event.listen(PrizeTier.__table__, 'after_create', DDL(
+    f"INSERT INTO prize_tier (name, points) "
+    f"VALUES ('prize', {DEFAULT_PRIZE_POINTS})"))
+
+# the triggers need the reward, prize_tier and eligibility_event tables,
+# they are added once all the tables exist. DDL escapes % as %%
+ELIGIBILITY_EVENTS_SELECT = (
+    "SELECT NEW.user, prize_tier.id, prize_tier.points, "
+    "strftime('%%Y-%%m-%%d %%H:%%M:%%f000', 'now') FROM prize_tier "
+    "WHERE prize_tier.points <= NEW.score")
+ELIGIBILITY_DDL = (
+    "CREATE TRIGGER IF NOT EXISTS eligibility_insert AFTER INSERT ON reward "
+    "BEGIN INSERT INTO eligibility_event (user, tier, points, created) "
+    f"{ELIGIBILITY_EVENTS_SELECT}; END",
+    "CREATE TRIGGER IF NOT EXISTS eligibility_update "
+    "AFTER UPDATE OF score ON reward WHEN NEW.score > OLD.score "
+    "BEGIN INSERT INTO eligibility_event (user, tier, points, created) "
+    f"{ELIGIBILITY_EVENTS_SELECT} AND prize_tier.points > OLD.score; END",
+)
+for statement in ELIGIBILITY_DDL:
+    event.listen(db.metadata, 'after_create', DDL(statement))
+
+
 # instantiate the schema serializer
 reward_schema = RewardSchema()
 rewards_schema = RewardSchema(many=True)
+reward_encoder = FastEncoder(reward_schema)
+score_delta_schema = ScoreDeltaSchema()
+score_deltas_schema = ScoreDeltaSchema(many=True)
+# (points, name) of the prize tiers, lowest first
+prize_tiers_cache = LRUCache(maxsize=1, ttl=PRIZE_TIERS_TTL)
+# when this worker last deleted the expired applied deltas
+applied_deltas_purge = {"purged_at": None}
 
 
 # add a route to GET all rewards
 @app.route("/rewards", methods=['GET'])
 def rewards_list():
-    """ Return all Reward instances """
+    """ Return all Reward instances, streamed as NDJSON if the Accept header
+        asks for it
+    """
+    if wants_ndjson():
+        return ndjson_response(Reward.query, Reward.user, reward_encoder)
+
     rewards = Reward.query.all()
-    serialized_objects = rewards_schema.dumps(
-        rewards, sort_keys=True, indent=4)
+    serialized_objects = reward_encoder.dumps_many(rewards, flag_arg('pretty'))
 
     return Response(
         response=serialized_objects,
@@ -71,7 +227,7 @@ def reward_info(user):
     if not reward:
         raise NotFound
 
-    serialized_object = reward_schema.dumps(reward, sort_keys=True, indent=4)
+    serialized_object = reward_encoder.dumps(reward, flag_arg('pretty'))
 
     return Response(
         response=serialized_object,
@@ -79,27 +235,211 @@ def reward_info(user):
         mimetype="application/json"
     )
 
+@app.route("/rewards/top", methods=['GET'])
+def top_rewards():
+    """ The users with the highest scores, best first, ?n= of them (100 by
+        default) from the ?offset=-th on. Users with the same score share
+        the same rank:
+        [{"rank": 1, "score": 12, "user": 7}, ...]
+    """
+    n = int_arg('n', default=DEFAULT_TOP_SIZE, minimum=1, maximum=MAX_TOP_SIZE)
+    offset = int_arg('offset', default=0, minimum=0)
+    rewards = Reward.query.order_by(Reward.score.desc(), Reward.user) \
+        .offset(offset).limit(n).all()
+
+    ranked = []
+    for position, reward in enumerate(rewards, offset + 1):
+        if not ranked:
+            rank = users_ahead_of(reward.score) + 1
+        elif reward.score != ranked[-1]["score"]:
+            rank = position
+        ranked.append({"rank": rank, "score": reward.score,
+                       "user": reward.user})
+
+    return Response(
+        response=encode(ranked, flag_arg('pretty')),
+        status=http_status.OK,
+        mimetype="application/json"
+    )
+
+
+@app.route("/rewards/rank/<int:user>", methods=['GET'])
+def reward_rank(user):
+    """ The rank of a user on the leaderboard of /rewards/top:
+        {"rank": 3, "score": 10, "user": 7}
+    """
+    reward = Reward.query.get(user)
+    if not reward:
+        raise NotFound
+
+    response_dict = {
+        "rank": users_ahead_of(reward.score) + 1,
+        "score": reward.score,
+        "user": user
+    }
+
+    return Response(
+        response=encode(response_dict, flag_arg('pretty')),
+        status=http_status.OK,
+        mimetype="application/json"
+    )
+
+
+def users_ahead_of(score):
+    """ How many users have a higher score """
+    return db.session.query(func.coalesce(func.sum(ScoreCount.users), 0)) \
+        .filter(ScoreCount.score > score).scalar()
+
+
 # Route for adding a new score
 @app.route("/rewards/add_score", methods=["POST"])
 def add_score():
-    """ POST a new score """
-    user = request.get_json().get('user')
-    add_to_score = request.get_json().get('add_to_score')
-
-    user_score = Reward.query.get(user)
-    if not user_score:
-        return NotFound
+    """ POST a new score.
+        The score is incremented by a single UPDATE, so concurrent requests
+        for the same user, even from other processes, never lose points.
+    """
+    try:
+        delta = score_delta_schema.load(request.get_json() or {})
+    except ValidationError as err:
+        raise BadRequest(err.messages)
 
-    user_score.score += add_to_score
+    score = increment_score(delta['user'], delta['add_to_score'])
     db.session.commit()
 
+    if score is None:
+        raise NotFound
+
+    return Response(
+        response=reward_schema.dumps(
+            {"score": score, "user": delta['user']}, sort_keys=True, indent=4),
+        status=http_status.OK,
+        mimetype='application/json'
+    )
+
+
+def increment_score(user, points):
+    """ Atomically add points to a user's score inside the current
+        transaction and return the new score, None for an unknown user
+    """
+    params = {'target_user': user, 'points': points}
+    if SUPPORTS_RETURNING:
+        rows = db.session.execute(text(
+            "UPDATE reward SET score = score + :points "
+            "WHERE user = :target_user RETURNING score"), params).fetchall()
+        return rows[0].score if rows else None
+
+    # the UPDATE holds the write lock until commit,
+    # so the score read right after it is still ours
+    updated = db.session.execute(text(
+        "UPDATE reward SET score = score + :points "
+        "WHERE user = :target_user"), params)
+    if not updated.rowcount:
+        return None
+    return db.session.execute(text(
+        "SELECT score FROM reward WHERE user = :target_user"), params).scalar()
+
+
+# Route for adding many scores at once
+@app.route("/rewards/add_scores", methods=["POST"])
+def add_scores():
+    """ POST a list of scores to add, applied in a single transaction.
+        request json: [{"user": 1, "add_to_score": 2, "id": "booking-7"}, ...]
+        A delta with an id is applied once: sent again, it is skipped.
+        response json has the following format:
+        {
+            "rewards": [{"score": new_score: Int, "user": user: Int}, ...],
+            "not_found": [user: Int, ...]
+        }
+    """
+    try:
+        deltas = score_deltas_schema.load(request.get_json() or [])
+    except ValidationError as err:
+        raise BadRequest(err.messages)
+
+    deltas = unapplied(deltas)
+    # several deltas for a user end up as a single update
+    totals = {}
+    for delta in deltas:
+        totals[delta['user']] = totals.get(delta['user'], 0) + \
+            delta['add_to_score']
+
+    rewards = []
+    if totals:
+        add_to_scores = Reward.__table__.update().where(
+            Reward.user == bindparam('target_user')).values(
+            score=Reward.score + bindparam('points'))
+        db.session.execute(add_to_scores, [
+            {'target_user': user, 'points': points}
+            for user, points in totals.items()])
+
+        for users in chunked(list(totals)):
+            rewards.extend(
+                Reward.query.filter(Reward.user.in_(users))
+                .populate_existing().all())
+
+    found = {reward.user for reward in rewards}
+    record_applied([delta['id'] for delta in deltas
+                    if 'id' in delta and delta['user'] in found])
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # the same delta is being applied by a concurrent request
+        db.session.rollback()
+        raise ServiceUnavailable("Some of the deltas are being applied, "
+                                 "send them again.")
+
+    rewards.sort(key=lambda reward: reward.user)
+    response_dict = {
+        "rewards": rewards_schema.dump(rewards),
+        "not_found": sorted(set(totals) - found)
+    }
+
     return Response(
-        response=reward_schema.dumps(user_score, sort_keys=True, indent=4),
+        response=json.dumps(response_dict, sort_keys=True, indent=4),
         status=http_status.OK,
         mimetype='application/json'
     )
 
 
+def unapplied(deltas):
+    """ The deltas whose id, if they have one, was not applied yet, each
+        id once
+    """
+    ids = {delta['id'] for delta in deltas if 'id' in delta}
+    applied = set()
+    if ids:
+        applied = {applied_id for applied_id, in db.session.query(
+            AppliedDelta.id).filter(text(
+                "applied_delta.id IN (SELECT value FROM json_each(:ids))"))
+            .params(ids=json.dumps(sorted(ids)))}
+
+    fresh = []
+    for delta in deltas:
+        if 'id' in delta:
+            if delta['id'] in applied:
+                continue
+            applied.add(delta['id'])
+        fresh.append(delta)
+    return fresh
+
+
+def record_applied(ids):
+    """ Record the ids of the deltas applied in the current transaction and,
+        now and then, forget those applied more than APPLIED_DELTA_TTL ago
+    """
+    now = datetime.utcnow()
+    if ids:
+        db.session.execute(AppliedDelta.__table__.insert(),
+                           [{"id": delta_id, "created": now} for delta_id in ids])
+
+    purged_at = applied_deltas_purge["purged_at"]
+    if purged_at is None or (now - purged_at).total_seconds() >= \
+            APPLIED_DELTA_PURGE_INTERVAL:
+        AppliedDelta.query.filter(AppliedDelta.created < now - timedelta(
+            seconds=APPLIED_DELTA_TTL)).delete(synchronize_session=False)
+        applied_deltas_purge["purged_at"] = now
+
+
 @app.route("/rewards/prizes/<user>", methods=['GET', ])
 def is_prize_available(user):
     """ Route to determine if user can retrieve prizes given a score
@@ -110,23 +450,13 @@ def is_prize_available(user):
             "points_unitil_prize": remaining_points: Int
         }
     """
-    # May we have a database for this?
-    # For now this is hard-coded
-    needed_points_for_prize = 5
     user = int(user)
     user_record = Reward.query.get(user)
 
     if not user_record:
-        return NotFound
-    # check if user can get a prize
-    if user_record.score < needed_points_for_prize:
-        prize_available = False
-        remaining_points = needed_points_for_prize - user_record.score
+        raise NotFound
 
-    response_dict = {"user": user,
-                     "prize_avaliable": prize_available,
-                     "points_until_prize": remaining_points
-                     }
+    response_dict = prize_status(user_record, prize_tiers())
 
     return Response(
         response=json.dumps(response_dict, sort_keys=True, indent=4),
@@ -135,5 +465,118 @@ def is_prize_available(user):
     )
 
 
+# route to check many users at once
+@app.route("/rewards/prizes", methods=['GET'])
+def prizes():
+    """ The prizes of the users listed in ?users=1,2,3:
+        {
+            "prizes": [{"points_until_prize": 0, "prize_avaliable": true,
+                        "user": 1}, ...],
+            "not_found": [user: Int, ...]
+        }
+    """
+    return prizes_response(int_list_arg('users') or [])
+
+
+# route to check a list of users too long for the query string
+@app.route("/rewards/prizes/lookup", methods=['POST'])
+def prizes_lookup():
+    """ POST {"users": [user, ...]} and get their prizes as GET
+        /rewards/prizes?users= does
+    """
+    body = request.get_json(force=True, silent=True)
+    users = body.get("users") if isinstance(body, dict) else None
+    if not isinstance(users, list) or \
+            not all(type(user) is int for user in users):
+        raise BadRequest('Expected {"users": [user, ...]}')
+
+    return prizes_response(users)
+
+
+def prizes_response(users):
+    """ The prizes of the users, read in a single query whatever their
+        number, the ids being bound as one JSON array
+    """
+    users = sorted(set(users))
+    if len(users) > MAX_PRIZE_USERS:
+        raise BadRequest(f"At most {MAX_PRIZE_USERS} users per request")
+
+    tiers = prize_tiers()
+    statuses = [prize_status(reward, tiers) for reward in Reward.query.filter(
+        text("reward.user IN (SELECT value FROM json_each(:users))")).params(
+            users=json.dumps(users)).order_by(Reward.user)]
+    found = {status["user"] for status in statuses}
+
+    return Response(
+        response=encode({"not_found": [user for user in users
+                                       if user not in found],
+                         "prizes": statuses}, flag_arg('pretty')),
+        status=http_status.OK,
+        mimetype="application/json"
+    )
+
+
+# route for the jobs handing out prizes
+@app.route("/rewards/prizes/eligible", methods=['GET'])
+def eligible_users():
+    """ Users who reached a prize tier, in the order they did, from the
+        ?since=<date> on or after the event ?after=<id>, ?limit= at a time
+        (1000 by default). The next page is linked in the Link header:
+        [{"created": "2019-11-01T20:15:02.123000", "id": 1, "points": 5,
+          "tier": 1, "user": 7}, ...]
+    """
+    after = int_arg('after', minimum=0)
+    since = date_arg('since')
+    limit = int_arg('limit', default=DEFAULT_EVENTS_PAGE_SIZE, minimum=1,
+                    maximum=MAX_EVENTS_PAGE_SIZE)
+
+    query = EligibilityEvent.query
+    if after is not None:
+        query = query.filter(EligibilityEvent.id > after)
+    if since is not None:
+        query = query.filter(
+            EligibilityEvent.created >= datetime.combine(since, time()))
+    events = query.order_by(EligibilityEvent.id).limit(limit).all()
+
+    response = Response(
+        response=encode([{"created": event.created.isoformat(),
+                          "id": event.id,
+                          "points": event.points,
+                          "tier": event.tier,
+                          "user": event.user} for event in events],
+                        flag_arg('pretty')),
+        status=http_status.OK,
+        mimetype="application/json"
+    )
+    if len(events) == limit:
+        next_url = url_for('eligible_users', **dict(
+            request.args, after=events[-1].id, limit=limit))
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+
+    return response
+
+
+def prize_tiers():
+    """ (points, name) of every prize tier, lowest first """
+    tiers = prize_tiers_cache.get('tiers')
+    if tiers is None:
+        tiers = [(tier.points, tier.name) for tier in
+                 PrizeTier.query.order_by(PrizeTier.points)]
+        prize_tiers_cache.set('tiers', tiers)
+    return tiers
+
+
+def prize_status(reward, tiers):
+    """ Whether a user reached a prize tier, and the points they still need
+        to reach the next one (0 once they reached them all)
+    """
+    next_tier = next((points for points, _ in tiers
+                      if points > reward.score), None)
+    return {"user": reward.user,
+            "prize_avaliable": bool(tiers) and tiers[0][0] <= reward.score,
+            "points_until_prize": 0 if next_tier is None
+            else next_tier - reward.score}
+
+
 if __name__ == '__main__':
     app.run(port=5004, debug=True)
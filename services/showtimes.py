@@ -1,4 +1,3 @@
-from os.path import dirname, realpath
 # microframework for webapps
 from flask import Flask, request, Response
 # local data storage
@@ -10,18 +9,35 @@ from http import HTTPStatus as http_status
 # read and dump as json data
 import json
 # exception handling
-from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import BadRequest, NotFound
 from datetime import date as datetime_date
+# shared helpers
+from services.streaming import ndjson_response, wants_ndjson
+from services.request_args import int_arg, int_list_arg, date_arg, \
+    flag_arg
+from services.bulk import ingest
+from services.serializers import FastEncoder, encode
+from services.health import add_health_routes
+from services.instrumentation import instrument
+from services.tracing import enable_tracing
+from services.deadlines import enable_deadlines
+from services.database import database_uri, tune_sqlite
 
 # instantiate a flask app and give it a name
 app = Flask(__name__)
 
 # load the database
-root_dir = dirname(realpath(__file__ + '/..'))
-db_file = f"sqlite:///{root_dir}/database/showtimes.db"
-app.config['SQLALCHEMY_DATABASE_URI'] = db_file
+app.config['SQLALCHEMY_DATABASE_URI'] = database_uri("showtimes")
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+tune_sqlite(app)
 db = SQLAlchemy(app)
+add_health_routes(app, db)
+instrument(app)
+enable_tracing(app, "showtimes")
+enable_deadlines(app)
+
+# movies a single schedule request may filter on
+MAX_SCHEDULE_MOVIES = 1000
 
 
 class Showtime(db.Model):
@@ -30,6 +46,12 @@ class Showtime(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     movie = db.Column(db.Integer, nullable=False)
 
+    # schedules are read by date range, for all movies or for a single one
+    __table_args__ = (
+        db.Index('ix_showtime_date_movie', 'date', 'movie'),
+        db.Index('ix_showtime_movie_date', 'movie', 'date'),
+    )
+
     def __repr__(self):
         return f"<Showtime: movie {self.movie} on {self.date}>"
 
@@ -53,6 +75,7 @@ class ShowtimeSchema(Schema):
 # instantiate the schema serializer
 showtime_schema = ShowtimeSchema()
 showtimes_schema = ShowtimeSchema(many=True)
+showtime_encoder = FastEncoder(showtime_schema)
 
 # add root route
 @app.route("/", methods=['GET'])
@@ -68,10 +91,30 @@ def hello():
 # add a route to GET showtimes
 @app.route("/showtimes", methods=['GET'])
 def showtimes_list():
-    """ Return all booking instances """
-    showtimes = Showtime.query.all()
-    serialized_objects = showtimes_schema.dumps(
-        showtimes, sort_keys=True, indent=4)
+    """ Return all showtime instances.
+        With ?from=<date>&to=<date>&movie=<id> only the matching showtimes
+        are returned, grouped by date, so a whole week takes a single call.
+        ?movies=<id>,<id> matches any of several movies.
+        Output is compact unless ?pretty=1 is given. If the Accept header
+        asks for NDJSON the matching showtimes are streamed one per line,
+        ordered by id.
+    """
+    pretty = flag_arg('pretty')
+    from_date = date_arg('from')
+    to_date = date_arg('to')
+    movies = movies_arg()
+
+    if wants_ndjson():
+        query = schedule_query(from_date, to_date, movies).order_by(None)
+        return ndjson_response(query, Showtime.id, showtime_encoder)
+
+    if from_date is None and to_date is None and movies is None:
+        showtimes = Showtime.query.all()
+        serialized_objects = showtime_encoder.dumps_many(showtimes, pretty)
+    else:
+        # showtimes come ordered by date, so are the keys of the schedule
+        showtimes = schedule_query(from_date, to_date, movies).all()
+        serialized_objects = encode(group_by_date(showtimes), pretty)
 
     return Response(
         response=serialized_objects,
@@ -80,6 +123,84 @@ def showtimes_list():
     )
 
 
+def movies_arg():
+    """ The movies of ?movie=<id> and ?movies=<id>,<id>, None if neither is
+        given
+    """
+    movie = int_arg('movie')
+    movies = int_list_arg('movies')
+    if movie is None and movies is None:
+        return None
+
+    return schedule_movies(
+        (movies or []) + ([movie] if movie is not None else []))
+
+
+def schedule_movies(movies):
+    """ Each of the movies once, answering 400 if there are too many """
+    movies = sorted(set(movies))
+    if len(movies) > MAX_SCHEDULE_MOVIES:
+        raise BadRequest(f"At most {MAX_SCHEDULE_MOVIES} movies per request")
+    return movies
+
+
+# route to look up a list of movies too long for the query string
+@app.route("/showtimes/lookup", methods=['POST'])
+def showtimes_lookup():
+    """ POST {"from": <date>, "to": <date>, "movies": [id, ...]} and get the
+        schedule as GET /showtimes?from=&to=&movies= does
+    """
+    body = request.get_json(force=True, silent=True)
+    movies = body.get("movies") if isinstance(body, dict) else None
+    if not isinstance(movies, list) or \
+            not all(type(movie) is int for movie in movies):
+        raise BadRequest('Expected {"from": <date>, "to": <date>, '
+                         '"movies": [id, ...]}')
+
+    showtimes = schedule_query(body_date(body, "from"), body_date(body, "to"),
+                               schedule_movies(movies)).all()
+    return Response(
+        response=encode(group_by_date(showtimes), flag_arg('pretty')),
+        status=http_status.OK,
+        mimetype="application/json"
+    )
+
+
+def body_date(body, name):
+    """ An optional YYYY-MM-DD date of a JSON body """
+    raw_value = body.get(name)
+    if raw_value is None:
+        return None
+    try:
+        return datetime_date.fromisoformat(raw_value)
+    except (TypeError, ValueError):
+        raise BadRequest(f"'{name}' must be a YYYY-MM-DD date, got '{raw_value}'")
+
+
+def schedule_query(from_date, to_date, movies):
+    """ Showtimes between two dates (both inclusive) ordered by date,
+        read from the (date, movie) or the (movie, date) index
+    """
+    query = Showtime.query
+    if movies is not None:
+        query = query.filter(Showtime.movie.in_(movies))
+    if from_date is not None:
+        query = query.filter(Showtime.date >= from_date)
+    if to_date is not None:
+        query = query.filter(Showtime.date <= to_date)
+
+    return query.order_by(Showtime.date, Showtime.movie)
+
+
+def group_by_date(showtimes):
+    """ Map each date to the list of its serialized showtimes """
+    schedule = {}
+    for showtime in map(showtime_encoder.dump, showtimes):
+        schedule.setdefault(showtime['date'], []).append(showtime)
+
+    return schedule
+
+
 # add a route to GET showtimes for a certain date
 @app.route("/showtimes/<date>", methods=['GET'])
 def showtimes_record(date):
@@ -90,8 +211,8 @@ def showtimes_record(date):
     if not showtimes:
         raise NotFound
 
-    serialized_objects = showtimes_schema.dumps(
-        showtimes, sort_keys=True, indent=4)
+    serialized_objects = showtime_encoder.dumps_many(
+        showtimes, flag_arg('pretty'))
 
     return Response(
         response=serialized_objects,
@@ -120,6 +241,13 @@ def new_movie():
     )
 
 
+# Route for adding many showtimes at once
+@app.route("/showtimes/bulk", methods=["POST"])
+def bulk_showtimes():
+    """ POST many showtimes as a JSON array or an NDJSON stream """
+    return ingest(db, Showtime, showtime_schema)
+
+
 # exeuted when this is called from the cmd
 if __name__ == "__main__":
     app.run(port=5002, debug=True)
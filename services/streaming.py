@@ -0,0 +1,76 @@
+""" Helpers to page through tables and stream them out without loading them whole """
+from textwrap import indent
+from http import HTTPStatus as http_status
+from flask import Response, request, stream_with_context
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# rows read from the database at a time when streaming a table
+STREAM_BATCH_SIZE = 1000
+
+
+def keyset_batches(query, key_column, batch_size, after=None):
+    """ Yield lists of at most `batch_size` rows ordered by `key_column`.
+        Each batch resumes right after the last key of the previous one
+        (keyset pagination), so no OFFSET scan is ever needed.
+    """
+    while True:
+        page = query
+        if after is not None:
+            page = page.filter(key_column > after)
+        batch = page.order_by(key_column).limit(batch_size).all()
+
+        if batch:
+            yield batch
+        if len(batch) < batch_size:
+            return
+
+        after = getattr(batch[-1], key_column.key)
+
+
+def json_array_chunks(batches, encoder, pretty=False):
+    """ Yield a JSON array one batch at a time, the same document
+        `encoder.dumps_many` gives for the whole list at once
+    """
+    if not pretty:
+        separator = ''
+        yield '['
+        for batch in batches:
+            yield separator + ','.join(encoder.dumps(row) for row in batch)
+            separator = ','
+        yield ']'
+        return
+
+    separator = '\n'
+    yield '['
+    for batch in batches:
+        rows = [indent(encoder.dumps(row, pretty=True), '    ')
+                for row in batch]
+        yield separator + ',\n'.join(rows)
+        separator = ',\n'
+    yield ']' if separator == '\n' else '\n]'
+
+
+def wants_ndjson():
+    """ Whether the client prefers NDJSON to a JSON document """
+    return request.accept_mimetypes.best_match(
+        ['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+
+def ndjson_lines(batches, encoder):
+    """ Yield the rows one compact JSON object per line, a batch at a time """
+    for batch in batches:
+        yield ''.join(encoder.dumps(row) + '\n' for row in batch)
+
+
+def ndjson_response(query, key_column, encoder, after=None,
+                    batch_size=STREAM_BATCH_SIZE):
+    """ Stream the rows of a query as NDJSON, ordered by `key_column`.
+        The first batch goes out as soon as it is read, and neither side
+        ever holds more than a batch.
+    """
+    batches = keyset_batches(query, key_column, batch_size, after=after)
+    return Response(
+        response=stream_with_context(ndjson_lines(batches, encoder)),
+        status=http_status.OK,
+        mimetype=NDJSON_MIMETYPE
+    )
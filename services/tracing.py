@@ -0,0 +1,267 @@
+""" Request ids shared across the services and timing spans of each hop.
+
+Every request gets the X-Request-ID it came with, or a new one, and passes
+it on to the calls it makes through the shared HTTP client. Tracing is off
+unless a trace directory is set (app.config['TRACE_DIR'] or the
+CINEMA_TRACE_DIR environment variable): each service then appends its spans
+there to <service>.jsonl, one per request served, with its database and
+downstream time, and one per call made to another service. A file reaching
+MAX_TRACE_BYTES is moved to <service>.jsonl.1, replacing the previous one.
+
+The waterfall of a request across the services is printed with:
+
+    python -m services.tracing <request id>
+    python -m services.tracing --slowest 10
+"""
+import argparse
+import contextvars
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from glob import glob
+from os.path import dirname, join, realpath
+from urllib.parse import urlsplit
+from flask import current_app, g, request
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+# request ids taken from callers, anything else is replaced by a new one
+VALID_REQUEST_ID = re.compile(r'[A-Za-z0-9._:-]{1,128}')
+# where the launcher has the services write their spans, when told to
+DEFAULT_TRACE_DIR = join(dirname(realpath(__file__ + '/..')), 'run', 'traces')
+WATERFALL_WIDTH = 40
+# size at which a trace file is rotated: a service keeps at most twice that
+MAX_TRACE_BYTES = 64 * 1024 * 1024
+
+# the span of the work this thread, or task, is doing
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Tracer:
+    """ Appends the spans of a service to its trace file, if it has one """
+
+    def __init__(self, service, trace_dir=None, max_bytes=MAX_TRACE_BYTES):
+        self.service = service
+        self.path = join(trace_dir, f"{service}.jsonl") if trace_dir else None
+        self.max_bytes = max_bytes
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        if self.path is None:
+            return
+        line = (json.dumps(record, separators=(',', ':')) + "\n").encode()
+        with self._lock:
+            # workers forked from a master open the file for themselves
+            if self._pid != os.getpid():
+                self._open()
+            elif os.fstat(self._fd).st_size >= self.max_bytes:
+                self._rotate()
+            # a single append, lines of concurrent workers do not interleave
+            os.write(self._fd, line)
+
+    def _open(self):
+        if self._fd is not None and self._pid == os.getpid():
+            os.close(self._fd)
+        os.makedirs(dirname(self.path), exist_ok=True)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        self._pid = os.getpid()
+
+    def _rotate(self):
+        """ Move the full file aside, unless another worker already did,
+            and go on in a new one
+        """
+        try:
+            if os.stat(self.path).st_ino == os.fstat(self._fd).st_ino:
+                os.replace(self.path, self.path + ".1")
+        except FileNotFoundError:
+            pass
+        self._open()
+
+
+class Span:
+    """ A timed piece of work done for a request """
+
+    def __init__(self, tracer, request_id, kind, name):
+        self.tracer = tracer
+        self.request_id = request_id
+        self.kind = kind
+        self.name = name
+        self.start = time.time()
+        self.downstream_seconds = 0.0
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_downstream(self, seconds):
+        with self._lock:
+            self.downstream_seconds += seconds
+
+    def finish(self, **fields):
+        seconds = time.perf_counter() - self._started
+        self.tracer.write(dict(
+            fields,
+            request_id=self.request_id,
+            service=self.tracer.service,
+            kind=self.kind,
+            name=self.name,
+            start=self.start,
+            duration_ms=round(seconds * 1000, 3),
+            downstream_ms=round(self.downstream_seconds * 1000, 3),
+            pid=os.getpid()
+        ))
+
+
+def new_request_id():
+    return uuid.uuid4().hex
+
+
+def enable_tracing(app, service):
+    """ Give every request of the app a request id and a span """
+    trace_dir = app.config.get('TRACE_DIR', os.environ.get('CINEMA_TRACE_DIR'))
+    tracer = app.extensions['tracing'] = Tracer(service, trace_dir)
+
+    @app.before_request
+    def start_span():
+        request_id = request.headers.get(REQUEST_ID_HEADER, '')
+        if not VALID_REQUEST_ID.fullmatch(request_id):
+            request_id = new_request_id()
+        rule = request.url_rule
+        span = Span(tracer, request_id, 'server',
+                    f"{request.method} {rule.rule if rule else request.path}")
+        g.trace_token = current_span.set(span)
+
+    @app.after_request
+    def finish_span(response):
+        span = current_span.get()
+        if span is not None and 'trace_token' in g:
+            response.headers[REQUEST_ID_HEADER] = span.request_id
+            # query time is measured by the instrumentation, when installed
+            span.finish(status=response.status_code,
+                        db_ms=round(g.get('sql_seconds', 0.0) * 1000, 3))
+        return response
+
+    @app.teardown_request
+    def forget_span(exception):
+        token = g.pop('trace_token', None)
+        if token is not None:
+            current_span.reset(token)
+
+
+@contextmanager
+def span(name):
+    """ A span, with a request id of its own, for work done outside of the
+        requests of the current app, such as a background dispatcher
+    """
+    tracer = current_app.extensions.get('tracing')
+    if tracer is None:
+        yield None
+        return
+
+    background_span = Span(tracer, new_request_id(), 'internal', name)
+    token = current_span.set(background_span)
+    try:
+        yield background_span
+    finally:
+        current_span.reset(token)
+        background_span.finish()
+
+
+def outbound_headers(headers=None):
+    """ The headers of an outgoing call, carrying the current request id """
+    current = current_span.get()
+    if current is None:
+        return headers
+    headers = dict(headers or {})
+    headers.setdefault(REQUEST_ID_HEADER, current.request_id)
+    return headers
+
+
+def record_call(method, url, status, seconds):
+    """ Add an outgoing call to the current span and trace it """
+    current = current_span.get()
+    if current is None:
+        return
+    current.add_downstream(seconds)
+    parts = urlsplit(url)
+    current.tracer.write({
+        "request_id": current.request_id,
+        "service": current.tracer.service,
+        "kind": "client",
+        "name": f"{method} {parts.netloc}{parts.path}",
+        "start": time.time() - seconds,
+        "duration_ms": round(seconds * 1000, 3),
+        "status": status,
+        "pid": os.getpid()
+    })
+
+
+def read_spans(trace_dir):
+    """ All the spans of the trace files, grouped by request id """
+    spans = {}
+    for path in glob(join(trace_dir, "*.jsonl")) + \
+            glob(join(trace_dir, "*.jsonl.1")):
+        with open(path) as trace_file:
+            for line in trace_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by a crash
+                spans.setdefault(record["request_id"], []).append(record)
+    return spans
+
+
+def waterfall(spans):
+    """ The spans of a request as lines of text, on a shared time axis """
+    spans = sorted(spans, key=lambda record: record["start"])
+    origin = spans[0]["start"]
+    end = max(record["start"] + record["duration_ms"] / 1000
+              for record in spans)
+    total_ms = max((end - origin) * 1000, 0.001)
+
+    lines = [f"request {spans[0]['request_id']}  {total_ms:.1f} ms"]
+    for record in spans:
+        offset_ms = (record["start"] - origin) * 1000
+        first = int(offset_ms / total_ms * WATERFALL_WIDTH)
+        length = max(1, round(record["duration_ms"] / total_ms * WATERFALL_WIDTH))
+        bar = (" " * first + "#" * length).ljust(WATERFALL_WIDTH)
+        details = ""
+        if record["kind"] != "client":
+            details = (f"  db {record.get('db_ms', 0):.1f} ms"
+                       f"  downstream {record['downstream_ms']:.1f} ms")
+        lines.append(
+            f"{offset_ms:>9.1f} ms |{bar}| {record['duration_ms']:>9.1f} ms  "
+            f"{record['service']:<9} {record['kind']:<8} {record['name']} "
+            f"{record.get('status', '')}{details}")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("request_id", nargs="?")
+    parser.add_argument("--slowest", type=int, default=10,
+                        help="without a request id, show the N slowest requests")
+    parser.add_argument("--dir", default=os.environ.get(
+        'CINEMA_TRACE_DIR', DEFAULT_TRACE_DIR))
+    args = parser.parse_args()
+
+    spans = read_spans(args.dir)
+    if args.request_id:
+        if args.request_id not in spans:
+            parser.exit(1, f"No span of request {args.request_id} in {args.dir}\n")
+        request_ids = [args.request_id]
+    else:
+        def slowest_first(request_id):
+            return -max(record["duration_ms"] for record in spans[request_id])
+        request_ids = sorted(spans, key=slowest_first)[:args.slowest]
+
+    for request_id in request_ids:
+        print("\n".join(waterfall(spans[request_id])), end="\n\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,8 @@
-from os.path import dirname, realpath
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from datetime import date as datetime_date, timedelta
 # microframework for webapps
 from flask import Flask, request, Response
 # local data storage
@@ -11,15 +15,46 @@ from http import HTTPStatus as http_status
 import json
 import requests
 # exception handling
-from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import BadRequest, NotFound, ServiceUnavailable
+# shared helpers
+from services.streaming import ndjson_response, wants_ndjson
+from services.http_client import client
+from services.bulk import ingest
+from services.request_args import flag_arg
+from services.serializers import FastEncoder, encode
+from services.health import add_health_routes
+from services.instrumentation import instrument
+from services.tracing import enable_tracing
+from services.deadlines import enable_deadlines
+from services.database import database_uri, tune_sqlite
 
 
 app = Flask(__name__)
-root_dir = dirname(realpath(__file__ + '/..'))
-db_file = f"sqlite:///{root_dir}/database/users.db"
-app.config['SQLALCHEMY_DATABASE_URI'] = db_file
+app.config['SQLALCHEMY_DATABASE_URI'] = database_uri("users")
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+tune_sqlite(app)
 db = SQLAlchemy(app)
+add_health_routes(app, db)
+instrument(app)
+enable_tracing(app, "users")
+enable_deadlines(app)
+
+MOVIES_URL = "http://127.0.0.1:5001/movies"
+BOOKINGS_URL = "http://127.0.0.1:5003/bookings"
+SHOWTIMES_URL = "http://127.0.0.1:5002/showtimes"
+# movies returned by the suggestions route
+SUGGESTIONS = 3
+# seconds the movie ranking is trusted before asking the Movies service
+# whether its catalog changed
+MOVIE_INDEX_MAX_AGE = 5.0
+# what ?expand= can add to the bookings of a user
+EXPAND_FIELDS = ('movie', 'showtime')
+# calls made at once to the other services to expand bookings
+EXPAND_WORKERS = 8
+# booking dates this close are expanded with a single showtimes call
+SHOWTIME_WINDOW_DAYS = 7
+# booked movies a showtimes lookup filters on, the most the service accepts
+SHOWTIME_MOVIES_PER_CALL = 1000
 
 
 class User(db.Model):
@@ -49,6 +84,7 @@ class UserSchema(Schema):
 # instantiate the schema serializer
 user_schema = UserSchema()
 users_schema = UserSchema(many=True)
+user_encoder = FastEncoder(user_schema)
 
 
 @app.route("/", methods=['GET'])
@@ -66,9 +102,14 @@ def hello():
 
 @app.route("/users", methods=['GET'])
 def users_list():
-    """ Return all booking instances """
+    """ Return all user instances, streamed as NDJSON if the Accept header
+        asks for it
+    """
+    if wants_ndjson():
+        return ndjson_response(User.query, User.id, user_encoder)
+
     users = User.query.all()
-    serialized_objects = users_schema.dumps(users, sort_keys=True, indent=4)
+    serialized_objects = user_encoder.dumps_many(users, flag_arg('pretty'))
 
     return Response(
         response=serialized_objects,
@@ -84,7 +125,7 @@ def user_record(user):
     if not user:
         raise NotFound
 
-    serialized_objects = user_schema.dumps(user, sort_keys=True, indent=4)
+    serialized_objects = user_encoder.dumps(user, flag_arg('pretty'))
 
     return Response(
         response=serialized_objects,
@@ -112,43 +153,239 @@ def new_user():
         mimetype='application/json'
     )
 
-# TODO: refactor this method
+# Route for adding many users at once
+@app.route("/users/bulk", methods=["POST"])
+def bulk_users():
+    """ POST many users as a JSON array or an NDJSON stream """
+    return ingest(db, User, user_schema)
+
 @app.route("/users/<user>/bookings", methods=['GET'])
 def user_bookings(user):
     """
-    Gets booking information from the bookings service for this user
+    Gets booking information from the bookings service for this user.
+    With ?expand=movie,showtime the movie id of every booking is replaced by
+    the movie and the showtime booked is added, as the other services return
+    them. Ids that could not be expanded are left as they are.
 
     response format is like:
+        [{"date": date, "id": id, "movie": movie, "rewarded": rewarded,
+          "showtime": showtime, "user": user}, ...]
     """
-    get_bookings_url = "http://127.0.0.1:5003/bookings"
+    expand = expand_arg()
     if not User.query.get(user):
-        return NotFound
+        raise NotFound
 
     try:
-        response = requests.get(f"{get_bookings_url}/{user}")
-    except requests.exceptions.ConnectionError:
+        response = client.get(f"{BOOKINGS_URL}/{user}")
+    except requests.exceptions.RequestException:
         raise ServiceUnavailable("The Bookings service is unavailable.")
 
     if response.status_code == http_status.NOT_FOUND:
         raise NotFound(f"No bookings were found for user {user}")
 
+    bookings = response.json()
+    if expand:
+        expand_bookings(bookings, expand)
+
     return Response(
-        response=json.dumps(response.json()),
+        response=json.dumps(bookings),
         status=http_status.OK,
         mimetype='application/json'
     )
 
-# TODO: implement this
+
+def expand_arg():
+    """ Read ?expand=movie,showtime """
+    expand = {field.strip() for field in request.args.get('expand', '').split(',')
+              if field.strip()}
+    unknown = expand.difference(EXPAND_FIELDS)
+    if unknown:
+        raise BadRequest(f"Cannot expand {', '.join(sorted(unknown))}, "
+                         f"only {', '.join(EXPAND_FIELDS)}")
+
+    return expand
+
+
+# threads calling the other services on behalf of the expanding requests
+expand_pool = ThreadPoolExecutor(max_workers=EXPAND_WORKERS,
+                                 thread_name_prefix="expand")
+
+
+def expand_bookings(bookings, expand):
+    """ Expand the bookings in place. All the movies take a single lookup and
+        the showtimes one call per SHOWTIME_WINDOW_DAYS days booked, asking
+        only for the movies booked then; the calls all run at once, so
+        expanding takes about as long as the slowest.
+    """
+    movies_call = None
+    showtimes_calls = []
+    if 'movie' in expand:
+        movie_ids = sorted({booking["movie"] for booking in bookings})
+        # the calls carry on the request id, kept in the context
+        movies_call = expand_pool.submit(
+            copy_context().run, fetch_movies, movie_ids)
+    if 'showtime' in expand:
+        dates = sorted({booking["date"] for booking in bookings})
+        for first, last in date_windows(dates):
+            # dates in the YYYY-MM-DD format compare as strings
+            booked = sorted({booking["movie"] for booking in bookings
+                             if first <= booking["date"] <= last})
+            showtimes_calls.extend(expand_pool.submit(
+                copy_context().run, fetch_showtimes, first, last,
+                booked[start:start + SHOWTIME_MOVIES_PER_CALL])
+                for start in range(0, len(booked), SHOWTIME_MOVIES_PER_CALL))
+
+    showtimes = {}
+    for call in showtimes_calls:
+        showtimes.update(call.result())
+    movies = movies_call.result() if movies_call else {}
+
+    for booking in bookings:
+        if 'showtime' in expand:
+            booking["showtime"] = showtimes.get(
+                (booking["date"], booking["movie"]))
+        if 'movie' in expand:
+            booking["movie"] = movies.get(booking["movie"], booking["movie"])
+
+
+def date_windows(dates):
+    """ Split sorted YYYY-MM-DD dates into (first, last) windows of at most
+        SHOWTIME_WINDOW_DAYS days
+    """
+    windows = []
+    for day in map(datetime_date.fromisoformat, dates):
+        if windows and day - windows[-1][0] < timedelta(days=SHOWTIME_WINDOW_DAYS):
+            windows[-1][1] = day
+        else:
+            windows.append([day, day])
+
+    return [(first.isoformat(), last.isoformat()) for first, last in windows]
+
+
+def fetch_movies(movie_ids):
+    """ Movies by id, from the batch lookup of the Movies service """
+    try:
+        # a lookup changes nothing, it is safe to retry
+        response = client.post(f"{MOVIES_URL}/lookup", json={"ids": movie_ids},
+                               idempotent=True)
+    except requests.exceptions.RequestException:
+        raise ServiceUnavailable("The Movies service is unavailable.")
+    if response.status_code != http_status.OK:
+        raise ServiceUnavailable("The Movies service is unavailable.")
+
+    return {movie["id"]: movie for movie in response.json()["movies"]}
+
+
+def fetch_showtimes(from_date, to_date, movie_ids):
+    """ Showtimes of the movies between two dates keyed by (date, movie).
+        The movies are POSTed, a list of them may not fit in a URL.
+    """
+    try:
+        # a lookup changes nothing, it is safe to retry
+        response = client.post(f"{SHOWTIMES_URL}/lookup", json={
+            "from": from_date, "to": to_date, "movies": movie_ids},
+            idempotent=True)
+    except requests.exceptions.RequestException:
+        raise ServiceUnavailable("The Showtimes service is unavailable.")
+    if response.status_code != http_status.OK:
+        raise ServiceUnavailable("The Showtimes service is unavailable.")
+
+    return {(date, showtime["movie"]): showtime
+            for date, showtimes in response.json().items()
+            for showtime in showtimes}
+
 @app.route("/users/<username>/suggested", methods=['GET'])
 def user_suggested(username):
     """
     Returns movie suggestions. The algorithm returns a list of 3 top ranked
     movies that the user has not yet booked.
+    The ranking is kept by this service and only the user's bookings are
+    fetched per call, so at most 3 + booked movies are looked at.
     :param username:
     :return: Suggested movies
     """
-    raise NotImplementedError()
+    if not User.query.get(username):
+        raise NotFound
+
+    booked = booked_movies(username)
+    suggested = []
+    for movie in ranked_movies():
+        if len(suggested) == SUGGESTIONS:
+            break
+        if movie["id"] not in booked:
+            suggested.append(movie)
+
+    return Response(
+        response=encode(suggested, flag_arg('pretty')),
+        status=http_status.OK,
+        mimetype="application/json"
+    )
+
+
+# movies from best to worst rated, along with the catalog ETag they match
+movie_index = {"movies": None, "etag": None, "checked_at": 0.0}
+movie_index_lock = threading.Lock()
+
+
+def ranked_movies():
+    """ The catalog sorted by rating. Once MOVIE_INDEX_MAX_AGE has passed the
+        Movies service is asked with If-None-Match whether the catalog
+        changed, which costs an empty 304 until it does. While one request
+        refreshes the index the others keep using the current one, as they
+        do when the Movies service is down.
+    """
+    if movie_index["movies"] is not None and \
+            time.monotonic() - movie_index["checked_at"] < MOVIE_INDEX_MAX_AGE:
+        return movie_index["movies"]
+    if not movie_index_lock.acquire(blocking=movie_index["movies"] is None):
+        return movie_index["movies"]
+
+    try:
+        # another request may have refreshed it while this one waited
+        if movie_index["movies"] is None or \
+                time.monotonic() - movie_index["checked_at"] >= MOVIE_INDEX_MAX_AGE:
+            refresh_movie_index()
+        return movie_index["movies"]
+    finally:
+        movie_index_lock.release()
+
+
+def refresh_movie_index():
+    """ Download and sort the catalog again if it changed """
+    headers = {}
+    if movie_index["etag"] and movie_index["movies"] is not None:
+        headers["If-None-Match"] = movie_index["etag"]
+
+    try:
+        response = client.get(MOVIES_URL, headers=headers)
+    except requests.exceptions.RequestException:
+        response = None
+
+    if response is not None and response.status_code == http_status.OK:
+        movie_index["movies"] = sorted(
+            response.json(), key=lambda movie: (-movie["rating"], movie["id"]))
+        movie_index["etag"] = response.headers.get("ETag")
+    elif response is None or response.status_code != http_status.NOT_MODIFIED:
+        if movie_index["movies"] is None:
+            raise ServiceUnavailable("The Movies service is unavailable.")
+        # serve the last ranking known, it is asked again after MAX_AGE
+
+    movie_index["checked_at"] = time.monotonic()
+
+
+def booked_movies(user):
+    """ Ids of the movies booked by a user """
+    try:
+        response = client.get(f"{BOOKINGS_URL}/{user}")
+    except requests.exceptions.RequestException:
+        raise ServiceUnavailable("The Bookings service is unavailable.")
+
+    if response.status_code == http_status.NOT_FOUND:
+        return set()
+    if response.status_code != http_status.OK:
+        raise ServiceUnavailable("The Bookings service is unavailable.")
 
+    return {booking["movie"] for booking in response.json()}
 
 if __name__ == "__main__":
     app.run(port=5000, debug=True)
@@ -1,10 +1,19 @@
 from flask_testing import TestCase as FlaskTestingCase
 import unittest
+from unittest import mock
 import requests
 import json
-from services import bookings
+import tempfile
+import threading
+import time
+from os.path import join
 from flask import Flask
-from datetime import date as datetime_date
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect
+from werkzeug.exceptions import ServiceUnavailable
+from services import bookings
+from services.database import upgrade_schema, tune_sqlite, database_uri
+from datetime import date as datetime_date, timedelta as datetime_timedelta
 bookings.testing = True
 
 
@@ -12,12 +21,10 @@ class TestBookingService(FlaskTestingCase):
 
     def create_app(self):
         """ Dynamically bind a fake  database to real application """
-        app = Flask(__name__)
+        app = bookings.app
         app.config['TESTING'] = True
-        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        # every request of the test client now hits this in-memory database
         app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///:memory:"
-        bookings.db.init_app(app)
-        app.app_context().push()  # this does the binding
         # now we can test frely on this app
         return app
 
@@ -26,6 +33,7 @@ class TestBookingService(FlaskTestingCase):
         self.post_url = "http://localhost:5003/bookings/new"
         self.new_booking_json = """{"date": "2019-11-12", "movie": 5, "user": 4}"""
         bookings.db.create_all()
+        bookings.idempotency_cache.clear()
         self.populate_db()
 
     def tearDown(self):
@@ -46,6 +54,65 @@ class TestBookingService(FlaskTestingCase):
             self.assertEqual(booking.movie, response_booking.movie)
             self.assertEqual(booking.user, response_booking.user)
 
+    def test_booking_list_stream(self):
+        """ Test /bookings streams the same document as a full dump """
+        all_bookings = bookings.Booking.query.order_by(bookings.Booking.id)
+        expected_json = bookings.bookings_schema.dumps(
+            all_bookings.all(), sort_keys=True, indent=4)
+        with bookings.app.test_client() as booking_list_route:
+            response = booking_list_route.get(f"{self.url}?pretty=1")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_data(as_text=True), expected_json)
+
+    def test_booking_list_pages(self):
+        """ Test keyset pagination with ?after=&limit= """
+        with bookings.app.test_client() as booking_list_route:
+            first_page = booking_list_route.get(f"{self.url}?limit=2")
+            self.assertEqual([b["id"] for b in first_page.get_json()], [1, 2])
+            self.assertIn("after=2", first_page.headers["Link"])
+
+            last_page = booking_list_route.get(f"{self.url}?after=2&limit=2")
+            self.assertEqual([b["id"] for b in last_page.get_json()], [3])
+            self.assertNotIn("Link", last_page.headers)
+
+            bad_page = booking_list_route.get(f"{self.url}?limit=many")
+            self.assertEqual(bad_page.status_code, 400)
+
+    def test_booking_list_ndjson(self):
+        """ Test /bookings streams one booking per line, from ?after= on """
+        with bookings.app.test_client() as booking_list_route:
+            response = booking_list_route.get(
+                f"{self.url}?after=1",
+                headers={"Accept": "application/x-ndjson"})
+
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line)["id"] for line in lines], [2, 3])
+
+    def test_booking_list_filters(self):
+        """ Test /bookings?movie=&from=&to= """
+        with bookings.app.test_client() as booking_list_route:
+            by_movie = booking_list_route.get(f"{self.url}?movie=2")
+            self.assertEqual([b["id"] for b in by_movie.get_json()], [2])
+
+            by_dates = booking_list_route.get(
+                f"{self.url}?from=2019-11-02&to=2019-11-03&limit=10")
+            self.assertEqual([b["id"] for b in by_dates.get_json()], [2, 3])
+
+            bad_date = booking_list_route.get(f"{self.url}?from=yesterday")
+            self.assertEqual(bad_date.status_code, 400)
+
+    def test_booking_record_date_range(self):
+        """ Test /bookings/<user>?from=&to= """
+        with bookings.app.test_client() as booking_record_route:
+            in_range = booking_record_route.get(
+                f"{self.url}/1?from=2019-11-01&to=2019-11-30")
+            self.assertEqual([b["id"] for b in in_range.get_json()], [1])
+
+            out_of_range = booking_record_route.get(
+                f"{self.url}/1?from=2019-12-01")
+            self.assertEqual(out_of_range.status_code, 404)
+
     def test_new_booking(self):
         """ Test for booking creation """
         fake_booking = bookings.booking_schema.loads(self.new_booking_json)
@@ -63,6 +130,254 @@ class TestBookingService(FlaskTestingCase):
             self.assertEqual(fake_booking.movie, response_booking.movie)
             self.assertEqual(fake_booking.user, response_booking.user)
 
+    def test_bulk_bookings_ndjson(self):
+        """ Bookings streamed as NDJSON are inserted line by line """
+        lines = ['{"date": "2019-12-01", "movie": 1, "user": 5}',
+                 'not json',
+                 '',
+                 '{"date": "2019-12-02", "movie": 2, "user": 5,'
+                 ' "rewarded": true}']
+        with bookings.app.test_client() as bulk_route:
+            response = bulk_route.post(
+                f"{self.url}/bulk", data="\n".join(lines),
+                content_type="application/x-ndjson")
+            report = response.get_json()
+
+        self.assertEqual(report["inserted"], 2)
+        self.assertEqual([error["row"] for error in report["errors"]], [2])
+        user_bookings = bookings.Booking.query.filter_by(user=5).all()
+        self.assertEqual([b.rewarded for b in user_bookings], [False, True])
+
+    def test_new_booking_outbox(self):
+        """ A new booking queues its reward point instead of calling Rewards """
+        with mock.patch.object(bookings, "add_to_users_scores") as add_scores:
+            with bookings.app.test_client() as new_booking_route:
+                response = new_booking_route.post(self.post_url,
+                                                  data=self.new_booking_json)
+            add_scores.assert_not_called()
+
+        self.assertFalse(response.get_json()["rewarded"])
+        entry = bookings.RewardOutbox.query.one()
+        self.assertEqual(entry.booking, response.get_json()["id"])
+        self.assertEqual((entry.user, entry.points), (4, 1))
+
+    def test_idempotent_new_booking(self):
+        """ A retry with the same Idempotency-Key books once """
+        headers = {"Idempotency-Key": "booking-4-5"}
+        with bookings.app.test_client() as new_booking_route:
+            first = new_booking_route.post(self.post_url, headers=headers,
+                                           data=self.new_booking_json)
+            # answered from memory, then from the table after a restart
+            retry = new_booking_route.post(self.post_url, headers=headers,
+                                           data=self.new_booking_json)
+            bookings.idempotency_cache.clear()
+            later_retry = new_booking_route.post(self.post_url, headers=headers,
+                                                 data=self.new_booking_json)
+            other_request = new_booking_route.post(
+                self.post_url, headers=headers,
+                data=self.new_booking_json.replace("5", "6"))
+
+        self.assertEqual(first.status_code, 200)
+        self.assertNotIn("Idempotent-Replayed", first.headers)
+        for replayed in (retry, later_retry):
+            self.assertEqual(replayed.status_code, 200)
+            self.assertEqual(replayed.headers["Idempotent-Replayed"], "true")
+            self.assertEqual(replayed.get_data(), first.get_data())
+        self.assertEqual(other_request.status_code, 422)
+        self.assertEqual(bookings.Booking.query.filter_by(user=4).count(), 1)
+        self.assertEqual(bookings.RewardOutbox.query.count(), 1)
+
+    def test_idempotency_key_expiry(self):
+        """ A response read back from the table is cached only for the time
+            its record has left
+        """
+        headers = {"Idempotency-Key": "booking-4-5"}
+        with bookings.app.test_client() as new_booking_route:
+            new_booking_route.post(self.post_url, headers=headers,
+                                   data=self.new_booking_json)
+            record = bookings.IdempotentResponse.query.get("booking-4-5")
+            record.created -= datetime_timedelta(
+                seconds=bookings.IDEMPOTENCY_TTL - 0.2)
+            bookings.db.session.commit()
+            bookings.idempotency_cache.clear()
+
+            replayed = new_booking_route.post(self.post_url, headers=headers,
+                                              data=self.new_booking_json)
+            time.sleep(0.3)
+            expired = new_booking_route.post(self.post_url, headers=headers,
+                                             data=self.new_booking_json)
+
+        self.assertEqual(replayed.headers["Idempotent-Replayed"], "true")
+        self.assertEqual(expired.status_code, 200)
+        self.assertNotIn("Idempotent-Replayed", expired.headers)
+        self.assertEqual(bookings.Booking.query.filter_by(user=4).count(), 2)
+
+    def test_purge_idempotency_keys(self):
+        """ Expired idempotency keys are deleted and book again """
+        headers = {"Idempotency-Key": "booking-4-5"}
+        with bookings.app.test_client() as new_booking_route:
+            new_booking_route.post(self.post_url, headers=headers,
+                                   data=self.new_booking_json)
+            record = bookings.IdempotentResponse.query.get("booking-4-5")
+            record.created -= datetime_timedelta(
+                seconds=bookings.IDEMPOTENCY_TTL + 1)
+            bookings.db.session.commit()
+            bookings.idempotency_cache.clear()
+
+            self.assertEqual(bookings.purge_idempotency_keys(), 1)
+            response = new_booking_route.post(self.post_url, headers=headers,
+                                              data=self.new_booking_json)
+            too_long = new_booking_route.post(
+                self.post_url, headers={"Idempotency-Key": "k" * 256},
+                data=self.new_booking_json)
+
+        self.assertNotIn("Idempotent-Replayed", response.headers)
+        self.assertEqual(too_long.status_code, 400)
+        self.assertEqual(bookings.Booking.query.filter_by(user=4).count(), 2)
+
+    def test_drain_outbox(self):
+        """ Acknowledged points flag the booking and leave the outbox """
+        for user in (1, 4):
+            booking = bookings.Booking(user=user, movie=1,
+                                       date=datetime_date(2019, 11, 4))
+            bookings.db.session.add(booking)
+            bookings.db.session.flush()
+            bookings.db.session.add(bookings.RewardOutbox(
+                booking=booking.id, user=user, points=1))
+        bookings.db.session.commit()
+
+        unavailable = ServiceUnavailable("The Rewards service is unavailable.")
+        with mock.patch.object(bookings, "add_to_users_scores",
+                               side_effect=[unavailable, {4}]) as add_scores:
+            self.assertEqual(bookings.drain_outbox(), 0)
+            self.assertEqual(
+                [entry.attempts for entry in bookings.RewardOutbox.query], [1, 1])
+
+            self.assertEqual(bookings.drain_outbox(), 2)
+            add_scores.assert_called_with([("booking-4", 1, 1),
+                                           ("booking-5", 4, 1)])
+
+        self.assertEqual(bookings.RewardOutbox.query.count(), 0)
+        self.assertTrue(bookings.Booking.query.get(4).rewarded)
+        self.assertFalse(bookings.Booking.query.get(5).rewarded)
+
+    def test_refused_points_are_parked(self):
+        """ Points the Rewards service refuses stop holding up the outbox """
+        for user in (1, 4):
+            booking = bookings.Booking(user=user, movie=1,
+                                       date=datetime_date(2019, 11, 4))
+            bookings.db.session.add(booking)
+            bookings.db.session.flush()
+            bookings.db.session.add(bookings.RewardOutbox(
+                booking=booking.id, user=user, points=1))
+        bookings.db.session.commit()
+
+        def answer(status):
+            response = requests.Response()
+            response.status_code = status
+            response._content = b'{"not_found": []}'
+            return response
+
+        replies = [answer(400), answer(200), answer(400)]
+        with mock.patch.object(bookings.client, "post",
+                               side_effect=replies) as post:
+            self.assertEqual(bookings.drain_outbox(), 2)
+
+        self.assertEqual([[delta["id"] for delta in call.kwargs["json"]]
+                          for call in post.call_args_list],
+                         [["booking-4", "booking-5"], ["booking-4"],
+                          ["booking-5"]])
+        self.assertEqual(bookings.RewardOutbox.query.count(), 0)
+        self.assertTrue(bookings.Booking.query.get(4).rewarded)
+        parked = bookings.ParkedReward.query.one()
+        self.assertEqual((parked.booking, parked.status), (5, 400))
+        self.assertFalse(bookings.Booking.query.get(5).rewarded)
+
+        with mock.patch.object(bookings.client, "post",
+                               return_value=answer(429)):
+            with self.assertRaises(ServiceUnavailable):
+                bookings.add_to_users_scores([("booking-6", 1, 1)])
+
+    def test_single_outbox_dispatcher(self):
+        """ Dispatchers sharing a lock file take turns """
+        running = []
+        stop = threading.Event()
+
+        def fake_dispatcher():
+            running.append(threading.current_thread())
+            stop.wait(5)
+
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch.object(bookings, "run_outbox_dispatcher",
+                                  side_effect=fake_dispatcher):
+            lock_path = join(tmp_dir, "outbox.lock")
+            first = bookings.start_outbox_dispatcher(lock_path)
+            while not running:
+                first.join(0.01)
+            second = bookings.start_outbox_dispatcher(lock_path)
+            second.join(0.2)
+            self.assertEqual(running, [first])
+
+            # the lock is released when the dispatcher holding it ends
+            stop.set()
+            first.join(5)
+            second.join(5)
+            self.assertEqual(running, [first, second])
+
+    def test_upgrade_schema(self):
+        """ Test indexes are added to a bookings table created without them """
+        for index in bookings.Booking.__table__.indexes:
+            index.drop(bind=bookings.db.engine)
+
+        upgrade_schema(bookings.db)
+
+        index_names = {index["name"] for index in
+                       inspect(bookings.db.engine).get_indexes("booking")}
+        self.assertEqual(index_names,
+                         {"ix_booking_user_date", "ix_booking_movie_date",
+                          "ix_booking_date_id"})
+
+    def test_date_range_uses_index(self):
+        """ Listing a period alone searches an index instead of the table """
+        plan = bookings.db.session.execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM booking "
+            "WHERE date >= '2019-11-01' AND date <= '2019-11-07' AND id > 0 "
+            "ORDER BY id LIMIT 100").fetchall()
+        self.assertIn("INDEX ix_booking_date_id (date>? AND date<?)",
+                      " ".join(row[-1] for row in plan))
+
+    def test_sqlite_pragmas(self):
+        """ Every connection gets the pragmas, with the app's own values """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            app = Flask(__name__)
+            app.config['SQLALCHEMY_DATABASE_URI'] = \
+                f"sqlite:///{join(tmp_dir, 'tuned.db')}"
+            app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+            app.config['SQLITE_PRAGMAS'] = {'cache_size': -1000,
+                                            'mmap_size': None}
+            tune_sqlite(app)
+            tuned_db = SQLAlchemy(app)
+
+            with app.app_context():
+                pragma = lambda name: tuned_db.session.execute(
+                    f"PRAGMA {name}").scalar()
+                self.assertEqual(pragma("journal_mode"), "wal")
+                self.assertEqual(pragma("synchronous"), 1)  # NORMAL
+                self.assertEqual(pragma("busy_timeout"), 5000)
+                self.assertEqual(pragma("cache_size"), -1000)
+                self.assertEqual(pragma("mmap_size"), 0)
+                tuned_db.session.remove()
+                tuned_db.get_engine().dispose()
+
+    def test_database_dir(self):
+        """ CINEMA_DATABASE_DIR moves the service databases """
+        with mock.patch.dict("os.environ", {"CINEMA_DATABASE_DIR": "/tmp/run"}):
+            self.assertEqual(database_uri("bookings"),
+                             "sqlite:////tmp/run/bookings.db")
+        with mock.patch.dict("os.environ", clear=True):
+            self.assertTrue(database_uri("bookings").endswith(
+                "/database/bookings.db"))
+
     def test_not_found(self):
         """ Test /showtimes/<date> for non-existent users"""
         invalid_user = "999"
@@ -0,0 +1,51 @@
+from unittest import TestCase, main, mock
+from services.cache import LRUCache
+
+
+class TestLRUCache(TestCase):
+    """ Tests for the in-process cache """
+
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.stats()["size"], 2)
+
+    def test_entries_expire(self):
+        cache = LRUCache(ttl=10)
+        with mock.patch("services.cache.time.monotonic", return_value=100):
+            cache.set("a", 1)
+        with mock.patch("services.cache.time.monotonic", return_value=105):
+            self.assertEqual(cache.get("a"), 1)
+        with mock.patch("services.cache.time.monotonic", return_value=111):
+            self.assertIsNone(cache.get("a"))
+
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]),
+                         (1, 1, 0))
+
+    def test_membership_is_not_counted(self):
+        cache = LRUCache(maxsize=2, ttl=10)
+        with mock.patch("services.cache.time.monotonic", return_value=100):
+            cache.set("a", 1)
+            cache.set("b", 2)
+            self.assertIn("a", cache)
+            self.assertNotIn("c", cache)
+            # checking "a" did not make it recently used
+            cache.set("c", 3)
+            self.assertNotIn("a", cache)
+        with mock.patch("services.cache.time.monotonic", return_value=111):
+            self.assertNotIn("b", cache)
+
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (0, 0))
+
+
+if __name__ == "__main__":
+    main()
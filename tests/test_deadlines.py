@@ -0,0 +1,76 @@
+from unittest import TestCase, main
+import requests
+from requests.adapters import BaseAdapter
+from flask import Flask
+from services import deadlines
+from services.http_client import ServiceClient
+
+
+class RecordingAdapter(BaseAdapter):
+    """ Answers every request with 200, keeping the headers it was sent """
+
+    def __init__(self):
+        super().__init__()
+        self.headers = []
+
+    def send(self, request, **kwargs):
+        self.headers.append(request.headers)
+        response = requests.Response()
+        response.status_code = 200
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+class TestDeadlines(TestCase):
+    """ Tests for the time budgets handed down between the services """
+
+    def setUp(self):
+        self.adapter = RecordingAdapter()
+        client = ServiceClient(retries=0)
+        client.session.mount("http://rewards.test", self.adapter)
+
+        self.app = Flask(__name__)
+        deadlines.enable_deadlines(self.app)
+
+        @self.app.route("/bookings/<user>")
+        def bookings(user):
+            client.get("http://rewards.test/rewards")
+            return user
+
+    def test_budget_is_propagated(self):
+        """ The callee gets what is left of the budget """
+        with self.app.test_client() as client:
+            response = client.get("/bookings/1",
+                                  headers={"X-Request-Budget-Ms": "500"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(
+            int(self.adapter.headers[0]["X-Request-Budget-Ms"]), 500)
+        self.assertIsNone(deadlines.remaining())
+
+    def test_exhausted_budget(self):
+        """ Too little time left gets a 503 marked as such, without calls """
+        with self.app.test_client() as client:
+            response = client.get("/bookings/1",
+                                  headers={"X-Request-Budget-Ms": "2"})
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers[deadlines.BUDGET_EXHAUSTED_HEADER],
+                         "1")
+        self.assertEqual(self.adapter.headers, [])
+
+    def test_malformed_budget(self):
+        """ Budgets that are not finite numbers are refused """
+        with self.app.test_client() as client:
+            for malformed in ("nan", "inf", "-inf", "soon"):
+                response = client.get(
+                    "/bookings/1", headers={"X-Request-Budget-Ms": malformed})
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.adapter.headers, [])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+from unittest import TestCase, main
+import time
+import requests
+from requests.adapters import BaseAdapter
+from services import deadlines
+from services.http_client import CircuitOpen, DeadlineExceeded, ServiceClient
+
+
+class FakeAdapter(BaseAdapter):
+    """ Answers requests from a script of outcomes instead of the network """
+
+    def __init__(self, outcomes):
+        super().__init__()
+        self.outcomes = list(outcomes)
+        self.sent = []
+
+    def send(self, request, **kwargs):
+        self.sent.append((request, kwargs))
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        response = requests.Response()
+        if isinstance(outcome, tuple):
+            outcome, headers = outcome
+            response.headers.update(headers)
+        response.status_code = outcome
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+class TestServiceClient(TestCase):
+    """ Tests for the HTTP client shared by the services """
+
+    def setUp(self):
+        self.url = "http://rewards.test/rewards/add_score"
+        self.client = ServiceClient(retries=2, backoff=0)
+
+    def mount(self, *outcomes):
+        adapter = FakeAdapter(outcomes)
+        self.client.session.mount("http://rewards.test", adapter)
+        return adapter
+
+    def test_get_is_retried(self):
+        """ Idempotent calls survive connection errors and busy statuses """
+        adapter = self.mount(requests.exceptions.ConnectionError(), 503, 200)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(adapter.sent), 3)
+
+    def test_retries_are_bounded(self):
+        """ The last failure is raised once the retries are spent """
+        self.mount(*[requests.exceptions.ConnectTimeout()] * 3)
+        with self.assertRaises(requests.exceptions.ConnectTimeout):
+            self.client.get(self.url)
+
+    def test_post_is_sent_once(self):
+        """ Non idempotent calls are never repeated """
+        adapter = self.mount(requests.exceptions.ReadTimeout(), 200)
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            self.client.post(self.url, json={"user": 1, "add_to_score": 1})
+        self.assertEqual(len(adapter.sent), 1)
+
+    def test_timeouts_and_latency(self):
+        """ Every call carries timeouts and is timed per destination """
+        adapter = self.mount(200, 500)
+        self.client.get(self.url, retries=0)
+        self.client.get(self.url, retries=0)
+
+        self.assertEqual(adapter.sent[0][1]["timeout"], self.client.timeout)
+        report = self.client.latency_report()["rewards.test"]
+        self.assertEqual(report["calls"], 2)
+        self.assertEqual(report["errors"], 1)
+
+        bucket_counts, _, calls, errors = \
+            self.client.latency_histograms()["rewards.test"]
+        self.assertEqual((sum(bucket_counts), calls, errors), (2, 2, 1))
+
+    def test_circuit_breaker(self):
+        """ A failing destination is not called until a trial call succeeds """
+        client = ServiceClient(retries=0, failure_threshold=2,
+                               reset_timeout=0.05)
+        adapter = FakeAdapter([requests.exceptions.ConnectionError(), 500,
+                               200])
+        client.session.mount("http://rewards.test", adapter)
+
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            client.get(self.url)
+        client.get(self.url)
+        with self.assertRaises(CircuitOpen):
+            client.get(self.url)
+        self.assertEqual(len(adapter.sent), 2)
+        self.assertEqual(client.circuit_report(), {"rewards.test": "open"})
+
+        time.sleep(0.05)
+        self.assertEqual(client.get(self.url).status_code, 200)
+        self.assertEqual(client.circuit_report(), {"rewards.test": "closed"})
+
+    def test_failed_trial_reopens_circuit(self):
+        """ A trial call failing with any error reopens the circuit """
+        client = ServiceClient(retries=0, failure_threshold=1,
+                               reset_timeout=0.05)
+        adapter = FakeAdapter([500, requests.exceptions.ChunkedEncodingError(),
+                               200])
+        client.session.mount("http://rewards.test", adapter)
+
+        client.get(self.url)
+        time.sleep(0.05)
+        with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+            client.get(self.url)
+        self.assertEqual(client.circuit_report(), {"rewards.test": "open"})
+        with self.assertRaises(CircuitOpen):
+            client.get(self.url)
+
+        time.sleep(0.05)
+        self.assertEqual(client.get(self.url).status_code, 200)
+        self.assertEqual(client.circuit_report(), {"rewards.test": "closed"})
+
+    def test_deadline(self):
+        """ Calls pass the time left on and are not sent once it ran out """
+        adapter = self.mount(200)
+        token = deadlines.current_deadline.set(time.monotonic() + 1.0)
+        try:
+            self.client.get(self.url)
+            request, kwargs = adapter.sent[0]
+            self.assertLessEqual(
+                int(request.headers[deadlines.BUDGET_HEADER]), 1000)
+            self.assertLessEqual(max(kwargs["timeout"]), 1.0)
+
+            deadlines.current_deadline.set(time.monotonic())
+            with self.assertRaises(DeadlineExceeded):
+                self.client.get(self.url)
+            self.assertEqual(len(adapter.sent), 1)
+        finally:
+            deadlines.current_deadline.reset(token)
+
+    def test_exhausted_budget_is_not_a_failure(self):
+        """ A callee turning down a caller out of time keeps its circuit
+            closed and is not asked again
+        """
+        exhausted = (503, {deadlines.BUDGET_EXHAUSTED_HEADER: "1"})
+        client = ServiceClient(retries=2, backoff=0, failure_threshold=2)
+        adapter = FakeAdapter([exhausted] * 3)
+        client.session.mount("http://rewards.test", adapter)
+
+        for _ in range(2):
+            self.assertEqual(client.get(self.url).status_code, 503)
+        self.assertEqual(len(adapter.sent), 2)
+        self.assertEqual(client.circuit_report(), {"rewards.test": "closed"})
+        self.assertEqual(client.latency_report()["rewards.test"]["errors"], 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+from unittest import TestCase, main
+from flask import Flask
+from flask_sqlalchemy import SQLAlchemy
+from services.instrumentation import instrument
+
+
+class TestInstrumentation(TestCase):
+    """ Tests for the metrics the services serve at /metrics """
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///:memory:"
+        self.app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        db = SQLAlchemy(self.app)
+        instrument(self.app)
+
+        @self.app.route("/items/<item>")
+        def item(item):
+            db.session.execute("SELECT 1")
+            db.session.execute("SELECT 2")
+            return item
+
+        @self.app.route("/broken")
+        def broken():
+            raise RuntimeError("broken")
+
+    def scrape(self, client):
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        return response.get_data(as_text=True).splitlines()
+
+    def test_request_metrics(self):
+        """ Statuses, durations and queries are labelled by route template """
+        with self.app.test_client() as client:
+            client.get("/items/1")
+            client.get("/items/2")
+            client.get("/broken")
+            client.get("/missing")
+            lines = self.scrape(client)
+
+        self.assertIn('http_requests_total{method="GET",route="/items/<item>",'
+                      'status="200"} 2', lines)
+        self.assertIn('http_requests_total{method="GET",route="/broken",'
+                      'status="500"} 1', lines)
+        self.assertIn('http_requests_total{method="GET",route="unmatched",'
+                      'status="404"} 1', lines)
+        self.assertIn('http_request_duration_seconds_count{method="GET",'
+                      'route="/items/<item>"} 2', lines)
+        # each request ran 2 queries
+        self.assertIn('sql_queries_per_request_bucket{route="/items/<item>",'
+                      'le="1"} 0', lines)
+        self.assertIn('sql_queries_per_request_bucket{route="/items/<item>",'
+                      'le="2"} 2', lines)
+        self.assertIn('sql_queries_per_request_sum{route="/items/<item>"} 4',
+                      lines)
+        # the scrape itself is in flight while the metrics are rendered
+        self.assertIn('http_requests_in_flight{method="GET",'
+                      'route="/metrics"} 1', lines)
+        self.assertIn('http_requests_in_flight{method="GET",'
+                      'route="/items/<item>"} 0', lines)
+
+    def test_queries_outside_requests(self):
+        """ Queries run in an app context still count in the totals """
+        with self.app.app_context():
+            self.app.extensions['sqlalchemy'].db.session.execute("SELECT 1")
+        with self.app.test_client() as client:
+            lines = self.scrape(client)
+
+        self.assertIn("sql_queries_total 1", lines)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,8 @@
 from flask_testing import TestCase as FlaskTestingCase
-from unittest import main
+from unittest import main, mock
 import requests
 import json
-from flask import Flask
+from sqlalchemy.exc import OperationalError
 from services import movies
 movies.testing = True
 
@@ -11,12 +11,10 @@ class TestMoviesService(FlaskTestingCase):
 
     def create_app(self):
         """ Dynamically bind a fake  database to real application """
-        app = Flask(__name__)
+        app = movies.app
         app.config['TESTING'] = True
-        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        # every request of the test client now hits this in-memory database
         app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///:memory:"
-        movies.db.init_app(app)
-        app.app_context().push()  # this does the binding
         return app
 
     def setUp(self):
@@ -25,6 +23,9 @@ class TestMoviesService(FlaskTestingCase):
         self.post_url = "http://localhost:5001/movies/new"
         self.new_movie_json = """{"director": "Alfonso Cuaron", "id": 4, "rating": 10, "title": "Children of Men"}"""
         movies.db.create_all()
+        # forget what previous tests left in the caches
+        movies.catalog["version"] = None
+        movies.movie_cache.clear()
         self.populate_db()
 
     def tearDown(self):
@@ -58,6 +59,139 @@ class TestMoviesService(FlaskTestingCase):
                     response.get_json()),
                 self.new_movie_json)
 
+    def test_bulk_movies(self):
+        """ Valid movies are inserted, invalid ones reported by row """
+        new_movies = [
+            {"director": "Alfonso Cuaron", "rating": 10, "title": "Roma"},
+            {"director": "Alfonso Cuaron", "rating": "ten", "title": "Gravity"},
+            {"director": "Bong Joon-ho", "id": 1, "rating": 9,
+             "title": "Parasite"},
+            {"director": "Bong Joon-ho", "rating": 8, "title": "Mother"}]
+        version = movies.catalog_version()
+        with movies.app.test_client() as bulk_route:
+            response = bulk_route.post(f"{self.url}/bulk?chunk_size=2",
+                                       json=new_movies)
+            report = response.get_json()
+
+        self.assertEqual(report["inserted"], 2)
+        # bumped by each of the two transactions that inserted a movie
+        self.assertEqual(movies.CatalogVersion.query.get(1).version,
+                         version + 2)
+        self.assertEqual([error["row"] for error in report["errors"]], [2, 3])
+        self.assertIn("rating", report["errors"][0]["errors"])
+        self.assertEqual(
+            sorted(movie.title for movie in movies.Movie.query)[-2:],
+            ["Roma", "Waking Life"])
+        self.assertEqual(movies.Movie.query.count(), 5)
+
+    def test_conditional_get(self):
+        """ Catalog responses carry an ETag honoured until the catalog changes """
+        with movies.app.test_client() as movie_list_route:
+            first = movie_list_route.get(self.url)
+            etag = first.headers["ETag"]
+            self.assertIn("must-revalidate", first.headers["Cache-Control"])
+            self.assertEqual(first.headers["Vary"], "Accept")
+
+            with mock.patch.object(movies.Movie, "query") as query:
+                cached = movie_list_route.get(
+                    self.url, headers={"If-None-Match": etag})
+                misses = movies.movie_cache.stats()["misses"]
+                detail = movie_list_route.get(
+                    f"{self.url}/1", headers={"If-None-Match": etag})
+                # the cache is only peeked at, its figures are left alone
+                self.assertEqual(movies.movie_cache.stats()["misses"], misses)
+                query.all.assert_not_called()
+                query.get.assert_not_called()
+            self.assertEqual(cached.status_code, 304)
+            self.assertEqual(detail.status_code, 304)
+
+            missing = movie_list_route.get(
+                f"{self.url}/999", headers={"If-None-Match": etag})
+            self.assertEqual(missing.status_code, 404)
+
+            pretty = movie_list_route.get(
+                f"{self.url}?pretty=1", headers={"If-None-Match": etag})
+            self.assertEqual(pretty.status_code, 200)
+
+            movie_list_route.post(self.post_url, data=self.new_movie_json)
+            changed = movie_list_route.get(
+                self.url, headers={"If-None-Match": etag})
+            self.assertEqual(changed.status_code, 200)
+            self.assertNotEqual(changed.headers["ETag"], etag)
+            self.assertEqual(len(changed.get_json()), 4)
+
+    def test_movie_list_ndjson(self):
+        """ The catalog is streamed one movie per line when NDJSON is accepted,
+            the ETag of the JSON document does not apply to it
+        """
+        with movies.app.test_client() as movie_list_route:
+            etag = movie_list_route.get(self.url).headers["ETag"]
+            response = movie_list_route.get(
+                self.url, headers={"Accept": "application/x-ndjson",
+                                   "If-None-Match": etag})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        self.assertEqual(response.headers["Vary"], "Accept")
+        titles = [json.loads(line)["title"]
+                  for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual(titles, ["Boyhood", "Before Sunset", "Waking Life"])
+
+    def test_movie_cache(self):
+        """ Cached movies skip the ORM until the catalog changes """
+        before = movies.movie_cache.stats()
+        with movies.app.test_client() as movie_route:
+            first = movie_route.get(f"{self.url}/1")
+            with mock.patch.object(movies.Movie, "query") as query:
+                second = movie_route.get(f"{self.url}/1")
+                query.get.assert_not_called()
+            self.assertEqual(first.get_data(), second.get_data())
+
+            stats = movie_route.get("/cache").get_json()
+            self.assertEqual(stats["hits"] - before["hits"], 1)
+            self.assertEqual(stats["misses"] - before["misses"], 1)
+
+            movie_route.post(self.post_url, data=self.new_movie_json)
+            self.assertEqual(movie_route.get("/cache").get_json()["size"], 0)
+            self.assertEqual(len(movie_route.get(self.url).get_json()), 4)
+
+    def test_movie_lookup(self):
+        """ Movies come back in the order asked, missing ones reported """
+        with movies.app.test_client() as lookup_route:
+            response = lookup_route.get("/movies?ids=3,999,1,3")
+            self.assertEqual(response.status_code, 200)
+            result = response.get_json()
+            self.assertEqual([movie["id"] for movie in result["movies"]], [3, 1])
+            self.assertEqual(result["movies"][0]["title"], "Waking Life")
+            self.assertEqual(result["not_found"], [999])
+
+            # the POST form answers the same, from the cache this time
+            with mock.patch.object(movies.Movie, "query") as query:
+                query.filter.return_value = []
+                response = lookup_route.post("/movies/lookup",
+                                             json={"ids": [3, 999, 1]})
+                self.assertEqual(response.get_json(), result)
+                # only the missing id had to be asked to the database
+                query.filter.assert_called_once()
+
+            response = lookup_route.get("/movies?ids=1,x")
+            self.assertEqual(response.status_code, 400)
+            response = lookup_route.post("/movies/lookup", json={"ids": "1"})
+            self.assertEqual(response.status_code, 400)
+
+    def test_health(self):
+        """ Readiness follows the database, liveness does not """
+        with movies.app.test_client() as health_route:
+            self.assertEqual(health_route.get("/health/live").status_code, 200)
+            self.assertEqual(health_route.get("/health/ready").status_code, 200)
+
+            with mock.patch.object(movies.db.session, "execute",
+                                   side_effect=OperationalError(
+                                       "SELECT 1", {}, None)):
+                response = health_route.get("/health/ready")
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(health_route.get("/health/live").status_code, 200)
+
     def test_not_found(self):
         """ test GET a invalid movie """
         invalid_movie = "999"
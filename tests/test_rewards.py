@@ -1,9 +1,9 @@
 from flask_testing import TestCase as FlaskTestingCase
 from http import HTTPStatus as http_status
-from unittest import main
+from unittest import main, mock
 import requests
 import json
-from flask import Flask
+from sqlalchemy import event
 from services import rewards
 rewards.testing = True
 
@@ -13,12 +13,10 @@ class TestRewardService(FlaskTestingCase):
 
     def create_app(self):
         """ Dynamically bind a fake  database to real application """
-        app = Flask(__name__)
+        app = rewards.app
         app.config['TESTING'] = True
-        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        # every request of the test client now hits this in-memory database
         app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///:memory:"
-        rewards.db.init_app(app)
-        app.app_context().push()  # this does the binding
         return app
 
     def setUp(self):
@@ -30,6 +28,7 @@ class TestRewardService(FlaskTestingCase):
         self.new_score_json = """{"score": 1, "user": 1}"""
         # to test if prize is available
         rewards.db.create_all()
+        rewards.prize_tiers_cache.clear()
         self.populate_db()
 
     def tearDown(self):
@@ -66,6 +65,101 @@ class TestRewardService(FlaskTestingCase):
             self.assertEqual(expected_record.user, response_record.user)
             self.assertEqual(expected_record.score, response_record.score)
 
+    def test_add_score_errors(self):
+        """ Unknown users get a 404 and malformed deltas a 400 """
+        with rewards.app.test_client() as add_score_route:
+            unknown = add_score_route.post(
+                self.post_score_url, json={"user": 999, "add_to_score": 1})
+            self.assertEqual(http_status.NOT_FOUND, unknown.status_code)
+
+            invalid = add_score_route.post(
+                self.post_score_url, json={"user": 1, "add_to_score": "a"})
+            self.assertEqual(http_status.BAD_REQUEST, invalid.status_code)
+
+    def test_increment_score_without_returning(self):
+        """ Older SQLite versions read the score back after the UPDATE """
+        with mock.patch.object(rewards, "SUPPORTS_RETURNING", False):
+            self.assertEqual(rewards.increment_score(1, 2), 2)
+            self.assertEqual(rewards.increment_score(1, 3), 5)
+            self.assertIsNone(rewards.increment_score(999, 1))
+        rewards.db.session.commit()
+        self.assertEqual(rewards.Reward.query.get(1).score, 5)
+
+    def test_add_scores(self):
+        """ Many deltas are applied at once and unknown users reported """
+        deltas = [{"user": 1, "add_to_score": 2},
+                  {"user": 3, "add_to_score": 1},
+                  {"user": 1, "add_to_score": 1},
+                  {"user": 999, "add_to_score": 1}]
+        with rewards.app.test_client() as add_scores_route:
+            response = add_scores_route.post(
+                f"{self.url}/add_scores", json=deltas)
+            self.assertEqual(http_status.OK, response.status_code)
+            self.assertEqual(response.get_json(), {
+                "not_found": [999],
+                "rewards": [{"score": 3, "user": 1},
+                            {"score": 1, "user": 3}]})
+
+            invalid = add_scores_route.post(
+                f"{self.url}/add_scores", json=[{"user": 1}])
+            self.assertEqual(http_status.BAD_REQUEST, invalid.status_code)
+
+        self.assertEqual(rewards.Reward.query.get(1).score, 3)
+        self.assertEqual(rewards.Reward.query.get(2).score, 0)
+
+    def test_add_scores_once(self):
+        """ A delta sent again with the same id is not added twice """
+        deltas = [{"user": 1, "add_to_score": 2, "id": "booking-1"},
+                  {"user": 1, "add_to_score": 2, "id": "booking-1"},
+                  {"user": 3, "add_to_score": 1, "id": "booking-2"},
+                  {"user": 999, "add_to_score": 1, "id": "booking-3"}]
+        with rewards.app.test_client() as add_scores_route:
+            first = add_scores_route.post(f"{self.url}/add_scores", json=deltas)
+            again = add_scores_route.post(f"{self.url}/add_scores", json=deltas)
+            invalid = add_scores_route.post(f"{self.url}/add_scores", json=[
+                {"user": 1, "add_to_score": 1, "id": ""}])
+
+        self.assertEqual(first.get_json()["rewards"],
+                         [{"score": 2, "user": 1}, {"score": 1, "user": 3}])
+        # points of unknown users are not recorded as applied
+        self.assertEqual(again.get_json(), {"not_found": [999], "rewards": []})
+        self.assertEqual(http_status.BAD_REQUEST, invalid.status_code)
+        self.assertEqual(rewards.Reward.query.get(1).score, 2)
+        self.assertEqual(sorted(delta.id for delta in
+                                rewards.AppliedDelta.query),
+                         ["booking-1", "booking-2"])
+
+    def test_leaderboard(self):
+        """ The top users come best first, users with the same score sharing
+            their rank, which follows every change of score
+        """
+        with rewards.app.test_client() as leaderboard_route:
+            leaderboard_route.post(f"{self.url}/add_scores", json=[
+                {"user": 2, "add_to_score": 5}, {"user": 3, "add_to_score": 5}])
+            top = leaderboard_route.get(f"{self.url}/top").get_json()
+            page = leaderboard_route.get(
+                f"{self.url}/top?n=2&offset=1").get_json()
+            ranks = [leaderboard_route.get(f"{self.url}/rank/{user}")
+                     .get_json()["rank"] for user in (1, 2, 3)]
+
+            leaderboard_route.post(f"{self.url}/add_score",
+                                   json={"user": 1, "add_to_score": 6})
+            first = leaderboard_route.get(f"{self.url}/rank/1").get_json()
+            unknown = leaderboard_route.get(f"{self.url}/rank/999")
+            invalid = leaderboard_route.get(f"{self.url}/top?n=0")
+
+        self.assertEqual(top, [{"rank": 1, "score": 5, "user": 2},
+                               {"rank": 1, "score": 5, "user": 3},
+                               {"rank": 3, "score": 0, "user": 1}])
+        self.assertEqual(page, top[1:])
+        self.assertEqual(ranks, [3, 1, 1])
+        self.assertEqual(first, {"rank": 1, "score": 6, "user": 1})
+        self.assertEqual(unknown.status_code, 404)
+        self.assertEqual(invalid.status_code, 400)
+        self.assertEqual(
+            {count.score: count.users for count in rewards.ScoreCount.query},
+            {0: 0, 5: 2, 6: 1})
+
     def test_is_prize_available(self):
         """ This asserts one can only get a prize if one has enough points"""
         user = 2
@@ -81,6 +175,91 @@ class TestRewardService(FlaskTestingCase):
             actual_json_response = json.dumps(response.json)
             self.assertEqual(actual_json_response, expected_json_response)
 
+    def test_prize_tiers(self):
+        """ Users reaching a tier get a prize and are told about the next """
+        rewards.db.session.add(rewards.PrizeTier(name="gold", points=10))
+        rewards.db.session.commit()
+        prize_url = f"{self.url}/prizes"
+        with rewards.app.test_client() as prize_route:
+            prize_route.post(f"{self.url}/add_scores", json=[
+                {"user": 1, "add_to_score": 7}, {"user": 3, "add_to_score": 12}])
+            silver = prize_route.get(f"{prize_url}/1").get_json()
+            batch = prize_route.get(f"{prize_url}?users=3,2,999,3").get_json()
+            unknown = prize_route.get(f"{prize_url}/999")
+
+        self.assertEqual(silver, {"points_until_prize": 3,
+                                  "prize_avaliable": True, "user": 1})
+        self.assertEqual(batch, {
+            "not_found": [999],
+            "prizes": [{"points_until_prize": 5, "prize_avaliable": False,
+                        "user": 2},
+                       {"points_until_prize": 0, "prize_avaliable": True,
+                        "user": 3}]})
+        self.assertEqual(unknown.status_code, 404)
+
+    def test_prizes_single_query(self):
+        """ However many users are asked about, one query reads their scores.
+            Lists too long for the query string are POSTed.
+        """
+        users = list(range(1, 2001))
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with rewards.app.test_client() as prize_route:
+            prize_route.get(f"{self.url}/prizes?users=1")
+            event.listen(rewards.db.engine, "before_cursor_execute", record)
+            try:
+                response = prize_route.post(f"{self.url}/prizes/lookup",
+                                            json={"users": users})
+            finally:
+                event.remove(rewards.db.engine, "before_cursor_execute", record)
+            invalid = prize_route.post(f"{self.url}/prizes/lookup",
+                                       json={"users": ["1"]})
+
+        found = [status["user"] for status in response.get_json()["prizes"]]
+        self.assertEqual(found, [1, 2, 3])
+        self.assertEqual(len(response.get_json()["not_found"]), 1997)
+        self.assertEqual(len([statement for statement in statements
+                              if "FROM reward" in statement]), 1)
+        self.assertEqual(invalid.status_code, 400)
+
+    def test_eligible_users(self):
+        """ Reaching a tier is recorded once, whatever updates the score """
+        with rewards.app.test_client() as eligible_route:
+            eligible_route.post(f"{self.url}/add_score",
+                                json={"user": 2, "add_to_score": 4})
+            eligible_route.post(f"{self.url}/add_scores", json=[
+                {"user": 2, "add_to_score": 1}, {"user": 3, "add_to_score": 9}])
+            eligible_route.post(f"{self.url}/add_score",
+                                json={"user": 3, "add_to_score": 1})
+
+            first_page = eligible_route.get(
+                f"{self.url}/prizes/eligible?since=2019-11-01&limit=1")
+            next_page = eligible_route.get(
+                f"{self.url}/prizes/eligible?after=1")
+            later = eligible_route.get(
+                f"{self.url}/prizes/eligible?since=2999-01-01")
+
+        events = first_page.get_json() + next_page.get_json()
+        self.assertEqual([(event["id"], event["user"], event["points"])
+                          for event in events], [(1, 2, 5), (2, 3, 5)])
+        self.assertIn("after=1", first_page.headers["Link"])
+        self.assertEqual(later.get_json(), [])
+
+    def test_rewards_ndjson(self):
+        """ Rewards are streamed one per line when NDJSON is accepted """
+        with rewards.app.test_client() as reward_list_route:
+            response = reward_list_route.get(
+                self.url, headers={"Accept": "application/x-ndjson"})
+            lines = response.get_data().splitlines()
+            document = reward_list_route.get(self.url)
+
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        self.assertEqual([json.loads(line) for line in lines],
+                         document.get_json())
+
     def test_not_found(self):
         """ Test /rewards/<user> for non-existent users"""
         invalid_user = "999"
@@ -0,0 +1,53 @@
+from unittest import TestCase, main
+import json
+from datetime import date as datetime_date
+from services import bookings, movies, rewards, showtimes, users
+from services.serializers import FastEncoder
+
+
+class TestFastEncoder(TestCase):
+    """ The fast encoder must match marshmallow's output """
+
+    def setUp(self):
+        self.samples = [
+            (bookings.booking_schema, [
+                bookings.Booking(id=1, user=1, movie=1, rewarded=True,
+                                 date=datetime_date(2019, 11, 1)),
+                bookings.Booking(user=2, movie=2,
+                                 date=datetime_date(2019, 11, 2))]),
+            (movies.movie_schema, [
+                movies.Movie(id=1, rating=10, title="Boyhood",
+                             director="Richard Linklater"),
+                movies.Movie(id=2, rating=9, title="Amélie \"Poulain\"",
+                             director="Jean-Pierre Jeunet")]),
+            (rewards.reward_schema, [rewards.Reward(user=1, score=3)]),
+            (showtimes.showtime_schema, [
+                showtimes.Showtime(id=1, movie=1,
+                                   date=datetime_date(2019, 11, 1))]),
+            (users.user_schema, [users.User(id=1, name="Jim Halpert")])]
+
+    def test_pretty_is_byte_compatible(self):
+        """ ?pretty=1 gives exactly what schema.dumps(indent=4) gave """
+        for schema, instances in self.samples:
+            encoder = FastEncoder(schema)
+            many_schema = type(schema)(many=True)
+            self.assertEqual(
+                encoder.dumps_many(instances, pretty=True),
+                many_schema.dumps(instances, sort_keys=True, indent=4))
+            self.assertEqual(
+                encoder.dumps(instances[0], pretty=True),
+                schema.dumps(instances[0], sort_keys=True, indent=4))
+
+    def test_compact_keeps_fields_and_order(self):
+        """ Compact output holds the same sorted fields, without whitespace """
+        for schema, instances in self.samples:
+            compact = FastEncoder(schema).dumps_many(instances)
+            self.assertNotIn("\n", compact)
+            self.assertEqual(
+                compact,
+                json.dumps(json.loads(type(schema)(many=True).dumps(instances)),
+                           sort_keys=True, separators=(",", ":")))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,6 @@ from flask_testing import TestCase as FlaskTestingCase
 from unittest import main
 import requests
 import json
-from flask import Flask
 from services import showtimes
 from datetime import date as datetime_date
 showtimes.testing = True
@@ -13,12 +12,10 @@ class TestMoviesService(FlaskTestingCase):
 
     def create_app(self):
         """ Dynamically bind a fake  database to real application """
-        app = Flask(__name__)
+        app = showtimes.app
         app.config['TESTING'] = True
-        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        # every request of the test client now hits this in-memory database
         app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///:memory:"
-        showtimes.db.init_app(app)
-        app.app_context().push()  # this does the binding
         return app
 
     def setUp(self):
@@ -65,6 +62,45 @@ class TestMoviesService(FlaskTestingCase):
             self.assertEqual(fake_showtime.date, response_showtime.date)
             self.assertEqual(fake_showtime.movie, response_showtime.movie)
 
+    def test_showtimes_schedule(self):
+        """ Test /showtimes?from=&to=&movie= groups showtimes by date """
+        with showtimes.app.test_client() as schedule_route:
+            week = schedule_route.get(
+                f"{self.url}?from=2019-11-01&to=2019-11-07").get_json()
+            self.assertEqual(sorted(week), ["2019-11-01", "2019-11-03"])
+            self.assertEqual([s["movie"] for s in week["2019-11-01"]], [1, 2])
+
+            one_movie = schedule_route.get(
+                f"{self.url}?from=2019-11-01&to=2019-11-07&movie=3").get_json()
+            self.assertEqual(list(one_movie), ["2019-11-03"])
+
+            booked = schedule_route.get(
+                f"{self.url}?from=2019-11-01&to=2019-11-07&movies=2,3").get_json()
+            self.assertEqual([(date, s["movie"]) for date in booked
+                              for s in booked[date]],
+                             [("2019-11-01", 2), ("2019-11-03", 3)])
+
+            bad_range = schedule_route.get(f"{self.url}?from=01/11/2019")
+            self.assertEqual(bad_range.status_code, 400)
+
+            looked_up = schedule_route.post(f"{self.url}/lookup", json={
+                "from": "2019-11-01", "to": "2019-11-07", "movies": [3, 2]})
+            self.assertEqual(looked_up.get_json(), booked)
+            bad_lookup = schedule_route.post(f"{self.url}/lookup", json={
+                "from": "2019-11-01", "movies": "2,3"})
+            self.assertEqual(bad_lookup.status_code, 400)
+
+    def test_showtimes_ndjson(self):
+        """ Showtimes are streamed one per line when NDJSON is accepted """
+        with showtimes.app.test_client() as showtime_list_route:
+            response = showtime_list_route.get(
+                f"{self.url}?from=2019-11-01&to=2019-11-01",
+                headers={"Accept": "application/x-ndjson"})
+
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line)["movie"] for line in lines], [1, 2])
+
     def test_not_found(self):
         """ GET a invalid showtime """
         invalid_showtime = "2018-01-01"
@@ -0,0 +1,107 @@
+from unittest import TestCase, main
+import os
+import tempfile
+import requests
+from requests.adapters import BaseAdapter
+from flask import Flask
+from services import tracing
+from services.http_client import ServiceClient
+
+
+class EchoAdapter(BaseAdapter):
+    """ Answers every request with 200, keeping the headers it was sent """
+
+    def __init__(self):
+        super().__init__()
+        self.headers = []
+
+    def send(self, request, **kwargs):
+        self.headers.append(request.headers)
+        response = requests.Response()
+        response.status_code = 200
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+class TestTracing(TestCase):
+    """ Tests for the request ids and spans shared by the services """
+
+    def setUp(self):
+        self.trace_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.trace_dir.cleanup)
+        self.adapter = EchoAdapter()
+        client = ServiceClient(retries=0)
+        client.session.mount("http://rewards.test", self.adapter)
+
+        self.app = Flask(__name__)
+        self.app.config['TRACE_DIR'] = self.trace_dir.name
+        tracing.enable_tracing(self.app, "bookings")
+
+        @self.app.route("/bookings/<user>")
+        def bookings(user):
+            client.get("http://rewards.test/rewards")
+            return user
+
+    def test_request_id_is_propagated(self):
+        """ The request id of the caller is answered and passed on """
+        with self.app.test_client() as client:
+            response = client.get("/bookings/1",
+                                  headers={"X-Request-ID": "booking-42"})
+
+        self.assertEqual(response.headers["X-Request-ID"], "booking-42")
+        self.assertEqual(self.adapter.headers[0]["X-Request-ID"], "booking-42")
+
+        spans = tracing.read_spans(self.trace_dir.name)["booking-42"]
+        self.assertEqual(sorted((span["kind"], span["name"]) for span in spans),
+                         [("client", "GET rewards.test/rewards"),
+                          ("server", "GET /bookings/<user>")])
+        lines = tracing.waterfall(spans)
+        self.assertTrue(lines[0].startswith("request booking-42"))
+        self.assertEqual(len(lines), 3)
+
+    def test_request_id_is_generated(self):
+        """ Requests without a usable id get a new one """
+        with self.app.test_client() as client:
+            first = client.get("/bookings/1")
+            second = client.get("/bookings/1",
+                                headers={"X-Request-ID": "bad id;" * 20})
+
+        request_ids = {first.headers["X-Request-ID"],
+                       second.headers["X-Request-ID"]}
+        self.assertEqual(len(request_ids), 2)
+        self.assertNotIn("bad id;" * 20, request_ids)
+        self.assertEqual(set(tracing.read_spans(self.trace_dir.name)),
+                         request_ids)
+
+    def test_background_span(self):
+        """ Work done outside of a request gets a request id of its own """
+        with self.app.app_context():
+            with tracing.span("dispatch") as dispatch:
+                self.assertEqual(tracing.outbound_headers(),
+                                 {"X-Request-ID": dispatch.request_id})
+        self.assertIsNone(tracing.outbound_headers())
+
+    def test_trace_files_are_rotated(self):
+        """ A full trace file is moved aside, only the last one is kept """
+        tracer = tracing.Tracer("rewards", self.trace_dir.name, max_bytes=100)
+        for number in range(10):
+            tracer.write({"request_id": str(number), "padding": "x" * 40})
+
+        path = os.path.join(self.trace_dir.name, "rewards.jsonl")
+        self.assertLess(os.path.getsize(path), 200)
+        self.assertLess(os.path.getsize(path + ".1"), 200)
+        self.assertEqual(sorted(tracing.read_spans(self.trace_dir.name)),
+                         ["6", "7", "8", "9"])
+
+    def test_tracing_is_off_without_a_directory(self):
+        """ Nothing is written unless a trace directory is set """
+        tracer = tracing.Tracer("rewards")
+        tracer.write({"request_id": "1"})
+        self.assertIsNone(tracer.path)
+
+
+if __name__ == "__main__":
+    main()
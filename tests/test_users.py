@@ -1,8 +1,8 @@
 from flask_testing import TestCase as FlaskTestingCase
-from unittest import main
+from unittest import main, mock
+import threading
 import requests
 import json
-from flask import Flask
 from services import users
 users.testing = True
 
@@ -12,12 +12,10 @@ class TestUserService(FlaskTestingCase):
 
     def create_app(self):
         """ Dynamically bind a fake  database to real application """
-        app = Flask(__name__)
+        app = users.app
         app.config['TESTING'] = True
-        app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        # every request of the test client now hits this in-memory database
         app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///:memory:"
-        users.db.init_app(app)
-        app.app_context().push()  # this does the binding
         return app
 
     def setUp(self):
@@ -26,6 +24,8 @@ class TestUserService(FlaskTestingCase):
         self.post_url = "http://localhost:5000/users/new"
         self.new_user_json = """{"name": "Andy Bernard"}"""
         users.db.create_all()
+        # forget the ranking left by previous tests
+        users.movie_index.update(movies=None, etag=None, checked_at=0.0)
         self.populate_db()
 
     def tearDown(self):
@@ -82,6 +82,60 @@ class TestUserService(FlaskTestingCase):
 
             self.assertEqual(expected_response_dict, actual_response_dict)
 
+    def test_expanded_bookings(self):
+        """ Movies and showtimes are fetched at once, with batch calls """
+        bookings = [
+            {"date": "2019-11-01", "id": 1, "movie": 2, "rewarded": True, "user": 1},
+            {"date": "2019-11-03", "id": 2, "movie": 7, "rewarded": True, "user": 1},
+        ]
+        showtimes = {"2019-11-01": [{"date": "2019-11-01", "id": 5, "movie": 2}]}
+        movie = {"director": "Ridley Scott", "id": 2, "rating": 9, "title": "Alien"}
+        # both expanding calls must be in flight together to get through
+        both_in_flight = threading.Barrier(2, timeout=5)
+
+        def answer(payload):
+            response = requests.Response()
+            response.status_code = 200
+            response._content = json.dumps(payload).encode()
+            return response
+
+        def fake_get(url, params=None, **kwargs):
+            return answer(bookings)
+
+        def fake_post(url, json=None, **kwargs):
+            if url == f"{users.SHOWTIMES_URL}/lookup":
+                self.assertEqual(json, {"from": "2019-11-01", "to": "2019-11-03",
+                                        "movies": [2, 7]})
+                both_in_flight.wait()
+                return answer(showtimes)
+            self.assertEqual(json, {"ids": [2, 7]})
+            both_in_flight.wait()
+            return answer({"movies": [movie], "not_found": [7]})
+
+        with mock.patch.object(users.client, "get", side_effect=fake_get), \
+                mock.patch.object(users.client, "post", side_effect=fake_post), \
+                users.app.test_client() as bookings_route:
+            response = bookings_route.get(
+                "/users/1/bookings?expand=movie,showtime")
+            self.assertEqual(response.status_code, 200)
+            expanded = response.get_json()
+            self.assertEqual(expanded[0]["movie"], movie)
+            self.assertEqual(expanded[0]["showtime"]["id"], 5)
+            # what is unknown to the other services stays as it was
+            self.assertEqual(expanded[1]["movie"], 7)
+            self.assertIsNone(expanded[1]["showtime"])
+
+            response = bookings_route.get("/users/1/bookings?expand=user")
+            self.assertEqual(response.status_code, 400)
+
+    def test_date_windows(self):
+        """ Close dates share a showtimes call """
+        windows = users.date_windows(
+            ["2019-11-01", "2019-11-07", "2019-11-08", "2020-01-01"])
+        self.assertEqual(windows, [("2019-11-01", "2019-11-07"),
+                                   ("2019-11-08", "2019-11-08"),
+                                   ("2020-01-01", "2020-01-01")])
+
     def test_not_found(self):
         """ GET a invalid user """
         invalid_user = "999"
@@ -90,6 +144,84 @@ class TestUserService(FlaskTestingCase):
             self.assertEqual(response.status_code, 404,
                              "Got {actual_reply.status_code} but expected 404")
 
+    def test_user_suggested(self):
+        """ The best rated movies the user has not booked, in rating order """
+        catalog = [
+            {"id": 1, "title": "Heat", "director": "Michael Mann", "rating": 7},
+            {"id": 2, "title": "Alien", "director": "Ridley Scott", "rating": 9},
+            {"id": 3, "title": "Ran", "director": "Akira Kurosawa", "rating": 8},
+            {"id": 4, "title": "Jaws", "director": "Steven Spielberg", "rating": 9},
+            {"id": 5, "title": "Tron", "director": "Steven Lisberger", "rating": 5},
+        ]
+        bookings = [{"id": 1, "movie": 2, "user": 1}]
+        fake_get = self.fake_services(catalog, bookings)
+
+        with mock.patch.object(users.client, "get", side_effect=fake_get), \
+                users.app.test_client() as suggested_route:
+            response = suggested_route.get("/users/1/suggested")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([movie["id"] for movie in response.get_json()],
+                         [4, 3, 1])
+
+    def test_suggested_index_refresh(self):
+        """ The catalog is downloaded again only when its ETag changed """
+        catalog = [{"id": 1, "title": "Heat", "director": "Michael Mann",
+                    "rating": 7}]
+        fake_get = self.fake_services(catalog, None)
+
+        with mock.patch.object(users.client, "get", side_effect=fake_get), \
+                users.app.test_client() as suggested_route:
+            suggested_route.get("/users/1/suggested")
+            # the ranking is trusted until MOVIE_INDEX_MAX_AGE has passed
+            suggested_route.get("/users/1/suggested")
+            movie_calls = [call for call in fake_get.calls
+                           if call[0] == users.MOVIES_URL]
+            self.assertEqual(len(movie_calls), 1)
+
+            users.movie_index["checked_at"] = 0.0
+            catalog.append({"id": 2, "title": "Ran",
+                            "director": "Akira Kurosawa", "rating": 8})
+            response = suggested_route.get("/users/1/suggested")
+
+        movie_calls = [call for call in fake_get.calls
+                       if call[0] == users.MOVIES_URL]
+        self.assertEqual(movie_calls[1][1], {"If-None-Match": '"v1"'})
+        self.assertEqual([movie["id"] for movie in response.get_json()], [2, 1])
+
+    def test_suggested_services_down(self):
+        """ Without a ranking to fall back on the route is unavailable """
+        with mock.patch.object(users.client, "get",
+                               side_effect=requests.exceptions.ConnectionError), \
+                users.app.test_client() as suggested_route:
+            response = suggested_route.get("/users/1/suggested")
+            self.assertEqual(response.status_code, 503)
+            response = suggested_route.get("/users/999/suggested")
+            self.assertEqual(response.status_code, 404)
+
+    def fake_services(self, catalog, bookings):
+        """ A stand-in for client.get answering as the Movies and Bookings
+            services would; the catalog ETag is its length
+        """
+        def fake_get(url, headers=None, **kwargs):
+            fake_get.calls.append((url, headers))
+            response = requests.Response()
+            if url == users.MOVIES_URL:
+                etag = f'"v{len(catalog)}"'
+                response.headers["ETag"] = etag
+                if (headers or {}).get("If-None-Match") == etag:
+                    response.status_code = 304
+                    return response
+                payload = catalog
+            else:
+                payload = bookings
+            response.status_code = 200 if payload is not None else 404
+            response._content = json.dumps(payload).encode()
+            return response
+
+        fake_get.calls = []
+        return fake_get
+
     def populate_db(self):
         """ Populates the database """
         u1 = users.User(name="Jim Halpert")